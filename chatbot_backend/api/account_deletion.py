@@ -0,0 +1,94 @@
+import logging
+import os
+import shutil
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .authentication import revoke_user
+from .bulk import delete_conversations
+from .models import AccountDeletion, Conversation
+from .tasks import submit_on_commit
+
+
+# Account deletion as a background job. Deleting a heavy user inline cascades through
+# every conversation, message and attachment in one request and one transaction,
+# locking those rows on the shared tables for as long as it takes. The job instead
+# deletes a bounded batch of conversations per short transaction, records progress
+# on its AccountDeletion row, removes the user's upload directory in one go and
+# deletes the (by then empty) user last. Tuned through settings.ACCOUNT_DELETION.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BATCH_SIZE': 100,
+}
+
+
+def _option(name):
+    return getattr(settings, 'ACCOUNT_DELETION', {}).get(name, DEFAULTS[name])
+
+
+def request_deletion(user_id):
+    """Lock the account and queue its deletion. Returns the job, an existing one if already queued."""
+    with transaction.atomic():
+        job = (
+            AccountDeletion.objects.filter(user_id=user_id)
+            .exclude(status=AccountDeletion.FAILED).first()
+        )
+        if job is not None:
+            return job
+        # No new logins while the job runs
+        get_user_model().objects.filter(pk=user_id).update(is_active=False)
+        job = AccountDeletion.objects.create(
+            user_id=user_id,
+            conversations_total=Conversation.objects.filter(user_id=user_id).count(),
+        )
+        submit_on_commit(run_deletion, job.pk)
+    # Nor requests with the tokens already issued, without waiting for their cached status to expire
+    revoke_user(user_id)
+    return job
+
+
+def _upload_directory(user_id):
+    # Attachments saved before blob storage live under user_<id>/, the whole tree is the user's.
+    # None for remote storage, which has no directories to drop
+    try:
+        return default_storage.path(f'user_{user_id}')
+    except NotImplementedError:
+        return None
+
+
+def run_deletion(job_pk):
+    """Run (or resume) a deletion job. Safe to call again after a crash."""
+    job = AccountDeletion.objects.get(pk=job_pk)
+    if job.status == AccountDeletion.DONE:
+        return job
+    AccountDeletion.objects.filter(pk=job.pk).update(status=AccountDeletion.RUNNING, error='')
+    directory = _upload_directory(job.user_id)
+
+    try:
+        batch_size = _option('BATCH_SIZE')
+        while True:
+            batch = list(Conversation.objects.filter(user_id=job.user_id).values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                break
+            # One short transaction per batch, other requests only wait on this batch's rows
+            with transaction.atomic():
+                # Legacy files are removed one by one only when there is no directory to drop
+                deleted = delete_conversations(Conversation.objects.filter(pk__in=batch), legacy_files=directory is None)
+                AccountDeletion.objects.filter(pk=job.pk).update(conversations_deleted=F('conversations_deleted') + deleted)
+
+        if directory is not None and os.path.isdir(directory):
+            shutil.rmtree(directory, ignore_errors=True)
+        # What is left (tokens, admin log entries) is small, the ORM cascade is fine
+        get_user_model().objects.filter(pk=job.user_id).delete()
+        AccountDeletion.objects.filter(pk=job.pk).update(status=AccountDeletion.DONE, finished_at=timezone.now())
+    except Exception as e:
+        logger.exception("Account deletion %s failed", job.job_id)
+        AccountDeletion.objects.filter(pk=job.pk).update(status=AccountDeletion.FAILED, error=str(e))
+    job.refresh_from_db()
+    return job
+
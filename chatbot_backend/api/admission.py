@@ -0,0 +1,172 @@
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+# Admission control for upstream LLM calls. At most MAX_IN_FLIGHT calls run at once
+# per process; up to MAX_QUEUE more wait, first come first served, for QUEUE_TIMEOUT
+# seconds. Anything beyond that is refused straight away with OverloadedError, so an
+# overload turns into quick 503s instead of every worker blocking on the upstream.
+# Threads (WSGI views) and coroutines (ASGI views) share the same slots.
+# Tuned through settings.LLM_ADMISSION.
+
+DEFAULTS = {
+    'MAX_IN_FLIGHT': 16,
+    'MAX_QUEUE': 32,
+    'QUEUE_TIMEOUT': 5.0,
+    'RETRY_AFTER': 5,
+}
+
+
+class OverloadedError(Exception):
+    def __init__(self, retry_after):
+        super().__init__("The AI service is busy, please retry later.")
+        self.retry_after = retry_after
+
+
+class _ThreadWaiter:
+    def __init__(self):
+        self.granted = False
+        self.event = threading.Event()
+
+    def grant(self):
+        self.granted = True
+        self.event.set()
+
+
+class _AsyncWaiter:
+    def __init__(self):
+        self.granted = False
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        # May be called from another thread or loop
+        self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=16, max_queue=32, queue_timeout=5.0, retry_after=5):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def _enter(self, make_waiter):
+        # Called under the lock: True when admitted right away, else the queued waiter
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise OverloadedError(self.retry_after)
+        waiter = make_waiter()
+        self._waiters.append(waiter)
+        return waiter
+
+    def _give_up(self, waiter):
+        # The wait ended without a slot, unless release() handed one over meanwhile.
+        # Returns True when the waiter holds a slot after all
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            return False
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # The slot passes straight to the longest waiter, in_flight stays the same
+                self._waiters.popleft().grant()
+                self.admitted += 1
+            else:
+                self.in_flight -= 1
+
+    def check(self):
+        """Raise OverloadedError if a call started now would be refused, without taking a slot."""
+        with self._lock:
+            if self.in_flight >= self.max_in_flight and len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise OverloadedError(self.retry_after)
+
+    def acquire(self):
+        with self._lock:
+            waiter = self._enter(_ThreadWaiter)
+        if waiter is True:
+            return
+        waiter.event.wait(self.queue_timeout)
+        if not self._give_up(waiter):
+            raise OverloadedError(self.retry_after)
+
+    async def aacquire(self):
+        with self._lock:
+            waiter = self._enter(_AsyncWaiter)
+        if waiter is True:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not self._give_up(waiter):
+                raise OverloadedError(self.retry_after)
+        except asyncio.CancelledError:
+            # The client went away while queued; pass on a slot it may just have been given
+            if self._give_up(waiter):
+                self.release()
+            raise
+
+    @contextmanager
+    def admit(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aadmit(self):
+        await self.aacquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def get_admission():
+    global _admission
+    if _admission is None:
+        with _admission_lock:
+            if _admission is None:
+                options = {**DEFAULTS, **getattr(settings, 'LLM_ADMISSION', {})}
+                _admission = AdmissionController(**{name.lower(): value for name, value in options.items()})
+    return _admission
+
+
+@receiver(setting_changed)
+def _reset_admission(setting, **kwargs):
+    global _admission
+    if setting == 'LLM_ADMISSION':
+        _admission = None
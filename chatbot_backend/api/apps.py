@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Hooks the query timer into connections opened from now on
+        from . import metrics  # noqa: F401
+        # Revokes the tokens of users deactivated or deleted anywhere, not just by our views
+        from . import authentication  # noqa: F401
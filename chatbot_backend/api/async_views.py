@@ -0,0 +1,175 @@
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework_simplejwt.settings import api_settings
+from .authentication import request_token
+from .context import build_context
+from .extraction import document_context
+from .retrieval import retrieval_context
+from .llm_client import CircuitOpenError
+from .router import get_router
+from .admission import OverloadedError, get_admission
+from .ratelimit import RateLimited, acheck_chat_rate
+from .usage import QuotaExceeded, Turn, acheck_quota, record_turn
+from .models import Conversation, Message
+from .response_cache import get_response_cache, make_key
+from .singleflight import get_single_flight
+from .views import _validate_files, _save_attachments, _upstream_unavailable, _wants_stream, _sse
+
+
+def _authenticate(request):
+    # DRF's api_view stack is sync-only, so async views read the token JWTAuthenticationMiddleware
+    # verified. Returns the user id from its claims, no database round trip
+    token = request_token(request)
+    if token is None:
+        return None
+    return token[api_settings.USER_ID_CLAIM]
+
+
+#async version of chat, served by chatbot_backend.asgi
+@csrf_exempt
+async def chat(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method. Please use POST."}, status=400)
+
+    user_id = _authenticate(request)
+    if user_id is None:
+        return JsonResponse({"error": "You must be logged in to interact with the chat."}, status=401)
+
+    try:
+        await acheck_chat_rate(user_id)
+        await acheck_quota(user_id)
+    except (RateLimited, QuotaExceeded) as e:
+        return _upstream_unavailable(e, status=429)
+
+    try:
+        prompt_message = request.POST.get("prompt_message", "")
+        conversation_id = request.POST.get("conversation_id", None)
+        files = request.FILES.getlist('files')
+
+        if not prompt_message and not files:
+            return JsonResponse({"error": "No prompt message or files provided"}, status=400)
+
+        file_error = _validate_files(request, files)
+        if file_error:
+            return file_error
+
+        if conversation_id:
+            conversation = await Conversation.objects.filter(conversation_id=conversation_id, user_id=user_id).afirst()
+            if not conversation:
+                return JsonResponse({"error": "Conversation not found or you are not authorized to continue this conversation."}, status=404)
+            history = await sync_to_async(build_context)(conversation)
+            new_conversation = False
+        else:
+            conversation_id = str(uuid.uuid4())
+            conversation = await Conversation.objects.acreate(user_id=user_id, conversation_id=conversation_id)
+            history = []
+            new_conversation = True
+
+        documents = await sync_to_async(document_context)(conversation, files, new_conversation)
+        retrieved = await sync_to_async(retrieval_context)(user_id, prompt_message, conversation, skip=documents["content"] if documents else "")
+
+        ai_input = prompt_message
+        if files:
+            file_info = [f"[File: {file.name}, Type: {file.content_type}, Size: {file.size} bytes]" for file in files]
+            ai_input += "\n\nAttached files:\n" + "\n".join(file_info)
+
+        llm_messages = [m for m in (documents, retrieved) if m] + history + [{"role": "user", "content": ai_input}]
+
+        if _wants_stream(request):
+            get_admission().check()
+            return _stream_chat(request, conversation, conversation_id, prompt_message, llm_messages, files)
+
+        response_cache = get_response_cache()
+        cache_key = make_key(settings.LLM_MODEL, llm_messages)
+        ai_response = await response_cache.aget(cache_key)
+        turn = Turn()
+
+        if ai_response is None:
+            # Waiting on the upstream only parks this coroutine, so one ASGI process
+            # can keep hundreds of completions in flight
+            async def complete():
+                with turn.upstream():
+                    response = await get_router().acomplete(llm_messages, turn=turn)
+                turn.add(response.usage)
+                answer = response.choices[0].message.content
+                await response_cache.aset(cache_key, answer)
+                return answer
+
+            ai_response = await get_single_flight().ado(cache_key, complete)
+
+        message = await Message.objects.acreate(
+            conversation=conversation,
+            user_message=prompt_message,
+            ai_response=ai_response,
+            model=turn.model
+        )
+        saved_files = await sync_to_async(_save_attachments)(request, message, files)
+        # After the attachments, see views.chat
+        await conversation.arecord_message(message)
+        await sync_to_async(record_turn)(conversation, message, turn)
+
+        return JsonResponse({
+            "conversation_id": conversation_id,
+            "ai_response": ai_response,
+            "files": saved_files
+        }, status=200)
+
+    except (CircuitOpenError, OverloadedError) as e:
+        return _upstream_unavailable(e)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+def _stream_chat(request, conversation, conversation_id, prompt_message, llm_messages, files):
+    async def event_stream():
+        yield _sse("start", {"conversation_id": str(conversation_id)})
+
+        chunks = []
+        turn = Turn()
+        try:
+            response_cache = get_response_cache()
+            cache_key = make_key(settings.LLM_MODEL, llm_messages)
+            ai_response = await response_cache.aget(cache_key)
+            if ai_response is not None:
+                yield _sse("token", {"token": ai_response})
+            else:
+                with turn.upstream():
+                    async for chunk in get_router().astream(llm_messages, turn=turn):
+                        turn.add(chunk.usage)
+                        if not chunk.choices:
+                            continue
+                        token = chunk.choices[0].delta.content
+                        if token:
+                            chunks.append(token)
+                            yield _sse("token", {"token": token})
+
+                ai_response = "".join(chunks)
+                await response_cache.aset(cache_key, ai_response)
+
+            message = await Message.objects.acreate(
+                conversation=conversation,
+                user_message=prompt_message,
+                ai_response=ai_response,
+                model=turn.model
+            )
+            saved_files = await sync_to_async(_save_attachments)(request, message, files)
+            # After the attachments, see views.chat
+            await conversation.arecord_message(message)
+            await sync_to_async(record_turn)(conversation, message, turn)
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+            return
+
+        yield _sse("done", {
+            "conversation_id": str(conversation_id),
+            "ai_response": ai_response,
+            "files": saved_files
+        })
+
+    response = StreamingHttpResponse(event_stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
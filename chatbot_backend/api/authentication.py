@@ -0,0 +1,305 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from .metrics import span
+
+
+# JWT authentication done once per request. JWTAuthenticationMiddleware verifies the
+# Bearer token and stores the result on the request; DRF (CachedJWTAuthentication),
+# validate_token and the async views all read that result instead of decoding again.
+# Recently verified tokens are kept in a small LRU until they expire, so a client
+# polling with the same token skips the signature check, and the user is built from
+# the token claims, touching the database only if a view needs more than the id.
+# Whether the user is still active is read from the User row and kept in the cache
+# (CACHE_ALIAS) for STATUS_TIMEOUT seconds; deactivating or deleting a user updates
+# that entry at once, other processes not sharing the cache see it within the timeout.
+# Configured through settings.AUTH_TOKEN_CACHE.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_ENTRIES': 10_000,
+    'CACHE_ALIAS': 'default',
+    'STATUS_TIMEOUT': 60,
+}
+
+
+def _option(name):
+    return getattr(settings, 'AUTH_TOKEN_CACHE', {}).get(name, DEFAULTS[name])
+
+
+class VerifiedTokenCache:
+    def __init__(self, max_entries=10_000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, raw_token):
+        with self._lock:
+            entry = self._entries.get(raw_token)
+            if entry is None:
+                return None
+            token, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[raw_token]
+                return None
+            self._entries.move_to_end(raw_token)
+            return token
+
+    def set(self, raw_token, token):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[raw_token] = (token, token['exp'])
+            self._entries.move_to_end(raw_token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict_user(self, user_id):
+        with self._lock:
+            for raw_token in [key for key, (token, _) in self._entries.items()
+                              if str(token.get(api_settings.USER_ID_CLAIM)) == str(user_id)]:
+                del self._entries[raw_token]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                options = {**DEFAULTS, **getattr(settings, 'AUTH_TOKEN_CACHE', {})}
+                _token_cache = VerifiedTokenCache(max_entries=options['MAX_ENTRIES'])
+    return _token_cache
+
+
+def _status_key(user_id):
+    return f"auth:active:{user_id}"
+
+
+def _set_status(user_id, active):
+    try:
+        caches[_option('CACHE_ALIAS')].set(_status_key(user_id), active, _option('STATUS_TIMEOUT'))
+    except Exception:
+        logger.warning("Could not cache the status of user %s", user_id, exc_info=True)
+
+
+def _load_status(user_id):
+    # The row is the source of truth: a deleted user has none, so is not active either
+    active = get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id, 'is_active': True}).exists()
+    _set_status(user_id, active)
+    return active
+
+
+def revoke_user(user_id):
+    """Reject the user's tokens from now on. Deactivate or delete the user too, or this expires."""
+    _set_status(user_id, False)
+    get_token_cache().evict_user(user_id)
+
+
+def unrevoke_user(user_id):
+    # Read the row again on the next request
+    try:
+        caches[_option('CACHE_ALIAS')].delete(_status_key(user_id))
+    except Exception:
+        logger.warning("Could not cache the status of user %s", user_id, exc_info=True)
+
+
+def is_revoked(user_id):
+    try:
+        active = caches[_option('CACHE_ALIAS')].get(_status_key(user_id))
+    except Exception:
+        # Unreachable cache: ask the database rather than trust the token
+        logger.warning("Could not read the status of user %s", user_id, exc_info=True)
+        active = None
+    if active is None:
+        active = _load_status(user_id)
+    return not active
+
+
+async def ais_revoked(user_id):
+    try:
+        active = await caches[_option('CACHE_ALIAS')].aget(_status_key(user_id))
+    except Exception:
+        logger.warning("Could not read the status of user %s", user_id, exc_info=True)
+        active = None
+    if active is None:
+        active = await sync_to_async(_load_status)(user_id)
+    return not active
+
+
+class ClaimsUser:
+    # Stands in for the User row: the id comes from the token, anything else loads the
+    # row once. Query by user_id=request.user.id, not user=request.user
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, token):
+        self.token = token
+        self.id = self.pk = token[api_settings.USER_ID_CLAIM]
+        self._user = None
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = get_user_model().objects.get(**{api_settings.USER_ID_FIELD: self.id})
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def __eq__(self, other):
+        return getattr(other, 'pk', None) == self.pk
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return f"User {self.pk}"
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    # Lets the tokens of a revoked user through, for the views they still need
+    allow_revoked = False
+
+    def get_validated_token(self, raw_token):
+        cache = get_token_cache()
+        key = raw_token.decode() if isinstance(raw_token, bytes) else raw_token
+        token = cache.get(key)
+        if token is None:
+            token = super().get_validated_token(raw_token)
+            cache.set(key, token)
+        return token
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken("Token contained no recognizable user identification")
+        return ClaimsUser(validated_token)
+
+    def authenticate(self, request):
+        # Reuse what JWTAuthenticationMiddleware found for this request
+        django_request = getattr(request, '_request', request)
+        if not hasattr(django_request, 'jwt_token'):
+            authenticate_request(django_request)
+        if self.allow_revoked and django_request.jwt_revoked is not None:
+            return django_request.jwt_revoked
+        if django_request.jwt_error is not None:
+            raise django_request.jwt_error
+        if django_request.jwt_token is None:
+            return None
+        return django_request.jwt_user, django_request.jwt_token
+
+
+class RevokedJWTAuthentication(CachedJWTAuthentication):
+    allow_revoked = True
+
+
+_authenticator = None
+
+
+def authenticate_request(request, check_revoked=True):
+    """Verify the request's Bearer token, once, and record the outcome on the request."""
+    global _authenticator
+    if _authenticator is None:
+        _authenticator = CachedJWTAuthentication()
+    request.jwt_token = request.jwt_user = request.jwt_error = request.jwt_revoked = None
+    try:
+        with span("auth"):
+            header = _authenticator.get_header(request)
+            raw_token = _authenticator.get_raw_token(header) if header else None
+            if raw_token is not None:
+                token = _authenticator.get_validated_token(raw_token)
+                request.jwt_user = _authenticator.get_user(token)
+                request.jwt_token = token
+                if check_revoked:
+                    _reject_revoked(request, is_revoked(request.jwt_user.id))
+    except (AuthenticationFailed, InvalidToken) as e:
+        request.jwt_error = e
+
+
+def _reject_revoked(request, revoked):
+    if revoked:
+        # Kept aside for RevokedJWTAuthentication, everything else sees a rejected token
+        request.jwt_revoked = (request.jwt_user, request.jwt_token)
+        request.jwt_token = request.jwt_user = None
+        request.jwt_error = AuthenticationFailed("User is inactive", code="user_inactive")
+
+
+def request_token(request):
+    """The verified access token of this request, None when missing or invalid."""
+    request = getattr(request, '_request', request)
+    if not hasattr(request, 'jwt_token'):
+        authenticate_request(request)
+    return request.jwt_token
+
+
+class JWTAuthenticationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _process(self, request):
+        authenticate_request(request)
+        if request.jwt_user is not None:
+            request.user = request.jwt_user
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self._process(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # Pure CPU work (and usually a cache hit), no need to leave the event loop; the
+        # status lookup goes through the cache's async API, the database only on a miss
+        authenticate_request(request, check_revoked=False)
+        if request.jwt_user is not None:
+            with span("auth"):
+                _reject_revoked(request, await ais_revoked(request.jwt_user.id))
+        if request.jwt_user is not None:
+            request.user = request.jwt_user
+        return await self.get_response(request)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def _revoke_inactive_user(sender, instance, update_fields=None, **kwargs):
+    if not instance.is_active:
+        revoke_user(instance.pk)
+    elif update_fields is None or 'is_active' in update_fields:
+        _set_status(instance.pk, True)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _revoke_deleted_user(sender, instance, **kwargs):
+    revoke_user(instance.pk)
+
+
+@receiver(setting_changed)
+def _reset_token_cache(setting, **kwargs):
+    global _token_cache, _authenticator
+    if setting in ('AUTH_TOKEN_CACHE', 'SIMPLE_JWT'):
+        _token_cache = None
+        _authenticator = None
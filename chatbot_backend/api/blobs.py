@@ -0,0 +1,74 @@
+import hashlib
+from django.db import transaction
+from .models import Blob, FileAttachment, blob_path
+
+
+# Content-addressed attachment storage. Files are keyed by their SHA-256, so the
+# same document uploaded again (every turn, or by another user) is stored once and
+# the duplicate upload never touches the disk. A blob is referenced by its
+# FileAttachment rows and garbage-collected when the last one is deleted.
+
+
+def file_sha256(file):
+    # HashingUploadHandler already hashed the upload while streaming it to disk
+    sha = getattr(file, 'sha256', None)
+    if sha:
+        return sha
+    hasher = hashlib.sha256()
+    for chunk in file.chunks():
+        hasher.update(chunk)
+    file.seek(0)
+    return hasher.hexdigest()
+
+
+def store_blob(file):
+    """Return the Blob holding this file's content, writing it to storage only if it is new."""
+    sha = file_sha256(file)
+    with transaction.atomic():
+        # Locking the row keeps a concurrent collect_blobs() from deleting it under us
+        blob = Blob.objects.select_for_update().filter(sha256=sha).first()
+        if blob is not None:
+            return blob
+
+        storage = Blob._meta.get_field('file').storage
+        # Written even if a file is already there: without a Blob row it is either one
+        # collect_blobs() is about to delete or a concurrent upload's. Storage then picks
+        # a free name, which is the one recorded
+        saved = storage.save(blob_path(Blob(sha256=sha), file.name), file)
+        blob, _ = Blob.objects.get_or_create(sha256=sha, defaults={'file': saved, 'size': file.size})
+        if blob.file.name != saved:
+            # Another request stored the same content first, keep its copy
+            storage.delete(saved)
+        return blob
+
+
+def referenced_blob_ids(attachments):
+    return set(attachments.exclude(blob=None).values_list('blob_id', flat=True))
+
+
+def collect_blobs(blob_ids):
+    """Delete the given blobs that no attachment references anymore, and their files."""
+    if not blob_ids:
+        return 0
+    with transaction.atomic():
+        orphans = list(
+            Blob.objects.select_for_update()
+            .filter(pk__in=blob_ids)
+            .exclude(pk__in=FileAttachment.objects.filter(blob_id__in=blob_ids).values('blob_id'))
+            .values_list('pk', 'file')
+        )
+        if not orphans:
+            return 0
+        Blob.objects.filter(pk__in=[pk for pk, _ in orphans]).delete()
+        # Files go only once the rows are gone for good
+        transaction.on_commit(lambda: _delete_files([name for _, name in orphans]))
+    return len(orphans)
+
+
+def _delete_files(names):
+    # Unless the same content was uploaded again in the meantime and a new Blob row took the name
+    storage = Blob._meta.get_field('file').storage
+    reused = set(Blob.objects.filter(file__in=names).values_list('file', flat=True))
+    for name in names:
+        if name not in reused:
+            storage.delete(name)
@@ -0,0 +1,56 @@
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from .blobs import collect_blobs, referenced_blob_ids
+from .models import Conversation, FileAttachment, Message
+from .tasks import submit_on_commit
+
+
+# Set-based operations on many conversations at once. Deletes run as one
+# DELETE ... WHERE statement per table instead of going through Django's cascade
+# collector, which first loads every message and attachment into Python. Files are
+# cleaned up in the background once the rows are gone.
+
+MAX_CONVERSATIONS = 500
+
+
+def _delete_legacy_files(names):
+    # Attachments saved before blob storage own their file, unless an older row shares the path
+    still_used = set(FileAttachment.objects.filter(file__in=names).values_list('file', flat=True))
+    for name in names:
+        if name not in still_used:
+            default_storage.delete(name)
+
+
+def delete_conversations(conversations, legacy_files=True):
+    """Delete the given Conversation queryset with its messages and attachments. Returns the number deleted.
+
+    Pass legacy_files=False when the caller removes the owners' upload directories itself.
+    """
+    with transaction.atomic():
+        pks = list(conversations.values_list('pk', flat=True))
+        if not pks:
+            return 0
+        attachments = FileAttachment.objects.filter(message__conversation_id__in=pks)
+        blob_ids = referenced_blob_ids(attachments)
+        legacy_names = list(attachments.filter(blob=None).values_list('file', flat=True)) if legacy_files else []
+
+        # Children first, the foreign keys are not ON DELETE CASCADE in the database
+        attachments._raw_delete(attachments.db)
+        messages = Message.objects.filter(conversation_id__in=pks)
+        messages._raw_delete(messages.db)
+        conversations = Conversation.objects.filter(pk__in=pks)
+        deleted = conversations._raw_delete(conversations.db)
+        if blob_ids:
+            submit_on_commit(collect_blobs, blob_ids)
+        if legacy_names:
+            submit_on_commit(_delete_legacy_files, legacy_names)
+    return deleted
+
+
+def archive_conversations(conversations):
+    return conversations.filter(archived_at=None).update(archived_at=timezone.now())
+
+
+def unarchive_conversations(conversations):
+    return conversations.exclude(archived_at=None).update(archived_at=None)
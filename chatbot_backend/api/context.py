@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+from .models import Message
+
+
+# Builds the conversation history sent to the model with each new turn.
+# The assembled turns are cached per conversation, so a new turn only reads the
+# messages written since the last one (usually a single row) instead of the whole history.
+
+DEFAULTS = {
+    'MAX_MESSAGES': 20,
+    'TOKEN_BUDGET': 3000,
+    'CACHE_ALIAS': 'default',
+    'CACHE_TIMEOUT': 60 * 60,
+}
+
+
+def _option(name):
+    return getattr(settings, 'LLM_CONTEXT', {}).get(name, DEFAULTS[name])
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text, good enough for budgeting
+    return len(text) // 4 + 1
+
+
+def _cache_key(conversation):
+    return f"llm-context:{conversation.pk}"
+
+
+def build_context(conversation):
+    """Return the previous turns of the conversation as chat messages, oldest first."""
+    max_messages = _option('MAX_MESSAGES')
+    cache = caches[_option('CACHE_ALIAS')]
+    state = cache.get(_cache_key(conversation))
+
+    messages = Message.objects.filter(conversation=conversation)
+    fields = ('id', 'created_at', 'user_message', 'ai_response')
+    rows = None
+    turns = []
+    if state is not None:
+        # Warm: range seek on (conversation, created_at, id) for what was written since
+        # the cached prefix was assembled, usually the single previous turn
+        rows = list(messages.filter(
+            Q(created_at__gt=state['last_created_at']) | Q(created_at=state['last_created_at'], id__gt=state['last_id'])
+        ).order_by('created_at', 'id').values_list(*fields)[:max_messages])
+        turns = state['turns']
+        if len(rows) == max_messages:
+            # So much is new that the cached turns fell out of the window, start over
+            rows = None
+            turns = []
+    if rows is None:
+        # Cold: the newest turns, read backwards along the same index
+        rows = list(messages.order_by('-created_at', '-id').values_list(*fields)[:max_messages])
+        rows.reverse()
+
+    for pk, _, user_message, ai_response in rows:
+        turns.append((pk, user_message, ai_response, estimate_tokens(user_message) + estimate_tokens(ai_response)))
+    turns = turns[-max_messages:]
+
+    # Drop the oldest turns until the history fits the token budget
+    budget = _option('TOKEN_BUDGET')
+    total = sum(turn[3] for turn in turns)
+    start = 0
+    while start < len(turns) and total > budget:
+        total -= turns[start][3]
+        start += 1
+    turns = turns[start:]
+
+    if rows:
+        state = {'last_id': rows[-1][0], 'last_created_at': rows[-1][1], 'turns': turns}
+        cache.set(_cache_key(conversation), state, _option('CACHE_TIMEOUT'))
+
+    context = []
+    for _, user_message, ai_response, _ in turns:
+        if user_message:
+            context.append({"role": "user", "content": user_message})
+        if ai_response:
+            context.append({"role": "assistant", "content": ai_response})
+    return context
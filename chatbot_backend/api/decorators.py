@@ -1,5 +1,5 @@
-from rest_framework_simplejwt.tokens import AccessToken
 from django.http import JsonResponse
+from .authentication import request_token
 
 def validate_token(view_func):
     def _wrapped_view(request, *args, **kwargs):
@@ -7,12 +7,10 @@ def validate_token(view_func):
         if not token:
             return JsonResponse({"error": "No token provided"}, status=401)
         
-        try:
-            token = token.split(' ')[1]  # Assuming the token is in the format "Bearer <token>"
-            AccessToken(token)
-        except Exception as e:
+        # Verified once per request by JWTAuthenticationMiddleware, this only reads the result
+        if request_token(request) is None:
             return JsonResponse({"error": "Invalid token"}, status=401)
         
         return view_func(request, *args, **kwargs)
     
-    return _wrapped_view
\ No newline at end of file
+    return _wrapped_view
@@ -0,0 +1,221 @@
+import json
+import uuid
+import zlib
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils.dateparse import parse_datetime
+from .models import Blob, Conversation, FileAttachment, Message
+from .retrieval import invalidate_user
+
+
+# Conversation history as NDJSON: one "conversation" line followed by its "message"
+# lines, oldest first. Rows are read with server-side cursors in chunks, a query per
+# CHUNK_SIZE rows, and written out line by line, so memory stays flat however long
+# the history is. import_lines
+# reads the same format back with batched bulk_create, for moving data between
+# environments (python manage.py import_conversations).
+
+CHUNK_SIZE = 500
+# Compressed output is flushed in pieces of about this size rather than per line
+GZIP_FLUSH_BYTES = 64 * 1024
+
+
+def _dt(value):
+    return value.isoformat() if value else None
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_lines(conversations):
+    """Yield NDJSON lines for the given Conversation queryset."""
+    attachments = Prefetch(
+        'attachments',
+        queryset=FileAttachment.objects.select_related('blob').only(
+            'message_id', 'file_name', 'file_type', 'blob__sha256', 'uploaded_at'
+        ),
+    )
+    ordered = conversations.order_by('created_at', 'id').iterator(chunk_size=CHUNK_SIZE)
+    for batch in _batches(ordered, CHUNK_SIZE):
+        # One message query per batch of conversations instead of one per conversation. It
+        # walks the (conversation, created_at, id) index, so the batch goes out in id order
+        batch.sort(key=lambda conversation: conversation.pk)
+        messages = (
+            Message.objects.filter(conversation_id__in=[conversation.pk for conversation in batch])
+            .order_by('conversation_id', 'created_at', 'id')
+            .prefetch_related(attachments)
+            .iterator(chunk_size=CHUNK_SIZE)
+        )
+        message = next(messages, None)
+        for conversation in batch:
+            yield json.dumps({
+                "type": "conversation",
+                "conversation_id": str(conversation.conversation_id),
+                "title": conversation.title,
+                "created_at": _dt(conversation.created_at),
+                "last_edited_at": _dt(conversation.last_edited_at),
+                "archived_at": _dt(conversation.archived_at),
+            }) + "\n"
+
+            while message is not None and message.conversation_id == conversation.pk:
+                yield json.dumps({
+                    "type": "message",
+                    "conversation_id": str(conversation.conversation_id),
+                    "user_message": message.user_message,
+                    "ai_response": message.ai_response,
+                    "model": message.model,
+                    "created_at": _dt(message.created_at),
+                    "attachments": [{
+                        "file_name": attachment.file_name,
+                        "file_type": attachment.file_type,
+                        "sha256": attachment.blob.sha256 if attachment.blob else None,
+                        "uploaded_at": _dt(attachment.uploaded_at),
+                    } for attachment in message.attachments.all()],
+                }) + "\n"
+                message = next(messages, None)
+
+
+def gzip_lines(lines):
+    """Gzip a stream of text lines on the fly, yielding compressed chunks."""
+    compressor = zlib.compressobj(wbits=31)  # 31: gzip header and trailer
+    pending = []
+    size = 0
+    for line in lines:
+        data = compressor.compress(line.encode())
+        if data:
+            pending.append(data)
+            size += len(data)
+        if size >= GZIP_FLUSH_BYTES:
+            yield b"".join(pending)
+            pending, size = [], 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
+
+
+def _bulk_create(model, objs, batch_size):
+    # bulk_create stamps auto_now/auto_now_add fields with the import time; the
+    # originals are written back with bulk_update, which leaves them as they are
+    fields = [
+        field.attname for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    originals = [[getattr(obj, name) for name in fields] for obj in objs]
+    model.objects.bulk_create(objs, batch_size=batch_size)
+    for obj, values in zip(objs, originals):
+        for name, value in zip(fields, values):
+            setattr(obj, name, value)
+    model.objects.bulk_update(objs, fields, batch_size=batch_size)
+
+
+class _Importer:
+    def __init__(self, user, batch_size, new_ids):
+        self.user = user
+        self.batch_size = batch_size
+        self.new_ids = new_ids
+        self.current = (None, None)  # exported conversation_id and its Conversation; messages follow it
+        self.pending_conversations = []
+        self.pending_messages = []  # (Message, [attachment dicts])
+        self.touched = {}  # id(Conversation) -> [Conversation, messages added, last created_at]; unsaved models are unhashable
+        self.stats = {"conversations": 0, "messages": 0, "attachments": 0, "missing_blobs": 0}
+
+    def add(self, record):
+        if record["type"] == "conversation":
+            conversation = Conversation(
+                user=self.user,
+                conversation_id=uuid.uuid4() if self.new_ids else uuid.UUID(record["conversation_id"]),
+                title=record.get("title") or '',
+                created_at=parse_datetime(record["created_at"]),
+                last_edited_at=parse_datetime(record.get("last_edited_at") or record["created_at"]),
+                archived_at=parse_datetime(record["archived_at"]) if record.get("archived_at") else None,
+            )
+            self.current = (record["conversation_id"], conversation)
+            self.pending_conversations.append(conversation)
+        elif record["type"] == "message":
+            exported_id, conversation = self.current
+            if record["conversation_id"] != exported_id:
+                raise ValueError(f"Message of conversation {record['conversation_id']} outside its conversation")
+            message = Message(
+                conversation=conversation,
+                user_message=record["user_message"],
+                ai_response=record["ai_response"],
+                # Absent from exports made before models were recorded
+                model=record.get("model"),
+                created_at=parse_datetime(record["created_at"]),
+            )
+            self.pending_messages.append((message, record.get("attachments") or []))
+            # Denormalized listing fields, written once the conversation's messages are in
+            touched = self.touched.setdefault(id(conversation), [conversation, 0, None])
+            touched[1] += 1
+            touched[2] = message.created_at
+        if len(self.pending_conversations) + len(self.pending_messages) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with transaction.atomic():
+            if self.pending_conversations:
+                _bulk_create(Conversation, self.pending_conversations, self.batch_size)
+                self.stats["conversations"] += len(self.pending_conversations)
+            if self.pending_messages:
+                messages = [message for message, _ in self.pending_messages]
+                # conversation_id is picked up from conversations saved just above
+                _bulk_create(Message, messages, self.batch_size)
+                self.stats["messages"] += len(messages)
+                self._create_attachments()
+            if self.touched:
+                for conversation, count, last in self.touched.values():
+                    conversation.message_count += count
+                    conversation.last_message_at = last
+                Conversation.objects.bulk_update(
+                    [conversation for conversation, _, _ in self.touched.values()],
+                    ['message_count', 'last_message_at'], batch_size=self.batch_size,
+                )
+        self.pending_conversations, self.pending_messages, self.touched = [], [], {}
+
+    def _create_attachments(self):
+        shas = {a["sha256"] for _, attachments in self.pending_messages for a in attachments if a.get("sha256")}
+        blobs = {blob.sha256: blob for blob in Blob.objects.filter(sha256__in=shas)}
+        rows = []
+        for message, attachments in self.pending_messages:
+            for attachment in attachments:
+                # Only the content hash is exported, the file itself must already be in this environment
+                blob = blobs.get(attachment.get("sha256"))
+                if blob is None:
+                    self.stats["missing_blobs"] += 1
+                    continue
+                rows.append(FileAttachment(
+                    message=message, blob=blob, file=blob.file.name,
+                    file_name=attachment["file_name"], file_type=attachment["file_type"],
+                    uploaded_at=parse_datetime(attachment["uploaded_at"]),
+                ))
+        if rows:
+            _bulk_create(FileAttachment, rows, self.batch_size)
+        self.stats["attachments"] += len(rows)
+
+
+def import_lines(lines, user, batch_size=CHUNK_SIZE, new_ids=False):
+    """Import export_lines() output for user. Returns counts of what was created.
+
+    Rows are written with bulk_create every batch_size records, each batch in its own
+    transaction, so a failing line leaves the batches before it. Attachments are linked
+    to blobs already stored here by their sha256; new_ids gives the conversations fresh
+    conversation_ids, for importing into an environment that already has them.
+    """
+    importer = _Importer(user, batch_size, new_ids)
+    try:
+        for line in lines:
+            line = line.strip()
+            if line:
+                importer.add(json.loads(line))
+        importer.flush()
+    finally:
+        # The rows keep their original timestamps, too old for the indexes' incremental refresh
+        invalidate_user(user.pk)
+    return importer.stats
@@ -0,0 +1,226 @@
+import os
+import re
+import zipfile
+from xml.etree.ElementTree import iterparse
+from django.conf import settings
+from django.utils import timezone
+from .context import estimate_tokens
+from .models import BlobText, FileAttachment
+from .tasks import submit_on_commit
+
+try:
+    import pypdf
+except ImportError:  # optional, PDFs are marked unsupported without it
+    pypdf = None
+
+
+# Text extraction for document attachments. Parsing runs on the background pool
+# once the upload is committed; the text is chunked and stored per blob (BlobText),
+# so a document is parsed once however many times it is uploaded or referenced.
+# Each chat turn then sends the model the extracted text of the conversation's
+# documents, within a token budget. Tuned through settings.LLM_ATTACHMENTS.
+
+DEFAULTS = {
+    'CHUNK_SIZE': 1500,
+    'CHUNK_OVERLAP': 150,
+    'MAX_CHARS': 500_000,
+    'MAX_MEMBER_SIZE': 50 * 1024 * 1024,
+    'CONTEXT_TOKENS': 2000,
+}
+
+
+def _option(name):
+    return getattr(settings, 'LLM_ATTACHMENTS', {}).get(name, DEFAULTS[name])
+
+
+class UnsupportedDocument(Exception):
+    pass
+
+
+def _read_text(file):
+    data = file.read(_option('MAX_CHARS') * 4)
+    for encoding in ('utf-8', 'utf-16'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('latin-1')
+
+
+def _read_rtf(file):
+    text = _read_text(file)
+    # Good enough for prompts: drop control words and groups markers, keep the prose
+    text = re.sub(r"\\'[0-9a-f]{2}", '', text)
+    text = re.sub(r'\\(par|line)\b ?', '\n', text)
+    text = re.sub(r'\\[a-z]+-?\d* ?|[{}]', '', text)
+    return text
+
+
+def _read_pdf(file):
+    if pypdf is None:
+        raise UnsupportedDocument("PDF extraction needs the pypdf package")
+    pages = []
+    size = 0
+    for page in pypdf.PdfReader(file).pages:
+        text = page.extract_text() or ''
+        pages.append(text)
+        size += len(text)
+        if size >= _option('MAX_CHARS'):
+            break
+    return '\n\n'.join(pages)
+
+
+# Office Open XML members holding the text, in reading order
+OOXML_MEMBERS = {
+    '.docx': lambda names: ['word/document.xml'],
+    '.pptx': lambda names: sorted(
+        (n for n in names if re.fullmatch(r'ppt/slides/slide\d+\.xml', n)),
+        key=lambda n: int(re.search(r'(\d+)\.xml$', n).group(1)),
+    ),
+    '.xlsx': lambda names: ['xl/sharedStrings.xml'],
+}
+# Elements whose end starts a new line: paragraphs, shared strings, table rows
+OOXML_BREAKS = {'p', 'si', 'tr'}
+
+
+def _read_ooxml(file, ext):
+    parts = []
+    size = 0
+    with zipfile.ZipFile(file) as archive:
+        names = archive.namelist()
+        for name in OOXML_MEMBERS[ext](names):
+            if name not in names:
+                continue
+            if archive.getinfo(name).file_size > _option('MAX_MEMBER_SIZE'):
+                raise UnsupportedDocument(f"{name} is too large to extract")
+            with archive.open(name) as member:
+                # Streamed, the XML tree is never held whole
+                for _, element in iterparse(member):
+                    tag = element.tag.rsplit('}', 1)[-1]
+                    if tag == 't' and element.text:
+                        parts.append(element.text)
+                        size += len(element.text)
+                    elif tag in OOXML_BREAKS:
+                        parts.append('\n')
+                        element.clear()
+                    if size >= _option('MAX_CHARS'):
+                        return ''.join(parts)
+    return ''.join(parts)
+
+
+def extract_text(file, ext):
+    if ext in ('.txt',):
+        return _read_text(file)
+    if ext == '.rtf':
+        return _read_rtf(file)
+    if ext == '.pdf':
+        return _read_pdf(file)
+    if ext in OOXML_MEMBERS:
+        return _read_ooxml(file, ext)
+    raise UnsupportedDocument(f"No text extractor for {ext} files")
+
+
+def chunk_text(text):
+    """Split text into chunks of about CHUNK_SIZE characters on whitespace, overlapping by CHUNK_OVERLAP."""
+    text = re.sub(r'[ \t]+', ' ', re.sub(r'\n\s*\n+', '\n\n', text)).strip()
+    size = _option('CHUNK_SIZE')
+    overlap = _option('CHUNK_OVERLAP')
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # Prefer to cut at a whitespace boundary in the last part of the chunk
+            cut = text.rfind(' ', start + size // 2, end)
+            if cut == -1:
+                cut = text.rfind('\n', start + size // 2, end)
+            if cut != -1:
+                end = cut
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        # Start the next chunk on a word boundary inside the overlap
+        boundary = text.find(' ', max(end - overlap, start + 1), end)
+        start = boundary + 1 if boundary != -1 else end
+    return [chunk for chunk in chunks if chunk]
+
+
+def extract_blob(blob_id):
+    """Background task: extract, chunk and store the text of one blob."""
+    text_row = BlobText.objects.select_related('blob').filter(blob_id=blob_id, status=BlobText.PENDING).first()
+    if text_row is None:
+        return
+    blob = text_row.blob
+    ext = os.path.splitext(blob.file.name)[1].lower()
+    try:
+        with blob.file.open('rb') as file:
+            text = extract_text(file, ext)[:_option('MAX_CHARS')]
+        text_row.chunks = chunk_text(text)
+        text_row.char_count = len(text)
+        text_row.status = BlobText.DONE
+    except UnsupportedDocument as e:
+        text_row.status = BlobText.UNSUPPORTED
+        text_row.error = str(e)
+    except Exception as e:
+        text_row.status = BlobText.FAILED
+        text_row.error = str(e)
+    text_row.extracted_at = timezone.now()
+    text_row.save()
+
+
+def queue_extraction(attachment):
+    # Only the first attachment of a given content triggers a parse
+    if attachment.file_category != 'document':
+        return
+    _, created = BlobText.objects.get_or_create(blob=attachment.blob)
+    if created:
+        submit_on_commit(extract_blob, attachment.blob_id)
+
+
+def document_context(conversation, files, new_conversation=False):
+    """Return a system message with the extracted text of the documents in play, or None.
+
+    Documents uploaded with this turn come first (available right away when the same
+    content was parsed before), then those attached earlier in the conversation, newest first.
+    """
+    documents = []
+    hashes = [file.sha256 for file in files if getattr(file, 'sha256', None)]
+    if hashes:
+        names = {file.sha256: file.name for file in files if getattr(file, 'sha256', None)}
+        for sha, blob_id in BlobText.objects.filter(blob__sha256__in=hashes, status=BlobText.DONE).values_list('blob__sha256', 'blob_id'):
+            documents.append((blob_id, names[sha]))
+    if not new_conversation:
+        earlier = (
+            FileAttachment.objects
+            .filter(message__conversation=conversation, blob__text__status=BlobText.DONE)
+            .values_list('id', 'blob_id', 'file_name')
+        )
+        # Sorted here, a conversation has few attachments and the index walk is by message
+        documents.extend((blob_id, name) for _, blob_id, name in sorted(earlier, reverse=True))
+
+    seen = set()
+    documents = [(blob_id, name) for blob_id, name in documents if not (blob_id in seen or seen.add(blob_id))]
+    if not documents:
+        return None
+
+    chunks = dict(BlobText.objects.filter(blob_id__in=[blob_id for blob_id, _ in documents]).values_list('blob_id', 'chunks'))
+    budget = _option('CONTEXT_TOKENS')
+    sections = []
+    for blob_id, name in documents:
+        taken = []
+        for chunk in chunks.get(blob_id, []):
+            cost = estimate_tokens(chunk)
+            if cost > budget:
+                break
+            taken.append(chunk)
+            budget -= cost
+        if taken:
+            sections.append(f"[File: {name}]\n" + "\n".join(taken))
+        if budget <= 0:
+            break
+    if not sections:
+        return None
+    return {
+        "role": "system",
+        "content": "Text extracted from the files attached to this conversation:\n\n" + "\n\n".join(sections),
+    }
@@ -0,0 +1,306 @@
+import asyncio
+import random
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+import httpx
+import openai
+from django.conf import settings
+from openai import AsyncOpenAI, OpenAI
+from .admission import OverloadedError, get_admission
+from .metrics import LLM_REJECTED, LLM_SECONDS, add_span, record_usage, span
+
+
+# Client layer for the LLM upstream: pooled keep-alive connections, explicit
+# connect/read timeouts, retries with jittered backoff and a circuit breaker
+# that fails fast while OpenRouter is degraded, behind the admission control of
+# api.admission. api.router builds one client per model, tuned through
+# settings.LLM_CLIENT.
+
+DEFAULTS = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30.0,
+    'CONNECT_TIMEOUT': 5.0,
+    'READ_TIMEOUT': 60.0,
+    'MAX_RETRIES': 2,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 8.0,
+    'BREAKER_FAILURE_THRESHOLD': 5,
+    'BREAKER_RESET_TIMEOUT': 30.0,
+}
+
+# Worth another attempt: the request may well succeed a moment later
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after):
+        super().__init__("The AI service is temporarily unavailable, please retry later.")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    # closed -> open after `failure_threshold` consecutive upstream failures,
+    # open -> half-open after `reset_timeout`, where a single trial call decides
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            retry_after = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            raise CircuitOpenError(retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class LLMClient:
+    def __init__(self, base_url, api_key, **options):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.options = {**DEFAULTS, **options}
+        self.breaker = CircuitBreaker(
+            failure_threshold=self.options['BREAKER_FAILURE_THRESHOLD'],
+            reset_timeout=self.options['BREAKER_RESET_TIMEOUT'],
+        )
+        self._sync_client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _limits(self):
+        return httpx.Limits(
+            max_connections=self.options['MAX_CONNECTIONS'],
+            max_keepalive_connections=self.options['MAX_KEEPALIVE_CONNECTIONS'],
+            keepalive_expiry=self.options['KEEPALIVE_EXPIRY'],
+        )
+
+    def _timeout(self):
+        return httpx.Timeout(
+            self.options['READ_TIMEOUT'],
+            connect=self.options['CONNECT_TIMEOUT'],
+            pool=self.options['CONNECT_TIMEOUT'],
+        )
+
+    def _client_kwargs(self):
+        return {
+            "base_url": self.base_url,
+            "api_key": self.api_key,
+            "timeout": self._timeout(),
+            # Retries are ours, with jitter and breaker accounting
+            "max_retries": 0,
+            "default_headers": {"HTTP-Referer": "", "X-Title": ""},
+        }
+
+    @property
+    def client(self):
+        if self._sync_client is None:
+            with self._lock:
+                if self._sync_client is None:
+                    self._sync_client = OpenAI(
+                        http_client=httpx.Client(limits=self._limits(), timeout=self._timeout()),
+                        **self._client_kwargs(),
+                    )
+        return self._sync_client
+
+    @property
+    def async_client(self):
+        # httpx.AsyncClient pools are bound to an event loop: one per loop, which in
+        # production is the single loop of each ASGI worker
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = AsyncOpenAI(
+                http_client=httpx.AsyncClient(limits=self._limits(), timeout=self._timeout()),
+                **self._client_kwargs(),
+            )
+        return client
+
+    def backoff(self, attempt, error=None):
+        # Honour Retry-After on 429s, otherwise "full jitter" exponential backoff
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                return min(float(response.headers.get("retry-after")), self.options['BACKOFF_MAX'])
+            except (TypeError, ValueError):
+                pass
+        ceiling = min(self.options['BACKOFF_MAX'], self.options['BACKOFF_BASE'] * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def _create(self, messages, model, max_retries=None, **kwargs):
+        max_retries = self.options['MAX_RETRIES'] if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                response = self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                if attempt >= max_retries:
+                    raise
+                time.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            except openai.APIStatusError:
+                # The upstream answered, it just rejected this particular request
+                self.breaker.record_success()
+                raise
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            return response
+
+    async def _acreate(self, messages, model, max_retries=None, **kwargs):
+        max_retries = self.options['MAX_RETRIES'] if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                response = await self.async_client.chat.completions.create(model=model, messages=messages, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                if attempt >= max_retries:
+                    raise
+                await asyncio.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            except openai.APIStatusError:
+                # The upstream answered, it just rejected this particular request
+                self.breaker.record_success()
+                raise
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            return response
+
+    # Every call holds an admission slot (api.admission) until the upstream is done with it,
+    # for streams until the last token. Waiting for the slot is timed as the "queue" span,
+    # the call itself as "llm" (api.metrics)
+    @contextmanager
+    def _call(self, model, stream):
+        admission = get_admission()
+        with span("queue"):
+            try:
+                admission.acquire()
+            except OverloadedError:
+                LLM_REJECTED.inc()
+                raise
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except GeneratorExit:
+            # The client stopped reading the stream
+            outcome = "cancelled"
+            raise
+        finally:
+            admission.release()
+            self._observe(model, stream, outcome, started)
+
+    @asynccontextmanager
+    async def _acall(self, model, stream):
+        admission = get_admission()
+        with span("queue"):
+            try:
+                await admission.aacquire()
+            except OverloadedError:
+                LLM_REJECTED.inc()
+                raise
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except (GeneratorExit, asyncio.CancelledError):
+            outcome = "cancelled"
+            raise
+        finally:
+            admission.release()
+            self._observe(model, stream, outcome, started)
+
+    def _observe(self, model, stream, outcome, started):
+        elapsed = time.perf_counter() - started
+        add_span("llm", elapsed)
+        LLM_SECONDS.observe(elapsed, model=model, stream="true" if stream else "false", outcome=outcome)
+
+    # max_retries overrides MAX_RETRIES for the one call, see api.router
+    def complete(self, messages, model=None, max_retries=None, **kwargs):
+        model = model or settings.LLM_MODEL
+        with self._call(model, stream=False):
+            response = self._create(messages, model, max_retries, **kwargs)
+        record_usage(model, response.usage)
+        return response
+
+    async def acomplete(self, messages, model=None, max_retries=None, **kwargs):
+        model = model or settings.LLM_MODEL
+        async with self._acall(model, stream=False):
+            response = await self._acreate(messages, model, max_retries, **kwargs)
+        record_usage(model, response.usage)
+        return response
+
+    def stream(self, messages, model=None, max_retries=None, **kwargs):
+        model = model or settings.LLM_MODEL
+        # Token counts come in a final chunk without choices
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        with self._call(model, stream=True):
+            # Only opening the stream is retried, once tokens flow a failure is passed on
+            stream = self._create(messages, model, max_retries, stream=True, **kwargs)
+            try:
+                for chunk in stream:
+                    record_usage(model, chunk.usage)
+                    yield chunk
+            except RETRYABLE_ERRORS:
+                self.breaker.record_failure()
+                raise
+
+    async def astream(self, messages, model=None, max_retries=None, **kwargs):
+        model = model or settings.LLM_MODEL
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        async with self._acall(model, stream=True):
+            stream = await self._acreate(messages, model, max_retries, stream=True, **kwargs)
+            try:
+                async for chunk in stream:
+                    record_usage(model, chunk.usage)
+                    yield chunk
+            except RETRYABLE_ERRORS:
+                self.breaker.record_failure()
+                raise
+
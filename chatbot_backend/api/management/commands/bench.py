@@ -0,0 +1,291 @@
+import json
+import math
+import platform
+import random
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings, setup_test_environment
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+from api.mock_llm import MockLLMServer
+from api.models import Conversation, Message, conversation_title
+
+
+# python manage.py bench --json bench.json --baseline main.json
+# Seeds a throwaway test database with users, conversations and messages, then drives
+# each endpoint at a fixed concurrency against a local mock LLM (never the real
+# upstream) and reports throughput, p50/p95/p99 latency and queries per request.
+# Seeded data and request order come from --seed, so runs with the same options on
+# the same machine are comparable across commits; --baseline compares with the JSON
+# of an earlier run and fails on regressions. On SQLite concurrent writes serialize,
+# compare write-heavy endpoints on Postgres.
+
+ENDPOINTS = ("login", "history", "history2", "chat", "chat_stream", "delete")
+PASSWORD = "bench-password"
+WORDS = (
+    "the model answer question context file upload message conversation history token stream "
+    "latency database index query cache user request response python django server client "
+    "error retry timeout queue worker batch export import search title summary document page "
+    "cursor limit offset json api view test deploy metric trace span budget quota plan review"
+).split()
+
+
+def _text(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def percentile(values, p):
+    # Nearest rank, on sorted values
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def seed_database(rng, users, conversations, messages):
+    """Create users with conversations of messages. Returns [(username, auth header, [conversation_id])]."""
+    # One hash for everyone: hashing is what login measures, not what seeding should spend time on
+    password = make_password(PASSWORD)
+    created = User.objects.bulk_create([
+        User(username=f"bench{i}", email=f"bench{i}@example.com", password=password) for i in range(users)
+    ])
+    seeded = []
+    for user in created:
+        now = timezone.now()
+        convos = Conversation.objects.bulk_create([
+            Conversation(user=user, message_count=messages, last_message_at=now) for _ in range(conversations)
+        ])
+        rows = []
+        for convo in convos:
+            turns = [
+                Message(conversation=convo, user_message=_text(rng, 5, 40), ai_response=_text(rng, 30, 300))
+                for _ in range(messages)
+            ]
+            convo.title = conversation_title(turns[0].user_message) if turns else ""
+            rows.extend(turns)
+        Message.objects.bulk_create(rows, batch_size=1000)
+        Conversation.objects.bulk_update(convos, ["title"], batch_size=1000)
+        auth = "Bearer " + str(RefreshToken.for_user(user).access_token)
+        seeded.append((user.username, auth, [str(convo.conversation_id) for convo in convos]))
+    return seeded
+
+
+def _login(client, rng, username, auth, conversation_id):
+    return client.post("/api/login/", json.dumps({"username": username, "password": PASSWORD}), content_type="application/json")
+
+
+def _history(client, rng, username, auth, conversation_id):
+    return client.get(f"/api/chat_history/{conversation_id}/", headers={"Authorization": auth})
+
+
+def _history2(client, rng, username, auth, conversation_id):
+    return client.post("/api/history2/", headers={"Authorization": auth})
+
+
+def _chat(client, rng, username, auth, conversation_id, stream=False):
+    data = {"prompt_message": _text(rng, 5, 40), "conversation_id": conversation_id}
+    if stream:
+        data["stream"] = "1"
+    return client.post("/api/chat/", data, headers={"Authorization": auth})
+
+
+def _chat_stream(client, rng, username, auth, conversation_id):
+    return _chat(client, rng, username, auth, conversation_id, stream=True)
+
+
+def _delete(client, rng, username, auth, conversation_id):
+    return client.delete(f"/api/conversation_delete/{conversation_id}/", headers={"Authorization": auth})
+
+
+REQUESTS = {
+    "login": _login,
+    "history": _history,
+    "history2": _history2,
+    "chat": _chat,
+    "chat_stream": _chat_stream,
+    "delete": _delete,
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Benchmark the main endpoints on a seeded test database against a mock LLM: throughput, latency percentiles, queries."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--conversations", type=int, default=50, help="Conversations per user.")
+        parser.add_argument("--messages", type=int, default=20, help="Messages per conversation.")
+        parser.add_argument("--requests", type=int, default=200, help="Measured requests per endpoint.")
+        parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests per endpoint before the measured ones.")
+        parser.add_argument("--concurrency", type=int, default=8, help="Client threads, like gunicorn --workers/--threads.")
+        parser.add_argument("--latency", type=float, default=0.2, help="Mock upstream latency in seconds.")
+        parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Mock upstream token rate.")
+        parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"Comma-separated subset of {', '.join(ENDPOINTS)}.")
+        parser.add_argument("--seed", type=int, default=1, help="Seed for the generated data and request order.")
+        parser.add_argument("--json", dest="json_path", help="Write the results to this file.")
+        parser.add_argument("--baseline", help="JSON of an earlier run to compare with.")
+        parser.add_argument("--max-regression", type=float, default=0.2,
+                            help="With --baseline, fail when a p95 grows by more than this fraction or queries per request grow.")
+
+    def handle(self, *args, **options):
+        endpoints = [name.strip() for name in options["endpoints"].split(",") if name.strip()]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+        rng = random.Random(options["seed"])
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            with MockLLMServer(latency=options["latency"], tokens_per_second=options["tokens_per_second"]) as mock, \
+                    override_settings(LLM_BASE_URL=mock.base_url, LLM_API_KEY="bench",
+                                      # Every chat turn goes upstream, limits never get in the way
+                                      LLM_RESPONSE_CACHE={"BACKEND": "api.response_cache.DummyResponseCache"},
+                                      CHAT_RATE_LIMIT={"USER_RATE": 0, "GLOBAL_RATE": 0},
+                                      LLM_ADMISSION={"MAX_IN_FLIGHT": max(1000, options["concurrency"]), "MAX_QUEUE": 1000},
+                                      # Usage is written every 100 turns, not on a timer, so query counts repeat
+                                      USAGE_LEDGER={"BATCH_SIZE": 100, "FLUSH_INTERVAL": float("inf")},
+                                      LLM_CLIENT={"MAX_CONNECTIONS": 1000, "MAX_KEEPALIVE_CONNECTIONS": 1000}):
+                started = time.perf_counter()
+                seeded = seed_database(rng, options["users"], options["conversations"], options["messages"])
+                seed_seconds = time.perf_counter() - started
+                vendor = connection.vendor
+
+                # Deletes get conversations of their own, nothing else touches them
+                targets = [(username, auth, conversation_id) for username, auth, ids in seeded for conversation_id in ids]
+                rng.shuffle(targets)
+                deletable = targets[:options["requests"] + options["warmup"]] if "delete" in endpoints else []
+                targets = targets[len(deletable):]
+                if not targets:
+                    raise CommandError("Not enough conversations seeded for the deletes and the other endpoints.")
+
+                results = {}
+                for name in endpoints:
+                    pool = deletable if name == "delete" else [rng.choice(targets) for _ in range(options["requests"] + options["warmup"])]
+                    results[name] = self._run(name, pool, rng, options)
+        finally:
+            runner.teardown_databases(old_config)
+
+        report = {
+            "meta": {
+                "commit": _git_commit(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": vendor,
+                "options": {name: options[name] for name in (
+                    "users", "conversations", "messages", "requests", "warmup", "concurrency",
+                    "latency", "tokens_per_second", "seed",
+                )},
+            },
+            "seed_seconds": round(seed_seconds, 2),
+            "endpoints": results,
+        }
+        self._print(report, baseline)
+        if options["json_path"]:
+            with open(options["json_path"], "w") as f:
+                json.dump(report, f, indent=2)
+        if baseline is not None:
+            self._check(report, baseline, options["max_regression"])
+
+    def _run(self, name, pool, rng, options):
+        request = REQUESTS[name]
+        # Request arguments are drawn up front so threads do not share the generator
+        calls = [(target, random.Random(rng.random())) for target in pool]
+
+        def one(call):
+            (username, auth, conversation_id), call_rng = call
+            queries = []
+            started = time.perf_counter()
+            try:
+                # Counted per thread: each worker thread has its own connection
+                with connection.execute_wrapper(lambda execute, *args: queries.append(1) or execute(*args)):
+                    response = request(Client(), call_rng, username, auth, conversation_id)
+                    body = b"".join(response.streaming_content) if response.streaming else response.content
+                ok = response.status_code == 200 and (not response.streaming or b"event: done" in body)
+            except Exception:
+                ok = False
+            finally:
+                connection.close()
+            return ok, time.perf_counter() - started, len(queries)
+
+        warmup, measured = calls[:options["warmup"]], calls[options["warmup"]:]
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            list(executor.map(one, warmup))
+            started = time.perf_counter()
+            outcomes = list(executor.map(one, measured))
+            wall = time.perf_counter() - started
+
+        latencies = sorted(seconds for _, seconds, _ in outcomes)
+        queries = [count for _, _, count in outcomes]
+        ok = sum(1 for success, _, _ in outcomes if success)
+        return {
+            "requests": len(outcomes),
+            "ok": ok,
+            "errors": len(outcomes) - ok,
+            "wall_s": round(wall, 3),
+            "throughput": round(ok / wall, 2) if wall else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "queries_per_request": round(sum(queries) / len(queries), 2) if queries else 0.0,
+            "max_queries": max(queries, default=0),
+        }
+
+    def _print(self, report, baseline):
+        meta = report["meta"]
+        self.stdout.write(
+            f"commit {meta['commit'] or '?'} on {meta['database']}, seeded in {report['seed_seconds']:.1f}s, "
+            f"concurrency {meta['options']['concurrency']}"
+        )
+        self.stdout.write(
+            f"{'endpoint':<13}{'ok':>6}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+            + (f"{'p95 vs base':>13}" if baseline else "")
+        )
+        for name, r in report["endpoints"].items():
+            line = (
+                f"{name:<13}{r['ok']:>6}{r['errors']:>8}{r['throughput']:>9.1f}"
+                f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['queries_per_request']:>9.1f}"
+            )
+            base = (baseline or {}).get("endpoints", {}).get(name)
+            if base and base["p95_ms"]:
+                line += f"{(r['p95_ms'] / base['p95_ms'] - 1) * 100:>+12.0f}%"
+            self.stdout.write(line)
+
+    def _check(self, report, baseline, max_regression):
+        if baseline["meta"]["options"] != report["meta"]["options"]:
+            self.stderr.write("Baseline was run with different options, its numbers are not comparable.")
+        regressions = []
+        for name, r in report["endpoints"].items():
+            base = baseline.get("endpoints", {}).get(name)
+            if not base:
+                continue
+            if r["p95_ms"] > base["p95_ms"] * (1 + max_regression):
+                regressions.append(f"{name}: p95 {base['p95_ms']:.1f} -> {r['p95_ms']:.1f} ms")
+            if r["queries_per_request"] > base["queries_per_request"]:
+                regressions.append(f"{name}: queries per request {base['queries_per_request']} -> {r['queries_per_request']}")
+            if r["errors"] > base["errors"]:
+                regressions.append(f"{name}: errors {base['errors']} -> {r['errors']}")
+        if regressions:
+            raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(regressions))
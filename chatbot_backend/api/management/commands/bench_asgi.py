@@ -0,0 +1,101 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings, setup_test_environment
+from rest_framework_simplejwt.tokens import RefreshToken
+from api.mock_llm import MockLLMServer
+
+
+# python manage.py bench_asgi --requests 200 --wsgi-workers 8 --latency 1
+# Runs against a throwaway test database and a local mock LLM, never the real upstream.
+class Command(BaseCommand):
+    help = "Compare concurrent chat capacity of the sync (WSGI) and async (ASGI) chat views against a mock LLM."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200, help="Chat requests sent per mode.")
+        parser.add_argument("--concurrency", type=int, default=200, help="Client-side concurrency for the ASGI run.")
+        parser.add_argument("--wsgi-workers", type=int, default=8, help="Sync worker threads, like gunicorn --workers/--threads.")
+        parser.add_argument("--latency", type=float, default=1.0, help="Mock upstream latency in seconds.")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            with MockLLMServer(latency=options["latency"], tokens_per_second=1000) as mock, \
+                    override_settings(LLM_BASE_URL=mock.base_url, LLM_API_KEY="bench",
+                                      LLM_RESPONSE_CACHE={"BACKEND": "api.response_cache.DummyResponseCache"},
+                                      # Limits would turn the extra concurrency into 429s and 503s
+                                      CHAT_RATE_LIMIT={"USER_RATE": 0, "GLOBAL_RATE": 0},
+                                      LLM_ADMISSION={"MAX_IN_FLIGHT": max(options["concurrency"], options["wsgi_workers"]),
+                                                     "MAX_QUEUE": options["requests"]},
+                                      LLM_CLIENT={"MAX_CONNECTIONS": 1000, "MAX_KEEPALIVE_CONNECTIONS": 1000}):
+
+                user = User.objects.create_user("bench", "bench@example.com", "bench-password")
+                auth = "Bearer " + str(RefreshToken.for_user(user).access_token)
+
+                results = [
+                    ("wsgi", self._run_wsgi(mock, auth, options)),
+                    ("asgi", asyncio.run(self._run_asgi(mock, auth, options))),
+                ]
+        finally:
+            runner.teardown_databases(old_config)
+
+        self.stdout.write(f"{'mode':<6}{'ok':>6}{'errors':>8}{'wall s':>10}{'req/s':>9}{'p50 s':>8}{'p95 s':>8}{'peak upstream':>15}")
+        for mode, r in results:
+            self.stdout.write(
+                f"{mode:<6}{r['ok']:>6}{r['errors']:>8}{r['wall']:>10.2f}{r['ok'] / r['wall']:>9.1f}"
+                f"{r['p50']:>8.2f}{r['p95']:>8.2f}{r['peak']:>15}"
+            )
+
+    def _summary(self, mock, statuses, latencies, wall):
+        latencies = sorted(latencies)
+        return {
+            "ok": sum(1 for s in statuses if s == 200),
+            "errors": sum(1 for s in statuses if s != 200),
+            "wall": wall,
+            "p50": statistics.median(latencies),
+            "p95": latencies[int(len(latencies) * 0.95) - 1],
+            # Peak concurrent upstream calls is the capacity we are after
+            "peak": mock.peak_in_flight,
+        }
+
+    def _run_wsgi(self, mock, auth, options):
+        mock.peak_in_flight = 0
+
+        def one(i):
+            started = time.perf_counter()
+            try:
+                # Distinct prompts, identical ones would share a single upstream call
+                response = Client().post("/api/chat/", {"prompt_message": f"benchmark {i}"}, headers={"Authorization": auth})
+                return response.status_code, time.perf_counter() - started
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["wsgi_workers"]) as pool:
+            outcomes = list(pool.map(one, range(options["requests"])))
+        wall = time.perf_counter() - started
+        return self._summary(mock, [o[0] for o in outcomes], [o[1] for o in outcomes], wall)
+
+    async def _run_asgi(self, mock, auth, options):
+        mock.peak_in_flight = 0
+        client = AsyncClient()
+        gate = asyncio.Semaphore(options["concurrency"])
+
+        async def one(i):
+            async with gate:
+                started = time.perf_counter()
+                response = await client.post("/api/chat_async/", {"prompt_message": f"benchmark {i}"}, headers={"Authorization": auth})
+                return response.status_code, time.perf_counter() - started
+
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*(one(i) for i in range(options["requests"])))
+        wall = time.perf_counter() - started
+        return self._summary(mock, [o[0] for o in outcomes], [o[1] for o in outcomes], wall)
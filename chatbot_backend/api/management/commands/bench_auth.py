@@ -0,0 +1,72 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment
+from rest_framework.request import Request
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from api.authentication import authenticate_request, get_token_cache
+
+
+# python manage.py bench_auth --iterations 20000
+# Per-request cost of authenticating a Bearer token, before and after verifying it
+# once in JWTAuthenticationMiddleware. Runs against a throwaway test database.
+class Command(BaseCommand):
+    help = "Microbenchmark of per-request JWT authentication cost."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20000)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            user = User.objects.create_user("bench", "bench@example.com", "bench-password")
+            auth = "Bearer " + str(RefreshToken.for_user(user).access_token)
+            request = RequestFactory().get("/api/conversations/", headers={"Authorization": auth})
+            legacy = JWTAuthentication()
+
+            def double_decode():
+                # DRF JWTAuthentication (decode + User query), then validate_token decoding again
+                legacy.authenticate(Request(request))
+                AccessToken(request.headers["Authorization"].split(" ")[1])
+
+            def verify_once():
+                get_token_cache()._entries.clear()
+                authenticate_request(request)
+
+            def cached():
+                authenticate_request(request)
+
+            cases = [
+                ("double decode + user query (before)", double_decode),
+                ("single verify, claims user", verify_once),
+                ("cached verify, claims user", cached),
+            ]
+            results = [(name, *self._measure(fn, options["iterations"])) for name, fn in cases]
+            results.append(("full request: GET /api/conversations/", *self._measure_view(auth, options["iterations"] // 10)))
+        finally:
+            runner.teardown_databases(old_config)
+
+        self.stdout.write(f"{'auth path':<40}{'us/request':>12}{'queries':>9}")
+        for name, per_call, queries in results:
+            self.stdout.write(f"{name:<40}{per_call * 1e6:>12.1f}{queries:>9.1f}")
+
+    def _measure(self, fn, iterations):
+        fn()
+        queries = []
+        # Counted with a wrapper: the test client resets connection.queries on every request
+        with connection.execute_wrapper(lambda execute, *args: queries.append(1) or execute(*args)):
+            fn()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        return (time.perf_counter() - started) / iterations, len(queries)
+
+    def _measure_view(self, auth, iterations):
+        client = Client()
+        return self._measure(lambda: client.get("/api/conversations/", headers={"Authorization": auth}), iterations)
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from api.blobs import collect_blobs, store_blob
+from api.models import Blob, FileAttachment
+
+
+# python manage.py dedupe_attachments [--dry-run]
+# Moves attachments saved before blob storage onto content-addressed blobs, removing
+# their per-conversation copies, then deletes blobs no attachment references.
+class Command(BaseCommand):
+    help = "Move legacy attachments to deduplicated blob storage and collect unreferenced blobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would change.")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        legacy = FileAttachment.objects.filter(blob=None).order_by('pk')
+        moved = missing = 0
+        last_pk = 0
+        while True:
+            batch = list(legacy.filter(pk__gt=last_pk)[:options["batch_size"]])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            for attachment in batch:
+                storage = attachment.file.storage
+                old_name = attachment.file.name
+                if not storage.exists(old_name):
+                    missing += 1
+                    continue
+                moved += 1
+                if options["dry_run"]:
+                    continue
+                with storage.open(old_name) as file:
+                    file.name = attachment.file_name
+                    blob = store_blob(file)
+                FileAttachment.objects.filter(pk=attachment.pk).update(blob=blob, file=blob.file.name)
+                # Older rows may share a path when the same name was re-uploaded to one conversation
+                if old_name != blob.file.name and not FileAttachment.objects.filter(file=old_name).exists():
+                    storage.delete(old_name)
+
+        orphans = list(Blob.objects.filter(attachments=None).values_list('pk', flat=True))
+        collected = len(orphans) if options["dry_run"] else collect_blobs(orphans)
+        self.stdout.write(f"moved {moved} attachments to blobs, {missing} with missing files, collected {collected} orphan blobs")
@@ -0,0 +1,36 @@
+import gzip
+import io
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from api.export import CHUNK_SIZE, import_lines
+
+
+# python manage.py import_conversations export.ndjson[.gz] --user alice [--new-ids]
+# Loads a file produced by GET /api/export/ into this database for the given user.
+class Command(BaseCommand):
+    help = "Import an NDJSON conversation export (optionally gzipped) for a user."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--user", required=True, help="Username that will own the conversations.")
+        parser.add_argument("--batch-size", type=int, default=CHUNK_SIZE)
+        parser.add_argument("--new-ids", action="store_true", help="Give conversations fresh conversation_ids.")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["user"])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['user']!r}")
+
+        with open(options["path"], "rb") as raw:
+            gzipped = raw.read(2) == b"\x1f\x8b"
+        opener = gzip.open if gzipped else open
+        with opener(options["path"], "rb") as file:
+            stats = import_lines(
+                io.TextIOWrapper(file, encoding="utf-8"), user,
+                batch_size=options["batch_size"], new_ids=options["new_ids"],
+            )
+        self.stdout.write(
+            f"imported {stats['conversations']} conversations, {stats['messages']} messages, "
+            f"{stats['attachments']} attachments ({stats['missing_blobs']} skipped, file not stored here)"
+        )
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from api.account_deletion import run_deletion
+from api.models import AccountDeletion
+
+
+# python manage.py resume_account_deletions
+# Finishes account deletion jobs interrupted by a restart. Jobs run in an in-process
+# worker pool, so one still pending or running after a deploy has lost its worker.
+class Command(BaseCommand):
+    help = "Run account deletion jobs that were interrupted before finishing."
+
+    def handle(self, *args, **options):
+        pending = AccountDeletion.objects.filter(status__in=[AccountDeletion.PENDING, AccountDeletion.RUNNING])
+        for job_pk in list(pending.values_list('pk', flat=True)):
+            job = run_deletion(job_pk)
+            self.stdout.write(f"{job.job_id}: {job.status}, {job.conversations_deleted} conversations deleted")
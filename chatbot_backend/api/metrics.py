@@ -0,0 +1,297 @@
+import contextvars
+import ipaddress
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+
+
+# Request instrumentation cheap enough to leave on: MetricsMiddleware times every
+# request and collects spans (auth, db, queue, llm, files) recorded by the code that
+# does the work, then reports them in a Server-Timing header and as Prometheus
+# metrics served by metrics_view (/metrics). Values are per process; scrape every
+# worker. Configured through settings.METRICS; without a TOKEN, /metrics only
+# answers requests from the host itself.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'TOKEN': None,
+    'SLOW_REQUEST': 10.0,
+    'SERVER_TIMING': True,
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _option(name):
+    return getattr(settings, 'METRICS', {}).get(name, DEFAULTS[name])
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _value(value):
+    # Every digit: with {:g} a counter past a million advances in steps and rate() reads it flat
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_labels(self.labelnames, key)} {_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        # Read at scrape time instead of being kept up to date
+        self.collect = collect
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.collect is not None:
+            with self._lock:
+                self._values = {(): self.collect()}
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    def _samples(self, key, entry):
+        counts, count, total = entry
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            labels = _labels(self.labelnames + ("le",), key + (f"{bound:g}",))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + ('+Inf',))} {count}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_value(total)}")
+        return lines
+
+
+REGISTRY = []
+
+REQUEST_SECONDS = Histogram("api_request_seconds", "Time to response headers by route and status.", ("route", "method", "status"))
+REQUESTS_IN_FLIGHT = Gauge("api_requests_in_flight", "Requests being handled by this process.")
+SPAN_SECONDS = Histogram("api_span_seconds", "Time spent per request in each span (auth, db, queue, llm, files).", ("span",))
+DB_QUERIES = Counter("api_db_queries_total", "Database queries run while handling requests.")
+LLM_SECONDS = Histogram("api_llm_request_seconds", "Upstream completion latency, streams until the last token.", ("model", "stream", "outcome"))
+LLM_REJECTED = Counter("api_llm_rejected_total", "Upstream calls refused by admission control.")
+LLM_TOKENS = Counter("api_llm_tokens_total", "Tokens reported by the upstream in response.usage.", ("model", "type"))
+
+
+def _admission_gauge(name, documentation, field):
+    def collect():
+        from .admission import get_admission
+        return get_admission().stats()[field]
+    return Gauge(name, documentation, collect=collect)
+
+
+LLM_IN_FLIGHT = _admission_gauge("api_llm_in_flight", "Upstream calls holding an admission slot.", "in_flight")
+LLM_QUEUED = _admission_gauge("api_llm_queued", "Upstream calls waiting for an admission slot.", "queued")
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Spans of the request being handled, shared by the threads and coroutines serving it
+_spans = contextvars.ContextVar('api_spans', default=None)
+
+
+@contextmanager
+def span(name):
+    """Time the block as part of the current request's `name` span. No-op outside a request."""
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans[name] = spans.get(name, 0.0) + time.perf_counter() - started
+
+
+def add_span(name, seconds):
+    spans = _spans.get()
+    if spans is not None:
+        spans[name] = spans.get(name, 0.0) + seconds
+
+
+def record_usage(model, usage):
+    if usage is None:
+        return
+    LLM_TOKENS.inc(getattr(usage, 'prompt_tokens', 0) or 0, model=model, type="prompt")
+    LLM_TOKENS.inc(getattr(usage, 'completion_tokens', 0) or 0, model=model, type="completion")
+
+
+def _timed_execute(execute, sql, params, many, context):
+    spans = _spans.get()
+    if spans is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        spans['db'] = spans.get('db', 0.0) + time.perf_counter() - started
+        spans['db_queries'] = spans.get('db_queries', 0) + 1
+
+
+@receiver(connection_created)
+def _install_query_timer(sender, connection, **kwargs):
+    # Every new connection, in whichever thread a request's queries end up running
+    if _timed_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_timed_execute)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        spans, token, started = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _spans.reset(token)
+            REQUESTS_IN_FLIGHT.dec()
+        return self._finish(request, response, spans, started)
+
+    async def __acall__(self, request):
+        spans, token, started = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _spans.reset(token)
+            REQUESTS_IN_FLIGHT.dec()
+        return self._finish(request, response, spans, started)
+
+    def _start(self):
+        REQUESTS_IN_FLIGHT.inc()
+        spans = {}
+        return spans, _spans.set(spans), time.perf_counter()
+
+    def _finish(self, request, response, spans, started):
+        elapsed = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else "unmatched"
+        REQUEST_SECONDS.observe(elapsed, route=route, method=request.method, status=response.status_code)
+        queries = spans.pop('db_queries', 0)
+        if queries:
+            DB_QUERIES.inc(queries)
+        for name, seconds in spans.items():
+            SPAN_SECONDS.observe(seconds, span=name)
+
+        if _option('SERVER_TIMING'):
+            timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in spans.items()]
+            timings.append(f"total;dur={elapsed * 1000:.1f}")
+            response["Server-Timing"] = ", ".join(timings)
+        if elapsed >= _option('SLOW_REQUEST'):
+            logger.warning(
+                "Slow request %s %s: %.2fs (%s, %d queries)", request.method, request.path, elapsed,
+                ", ".join(f"{name} {seconds:.3f}s" for name, seconds in spans.items()) or "no spans", queries,
+            )
+        return response
+
+
+def _is_local(request):
+    try:
+        return ipaddress.ip_address(request.META.get("REMOTE_ADDR", "")).is_loopback
+    except ValueError:
+        return False
+
+
+def metrics_view(request):
+    # Prometheus text format. With METRICS['TOKEN'] set, scrapers send it as a Bearer token;
+    # without one, only a scraper on this host (or a sidecar sharing its network) gets in
+    token = _option('TOKEN')
+    if token:
+        if request.headers.get("Authorization") != f"Bearer {token}":
+            return HttpResponseForbidden()
+    elif not _is_local(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
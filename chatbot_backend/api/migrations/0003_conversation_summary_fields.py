@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:11
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Substr
+
+
+def backfill_summary_fields(apps, schema_editor):
+    Conversation = apps.get_model('api', 'Conversation')
+    Message = apps.get_model('api', 'Message')
+
+    first_prompt = Message.objects.filter(conversation=OuterRef('pk')).order_by('created_at', 'id').values('user_message')[:1]
+    conversations = Conversation.objects.annotate(
+        counted=Count('messages'),
+        latest=Max('messages__created_at'),
+        first_prompt=Substr(Subquery(first_prompt), 1, 200),
+    ).only('id')
+
+    batch = []
+    for conversation in conversations.iterator(chunk_size=1000):
+        conversation.message_count = conversation.counted
+        conversation.last_message_at = conversation.latest
+        conversation.title = ' '.join((conversation.first_prompt or '').split()[:4])
+        batch.append(conversation)
+        if len(batch) >= 1000:
+            Conversation.objects.bulk_update(batch, ['message_count', 'last_message_at', 'title'])
+            batch = []
+    if batch:
+        Conversation.objects.bulk_update(batch, ['message_count', 'last_message_at', 'title'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_fileattachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='title',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.RunPython(backfill_summary_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_blob_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlobText',
+            fields=[
+                ('blob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='text', serialize=False, to='api.blob')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('unsupported', 'Unsupported'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('chunks', models.JSONField(default=list)),
+                ('char_count', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('extracted_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
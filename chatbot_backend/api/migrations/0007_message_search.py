@@ -0,0 +1,77 @@
+from django.db import migrations
+
+
+# Full-text search over messages, maintained by the database itself so every write
+# path (ORM, bulk_create, raw deletes) keeps it current. The column and the FTS table
+# are not on the Message model; only api.search queries them.
+
+POSTGRES_FORWARD = [
+    # Generated column (PostgreSQL 12+). Adding it rewrites api_message once
+    """
+    ALTER TABLE api_message ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(user_message, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(ai_response, '')), 'B')
+        ) STORED
+    """,
+    "CREATE INDEX api_msg_search_idx ON api_message USING GIN (search_vector)",
+]
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS api_msg_search_idx",
+    "ALTER TABLE api_message DROP COLUMN IF EXISTS search_vector",
+]
+
+# External-content FTS5 table: the text lives only in api_message, triggers keep the index in step
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE api_message_fts USING fts5(
+        user_message, ai_response, content='api_message', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER api_message_fts_insert AFTER INSERT ON api_message BEGIN
+        INSERT INTO api_message_fts(rowid, user_message, ai_response) VALUES (new.id, new.user_message, new.ai_response);
+    END
+    """,
+    """
+    CREATE TRIGGER api_message_fts_delete AFTER DELETE ON api_message BEGIN
+        INSERT INTO api_message_fts(api_message_fts, rowid, user_message, ai_response) VALUES ('delete', old.id, old.user_message, old.ai_response);
+    END
+    """,
+    """
+    CREATE TRIGGER api_message_fts_update AFTER UPDATE OF user_message, ai_response ON api_message BEGIN
+        INSERT INTO api_message_fts(api_message_fts, rowid, user_message, ai_response) VALUES ('delete', old.id, old.user_message, old.ai_response);
+        INSERT INTO api_message_fts(rowid, user_message, ai_response) VALUES (new.id, new.user_message, new.ai_response);
+    END
+    """,
+    # Prompts weigh twice as much as answers; FTS5 then sorts hits by rank itself
+    "INSERT INTO api_message_fts(api_message_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')",
+    "INSERT INTO api_message_fts(api_message_fts) VALUES ('rebuild')",
+]
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS api_message_fts_update",
+    "DROP TRIGGER IF EXISTS api_message_fts_delete",
+    "DROP TRIGGER IF EXISTS api_message_fts_insert",
+    "DROP TABLE IF EXISTS api_message_fts",
+]
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        for statement in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_blob_text'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({'postgresql': POSTGRES_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            _run({'postgresql': POSTGRES_REVERSE, 'sqlite': SQLITE_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_usage_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='model',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Local stand-in for the OpenRouter chat-completions API, used by the
+# benchmarks so they measure our stack instead of the free upstream model.
+# Point the app at it with LLM_BASE_URL=<server.base_url>.
+class MockLLMServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.5, tokens_per_second=50.0,
+                 reply="This is a mock completion from the local benchmark server."):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply = reply
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        # Request body of the latest call, to assert on the prompt that was sent
+        self.last_body = None
+        self._failures = []
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        # Clients that time out hang up mid-response, that is expected here
+        self._httpd.handle_error = lambda request, client_address: None
+        # The default listen backlog (5) drops connections long before we hit real concurrency limits
+        self._httpd.socket.listen(1024)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def fail(self, count=1, status=503, retry_after=None):
+        # Answer the next `count` requests with an error, to exercise retries and the breaker
+        with self._lock:
+            self._failures.extend([(status, retry_after)] * count)
+
+    def _next_failure(self):
+        with self._lock:
+            return self._failures.pop(0) if self._failures else None
+
+    def _enter(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def _leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                server.last_body = body
+                server._enter()
+                try:
+                    failure = server._next_failure()
+                    if failure:
+                        self._error(*failure)
+                    elif body.get("stream"):
+                        self._stream(body)
+                    else:
+                        self._complete(body)
+                finally:
+                    server._leave()
+
+            def _error(self, status, retry_after):
+                payload = json.dumps({"error": {"message": "Mock upstream failure", "code": status}}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if retry_after is not None:
+                    self.send_header("Retry-After", str(retry_after))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _tokens(self):
+                # Split on spaces but keep them so the joined stream equals the full reply
+                words = server.reply.split(" ")
+                return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+            def _usage(self, body):
+                prompt = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+                prompt_tokens = max(1, len(prompt) // 4)
+                completion_tokens = len(self._tokens())
+                return {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }
+
+            def _complete(self, body):
+                time.sleep(server.latency + len(self._tokens()) / server.tokens_per_second)
+                payload = json.dumps({
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": server.reply},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": self._usage(body),
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _stream(self, body):
+                time.sleep(server.latency)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+                for token in self._tokens():
+                    self._event({
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": body.get("model", "mock"),
+                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                    })
+                    time.sleep(1 / server.tokens_per_second)
+                if body.get("stream_options", {}).get("include_usage"):
+                    self._event({
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": body.get("model", "mock"),
+                        "choices": [],
+                        "usage": self._usage(body),
+                    })
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+            def _event(self, data):
+                self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+                self.wfile.flush()
+
+        return Handler
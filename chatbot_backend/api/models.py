@@ -1,5 +1,7 @@
 from django.db import models
+from django.db.models import Case, F, Value, When
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
 import os
 
@@ -7,26 +9,108 @@ def upload_path(instance, filename):
     # Files will be uploaded to MEDIA_ROOT/user_<id>/<conversation_id>/<filename>
     return f'user_{instance.message.conversation.user.id}/{instance.message.conversation.conversation_id}/{filename}'
 
+def blob_path(instance, filename):
+    # Content-addressed: MEDIA_ROOT/blobs/ab/cd/<sha256><ext>, fanned out so no directory grows huge
+    sha = instance.sha256
+    return f'blobs/{sha[:2]}/{sha[2:4]}/{sha}{os.path.splitext(filename)[1].lower()}'
+
+def conversation_title(prompt):
+    # First four words of the opening prompt; only look at its head so huge prompts are not split whole
+    return ' '.join(prompt[:200].split()[:4])
+
 class Conversation(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Indexed through the (user, created_at) composite below
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     conversation_id = models.UUIDField(default=uuid.uuid4, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     last_edited_at = models.DateTimeField(auto_now=True)
+    # Denormalized from the messages so listing conversations never has to touch them
+    title = models.CharField(max_length=255, blank=True, default='')
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    # Archived conversations are hidden from the sidebar listing but keep their messages
+    archived_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Sidebar listings: filter by user, newest first, id as keyset tie-breaker.
+            # Lookups by (conversation_id, user) are already served by the unique conversation_id index
+            models.Index(fields=['user', '-created_at', '-id'], name='api_conv_user_created_idx'),
+        ]
     
     def __str__(self):
         return f"Conversation {self.conversation_id} by {self.user.username}"
 
+    def _message_recorded(self, message):
+        # Done in SQL so concurrent turns cannot lose a count, and the title is only set once
+        return {
+            'message_count': F('message_count') + 1,
+            'last_message_at': message.created_at,
+            'last_edited_at': timezone.now(),
+            'title': Case(When(title='', then=Value(conversation_title(message.user_message))), default=F('title')),
+        }
+
+    def record_message(self, message):
+        Conversation.objects.filter(pk=self.pk).update(**self._message_recorded(message))
+
+    async def arecord_message(self, message):
+        await Conversation.objects.filter(pk=self.pk).aupdate(**self._message_recorded(message))
+
 class Message(models.Model):
-    conversation = models.ForeignKey('Conversation', related_name='messages', on_delete=models.CASCADE)
+    # Indexed through the (conversation, created_at) composite below
+    conversation = models.ForeignKey('Conversation', related_name='messages', on_delete=models.CASCADE, db_index=False)
     user_message = models.TextField()  # Store user prompt
     ai_response = models.TextField()  # Store AI response
     created_at = models.DateTimeField(auto_now_add=True)
+    # Model that wrote the answer (see api.router). Null when it came from the response cache
+    # or an identical call in flight, and for messages older than model routing
+    model = models.CharField(max_length=100, null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            # History reads: one conversation's messages in chronological order
+            models.Index(fields=['conversation', 'created_at', 'id'], name='api_msg_conv_created_idx'),
+        ]
     
     def __str__(self):
         return f"Message in conversation {self.conversation.conversation_id} at {self.created_at}"
 
+class Blob(models.Model):
+    # One stored copy per distinct file content, shared by every attachment with that content.
+    # Referenced by FileAttachment rows and removed once the last of them is gone (see api.blobs)
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=blob_path)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Blob {self.sha256} ({self.size} bytes)"
+
+class BlobText(models.Model):
+    # Text extracted from a document blob by the background pipeline (api.extraction),
+    # split into chunks for the prompt. Kept per blob, so each distinct file is parsed once
+    PENDING = 'pending'
+    DONE = 'done'
+    UNSUPPORTED = 'unsupported'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (DONE, 'Done'), (UNSUPPORTED, 'Unsupported'), (FAILED, 'Failed')]
+
+    blob = models.OneToOneField(Blob, related_name='text', on_delete=models.CASCADE, primary_key=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    chunks = models.JSONField(default=list)
+    char_count = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    extracted_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Text of blob {self.blob_id} ({self.status})"
+
 class FileAttachment(models.Model):
     message = models.ForeignKey(Message, related_name='attachments', on_delete=models.CASCADE)
+    # Attachments saved before blob storage have no blob and keep their own file under upload_path;
+    # newer ones point file at the blob's path so URLs are built the same way for both
+    blob = models.ForeignKey(Blob, related_name='attachments', on_delete=models.PROTECT, null=True, blank=True)
     file = models.FileField(upload_to=upload_path)
     file_name = models.CharField(max_length=255)
     file_type = models.CharField(max_length=50)
@@ -53,4 +137,73 @@ class FileAttachment(models.Model):
         elif ext in ['.mp4', '.mov', '.avi', '.mkv', '.wmv']:
             return 'video'
         else:
-            return 'other'
\ No newline at end of file
+            return 'other'
+
+class AccountDeletion(models.Model):
+    # Background job removing a user and everything they own (see api.account_deletion).
+    # Keeps the user id as a plain column: the job row outlives the user it deletes
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True)
+    user_id = models.IntegerField(db_index=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    conversations_total = models.PositiveIntegerField(default=0)
+    conversations_deleted = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Deletion of user {self.user_id} ({self.status})"
+
+class UsageEvent(models.Model):
+    # Append-only ledger of upstream usage, one row per chat turn, written in batches by
+    # api.usage. Plain id columns: the cost of a turn stays on record after its
+    # conversation or user is deleted
+    user_id = models.IntegerField()
+    conversation_id = models.UUIDField(null=True, blank=True)
+    message_id = models.BigIntegerField(null=True, blank=True)
+    model = models.CharField(max_length=100)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    # Until the last token; null when the turn made no upstream call of its own
+    latency_ms = models.PositiveIntegerField(null=True, blank=True)
+    # Answered from the response cache or by an identical call already in flight
+    cached = models.BooleanField(default=False)
+    # Set when the turn happens, not when its batch is written
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'created_at'], name='api_usage_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.prompt_tokens}+{self.completion_tokens} tokens of {self.model} for user {self.user_id}"
+
+class DailyUsage(models.Model):
+    # Per user and day totals of UsageEvent, kept up to date as each batch is written,
+    # so quota checks and dashboards read one row instead of aggregating the ledger
+    user_id = models.IntegerField()
+    day = models.DateField()
+    turns = models.PositiveIntegerField(default=0)
+    upstream_calls = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+    latency_ms = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'day'], name='api_dailyusage_user_day_uniq'),
+        ]
+
+    def __str__(self):
+        return f"Usage of user {self.user_id} on {self.day}"
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
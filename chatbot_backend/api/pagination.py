@@ -0,0 +1,50 @@
+import base64
+import json
+from django.utils.dateparse import parse_datetime
+
+
+# Opaque keyset cursors: the client gets back whatever values the next page
+# should continue after, encoded so it does not depend on their shape.
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Messages of one conversation, newest first
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+
+def encode_cursor(*values):
+    raw = json.dumps(values, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    # Raises ValueError on anything we did not produce ourselves
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def decode_keyset_cursor(cursor):
+    """The (created_at, id) of a cursor made by encode_cursor(created_at.isoformat(), id)."""
+    values = decode_cursor(cursor)
+    if len(values) != 2 or not isinstance(values[0], str) or type(values[1]) is not int:
+        raise ValueError("Invalid cursor")
+    # Well-formed but impossible dates ("2024-02-30") raise ValueError too
+    created_at = parse_datetime(values[0])
+    if created_at is None:
+        raise ValueError("Invalid cursor")
+    return created_at, values[1]
+
+
+def page_size(request, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    try:
+        size = int(request.GET.get("limit", default))
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    return max(1, min(size, maximum))
@@ -0,0 +1,208 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+# Token-bucket rate limits on the chat endpoints, one bucket per user and one for the
+# whole deployment, which shares a single (free tier) upstream account. A bucket holds
+# up to BURST tokens and refills at RATE tokens per second; each request takes one.
+# The per-process backend keeps buckets in memory, DjangoCacheRateLimiter keeps them
+# in one of settings.CACHES so every worker draws from the same buckets. Configured
+# through settings.CHAT_RATE_LIMIT, like LLM_RESPONSE_CACHE; a RATE of 0 turns a
+# bucket off.
+
+DEFAULTS = {
+    'BACKEND': 'api.ratelimit.LocMemRateLimiter',
+    'USER_RATE': 0.5,
+    'USER_BURST': 10,
+    'GLOBAL_RATE': 5.0,
+    'GLOBAL_BURST': 20,
+}
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Too many requests, please slow down.")
+        self.retry_after = retry_after
+
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+class BaseRateLimiter:
+    # Whether take() may wait on I/O, and so has to stay off the event loop in async views
+    blocking = True
+
+    def __init__(self, **options):
+        self.allowed = 0
+        self.limited = 0
+        self._stats_lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket. Returns 0 if one was available, else seconds until there is."""
+        retry_after = self._take(key, rate, burst)
+        with self._stats_lock:
+            if retry_after:
+                self.limited += 1
+            else:
+                self.allowed += 1
+        return retry_after
+
+    def give_back(self, key, rate, burst):
+        """Return a token taken for a request that was then refused by another bucket."""
+        self._give_back(key, rate, burst)
+
+    def stats(self):
+        return {"backend": type(self).__name__, "allowed": self.allowed, "limited": self.limited}
+
+    def _take(self, key, rate, burst):
+        raise NotImplementedError
+
+    def _give_back(self, key, rate, burst):
+        raise NotImplementedError
+
+
+class LocMemRateLimiter(BaseRateLimiter):
+    # Buckets of this process, the least recently used dropped beyond MAX_KEYS (a dropped
+    # bucket comes back full, which only errs on the generous side)
+    blocking = False
+
+    def __init__(self, max_keys=100_000, **options):
+        super().__init__(**options)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def _give_back(self, key, rate, burst):
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(burst, tokens + 1), updated)
+
+
+class DjangoCacheRateLimiter(BaseRateLimiter):
+    # Buckets shared by every process through settings.CACHES[CACHE_ALIAS]. The read-modify-
+    # write of a bucket is serialized with a short cache.add() lock per key; a request that
+    # cannot get the lock in LOCK_WAIT seconds is limited rather than let through unchecked
+    def __init__(self, cache_alias='default', lock_wait=0.05, **options):
+        super().__init__(**options)
+        self.cache_alias = cache_alias
+        self.lock_wait = lock_wait
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _update(self, key, rate, burst, change):
+        cache = self.cache
+        bucket_key, lock_key = f"ratelimit:{key}", f"ratelimit:lock:{key}"
+        deadline = time.monotonic() + self.lock_wait
+        while not cache.add(lock_key, 1, timeout=1):
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.001)
+        try:
+            # Wall clock: the buckets are shared between machines
+            now = time.time()
+            tokens, updated = cache.get(bucket_key) or (burst, now)
+            tokens, result = change(_refill(tokens, updated, now, rate, burst))
+            # An idle bucket is full again after burst / rate seconds, no need to keep it longer
+            cache.set(bucket_key, (tokens, now), timeout=math.ceil(burst / rate) + 1)
+            return result
+        finally:
+            cache.delete(lock_key)
+
+    def _take(self, key, rate, burst):
+        def take(tokens):
+            if tokens >= 1:
+                return tokens - 1, 0
+            return tokens, (1 - tokens) / rate
+        retry_after = self._update(key, rate, burst, take)
+        # Lock contention: this key is hammered right now
+        return 1.0 if retry_after is None else retry_after
+
+    def _give_back(self, key, rate, burst):
+        self._update(key, rate, burst, lambda tokens: (min(burst, tokens + 1), None))
+
+    def stats(self):
+        stats = super().stats()
+        stats["cache_alias"] = self.cache_alias
+        return stats
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def _option(name):
+    return getattr(settings, 'CHAT_RATE_LIMIT', {}).get(name, DEFAULTS[name])
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                config = {**DEFAULTS, **getattr(settings, 'CHAT_RATE_LIMIT', {})}
+                options = {name.lower(): value for name, value in config.items() if name not in DEFAULTS}
+                _rate_limiter = import_string(config['BACKEND'])(**options)
+    return _rate_limiter
+
+
+def check_chat_rate(user_id):
+    """Take a token from the user's bucket and from the global one. Raises RateLimited if either is empty."""
+    limiter = get_rate_limiter()
+    buckets = [
+        (f"user:{user_id}", _option('USER_RATE'), _option('USER_BURST')),
+        ("global", _option('GLOBAL_RATE'), _option('GLOBAL_BURST')),
+    ]
+    taken = []
+    for key, rate, burst in buckets:
+        if not rate:
+            continue
+        retry_after = limiter.take(key, rate, burst)
+        if retry_after:
+            # Refused as a whole, so the buckets it already drew from get their token back
+            for taken_key, taken_rate, taken_burst in taken:
+                limiter.give_back(taken_key, taken_rate, taken_burst)
+            raise RateLimited(retry_after)
+        taken.append((key, rate, burst))
+
+
+async def acheck_chat_rate(user_id):
+    if get_rate_limiter().blocking:
+        # Cache round trips and the per-bucket lock wait, in a thread
+        await sync_to_async(check_chat_rate)(user_id)
+    else:
+        check_chat_rate(user_id)
+
+
+@receiver(setting_changed)
+def _reset_rate_limiter(setting, **kwargs):
+    global _rate_limiter
+    if setting == 'CHAT_RATE_LIMIT':
+        _rate_limiter = None
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+# Cache of upstream completions keyed on model + normalized message list, so the
+# same FAQ typed by thousands of users only pays for one upstream round trip.
+# Configured through settings.LLM_RESPONSE_CACHE, like Django's own CACHES.
+
+def normalize_messages(messages):
+    # Whitespace and case differences should not defeat the cache
+    return [
+        {"role": m["role"], "content": " ".join(str(m["content"]).split()).casefold()}
+        for m in messages
+    ]
+
+
+def make_key(model, messages):
+    payload = json.dumps([model, normalize_messages(messages)], separators=(",", ":"), ensure_ascii=False)
+    return "llm-response:" + hashlib.sha256(payload.encode()).hexdigest()
+
+
+class BaseResponseCache:
+    def __init__(self, ttl=3600, **options):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if value:
+            self._set(key, value)
+
+    async def aget(self, key):
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key, value):
+        await sync_to_async(self.set)(key, value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+
+class DummyResponseCache(BaseResponseCache):
+    # Never stores anything, used to switch the cache off
+    def _get(self, key):
+        return None
+
+    def _set(self, key, value):
+        pass
+
+
+class LocMemResponseCache(BaseResponseCache):
+    # Per-process LRU bounded both by entry count and by total cached characters
+    def __init__(self, ttl=3600, max_entries=1024, max_bytes=16 * 1024 * 1024, **options):
+        super().__init__(ttl=ttl, **options)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._size += len(value)
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+
+    # Dictionary lookups never block, so skip the thread hop of sync_to_async
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value):
+        self.set(key, value)
+
+    def _pop(self, key):
+        _, value = self._entries.pop(key)
+        self._size -= len(value)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({"entries": len(self._entries), "bytes": self._size})
+        return stats
+
+
+class DjangoResponseCache(BaseResponseCache):
+    # Shared across processes through one of settings.CACHES; eviction is left to that backend
+    def __init__(self, ttl=3600, cache_alias="default", **options):
+        super().__init__(ttl=ttl, **options)
+        self.cache_alias = cache_alias
+
+    def _get(self, key):
+        return caches[self.cache_alias].get(key)
+
+    def _set(self, key, value):
+        caches[self.cache_alias].set(key, value, timeout=self.ttl)
+
+    def stats(self):
+        stats = super().stats()
+        stats["cache_alias"] = self.cache_alias
+        return stats
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _response_cache
+    config = getattr(settings, "LLM_RESPONSE_CACHE", None) or {"BACKEND": "api.response_cache.DummyResponseCache"}
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                options = {name.lower(): value for name, value in config.items() if name != "BACKEND"}
+                _response_cache = import_string(config["BACKEND"])(**options)
+    return _response_cache
+
+
+@receiver(setting_changed)
+def _reset_response_cache(setting, **kwargs):
+    global _response_cache
+    if setting == 'LLM_RESPONSE_CACHE':
+        _response_cache = None
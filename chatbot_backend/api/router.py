@@ -0,0 +1,371 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import openai
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .llm_client import DEFAULTS as CLIENT_DEFAULTS, RETRYABLE_ERRORS, CircuitOpenError, LLMClient
+
+
+# Routes each completion to one of several models: settings.LLM_MODEL, then the
+# settings.LLM_FALLBACK_MODELS, each on its own endpoint if need be. Every model keeps a
+# sliding window of recent response times and failures; requests go to the model with
+# the best latency, weighted by its error rate, ties going to the configured order. A
+# model that times out, answers 429 or has its circuit open is skipped for the next one,
+# and a 429 benches it for Retry-After (or COOLDOWN) seconds. With HEDGE on, a completion
+# still running after the model's p95 is sent to the next model as well and whichever
+# answers first is kept. Streams fail over until their first chunk and are not hedged.
+# Tuned through settings.LLM_ROUTER.
+
+DEFAULTS = {
+    'HEDGE': False,
+    'HEDGE_QUANTILE': 0.95,
+    # Never hedge sooner than this, nor before MIN_SAMPLES answers gave a usable quantile
+    'HEDGE_MIN_DELAY': 1.0,
+    'MIN_SAMPLES': 20,
+    'STATS_WINDOW': 300.0,
+    'MAX_SAMPLES': 200,
+    'ERROR_WEIGHT': 4.0,
+    'COOLDOWN': 10.0,
+    # With another model to go to, retrying the same one first only adds to the wait
+    'RETRIES_BEFORE_FAILOVER': 0,
+}
+
+# Worth trying another model for; anything else (a 400, admission refusing the call) is not
+FAILOVER_ERRORS = RETRYABLE_ERRORS + (CircuitOpenError,)
+
+
+class RouteStats:
+    # Response times (until the last token) and failures of one model over the last
+    # `window` seconds. Old samples expire, so a model that was benched gets traffic
+    # again once its bad run is out of the window
+    def __init__(self, window=300.0, max_samples=200):
+        self.window = window
+        self.samples = deque(maxlen=max_samples)  # (monotonic time, seconds, ok)
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok):
+        with self._lock:
+            self.samples.append((time.monotonic(), seconds, ok))
+
+    def _recent(self):
+        horizon = time.monotonic() - self.window
+        with self._lock:
+            return [(seconds, ok) for at, seconds, ok in self.samples if at >= horizon]
+
+    def latencies(self):
+        return sorted(seconds for seconds, ok in self._recent() if ok)
+
+    def latency(self, quantile):
+        latencies = self.latencies()
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+    def error_rate(self):
+        recent = self._recent()
+        if not recent:
+            return 0.0
+        return sum(1 for _, ok in recent if not ok) / len(recent)
+
+    def cool_down(self, seconds):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    @property
+    def cooling(self):
+        return time.monotonic() < self.cooldown_until
+
+
+class Route:
+    def __init__(self, model, client, window=300.0, max_samples=200):
+        self.model = model
+        self.client = client
+        self.stats = RouteStats(window, max_samples)
+
+    @property
+    def available(self):
+        return not self.stats.cooling and self.client.breaker.state != "open"
+
+    def snapshot(self):
+        return {
+            "model": self.model,
+            "available": self.available,
+            "samples": len(self.stats.latencies()),
+            "p50": self.stats.latency(0.5),
+            "p95": self.stats.latency(0.95),
+            "error_rate": round(self.stats.error_rate(), 3),
+            "breaker": self.client.breaker.state,
+        }
+
+
+# Sync hedges run the second attempt on a thread; the losing call cannot be interrupted
+# and finishes in the background, its slot released when it is done
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='llm-hedge')
+    return _hedge_executor
+
+
+class ModelRouter:
+    def __init__(self, routes, hedge=False, hedge_quantile=0.95, hedge_min_delay=1.0, min_samples=20,
+                 error_weight=4.0, cooldown=10.0, retries_before_failover=0, **options):
+        self.routes = routes
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.min_samples = min_samples
+        self.error_weight = error_weight
+        self.cooldown = cooldown
+        self.retries_before_failover = retries_before_failover
+
+    def ranked(self):
+        """Routes in the order to try them: available ones first, then by weighted latency."""
+        medians = [route.stats.latency(0.5) for route in self.routes]
+        # A model without recent answers looks as fast as the fastest one, so the
+        # configured order decides until it has numbers of its own
+        fastest = min((median for median in medians if median is not None), default=0.0)
+
+        def key(item):
+            route, median = item
+            latency = fastest if median is None else median
+            return (not route.available, latency * (1 + self.error_weight * route.stats.error_rate()))
+
+        return [route for route, _ in sorted(zip(self.routes, medians), key=key)]
+
+    def hedge_delay(self, route):
+        """Seconds to wait on route before hedging, or None when it should not be hedged yet."""
+        latencies = route.stats.latencies()
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.hedge_min_delay, route.stats.latency(self.hedge_quantile))
+
+    def _failed(self, route, error, started):
+        route.stats.record(time.perf_counter() - started, ok=False)
+        if isinstance(error, openai.RateLimitError):
+            route.stats.cool_down(self._retry_after(error))
+
+    def _retry_after(self, error):
+        try:
+            return float(error.response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            return self.cooldown
+
+    def _retries(self, queue):
+        # Called with what is left after taking a route: with a model still to fail over to,
+        # RETRIES_BEFORE_FAILOVER; the last one tried gets its client's full MAX_RETRIES
+        return self.retries_before_failover if queue else None
+
+    def _attempt(self, route, messages, kwargs, max_retries=None):
+        started = time.perf_counter()
+        try:
+            response = route.client.complete(messages, model=route.model, max_retries=max_retries, **kwargs)
+        except FAILOVER_ERRORS as e:
+            self._failed(route, e, started)
+            raise
+        route.stats.record(time.perf_counter() - started, ok=True)
+        return route, response
+
+    async def _aattempt(self, route, messages, kwargs, max_retries=None):
+        started = time.perf_counter()
+        try:
+            response = await route.client.acomplete(messages, model=route.model, max_retries=max_retries, **kwargs)
+        except FAILOVER_ERRORS as e:
+            self._failed(route, e, started)
+            raise
+        route.stats.record(time.perf_counter() - started, ok=True)
+        return route, response
+
+    def _hedged(self, queue, messages, kwargs):
+        # Runs queue[0], adding queue[1] if it is still going after the hedge delay.
+        # Returns the first success, or raises once every attempt started has failed
+        route = queue.pop(0)
+        retries = self._retries(queue)
+        delay = self.hedge_delay(route) if self.hedge and queue else None
+        if delay is None:
+            return self._attempt(route, messages, kwargs, retries)
+        executor = _get_hedge_executor()
+        # The copied context carries the request's metrics spans into the thread
+        pending = {executor.submit(contextvars.copy_context().run, self._attempt, route, messages, kwargs, retries)}
+        done, pending = wait(pending, timeout=delay)
+        if not done:
+            backup = queue.pop(0)
+            pending.add(executor.submit(contextvars.copy_context().run, self._attempt, backup, messages, kwargs,
+                                        self._retries(queue)))
+        error = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+                if not isinstance(error, FAILOVER_ERRORS):
+                    raise error
+            if not pending:
+                raise error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    async def _ahedged(self, queue, messages, kwargs):
+        route = queue.pop(0)
+        retries = self._retries(queue)
+        delay = self.hedge_delay(route) if self.hedge and queue else None
+        if delay is None:
+            return await self._aattempt(route, messages, kwargs, retries)
+        pending = {asyncio.create_task(self._aattempt(route, messages, kwargs, retries))}
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            backup = queue.pop(0)
+            pending.add(asyncio.create_task(self._aattempt(backup, messages, kwargs, self._retries(queue))))
+        error = None
+        try:
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    if not isinstance(error, FAILOVER_ERRORS):
+                        raise error
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # The slower attempt is abandoned, which hands its admission slot back
+            for task in pending:
+                task.cancel()
+
+    def complete(self, messages, turn=None, **kwargs):
+        """Complete on the best available model, failing over down the ranking. Sets turn.model."""
+        queue = self.ranked()
+        while True:
+            try:
+                route, response = self._hedged(queue, messages, kwargs)
+            except FAILOVER_ERRORS:
+                if not queue:
+                    raise
+                continue
+            if turn is not None:
+                turn.model = route.model
+            return response
+
+    async def acomplete(self, messages, turn=None, **kwargs):
+        queue = self.ranked()
+        while True:
+            try:
+                route, response = await self._ahedged(queue, messages, kwargs)
+            except FAILOVER_ERRORS:
+                if not queue:
+                    raise
+                continue
+            if turn is not None:
+                turn.model = route.model
+            return response
+
+    def stream(self, messages, turn=None, **kwargs):
+        queue = self.ranked()
+        while True:
+            route = queue.pop(0)
+            started = time.perf_counter()
+            chunks = route.client.stream(messages, model=route.model, max_retries=self._retries(queue), **kwargs)
+            try:
+                # Opening the stream happens on the first chunk, a failure up to there fails over
+                first = next(chunks, None)
+            except FAILOVER_ERRORS as e:
+                self._failed(route, e, started)
+                if not queue:
+                    raise
+                continue
+            if turn is not None:
+                turn.model = route.model
+            try:
+                if first is not None:
+                    yield first
+                    yield from chunks
+            except FAILOVER_ERRORS as e:
+                self._failed(route, e, started)
+                raise
+            finally:
+                # Releases the admission slot right away when the client stops reading
+                chunks.close()
+            route.stats.record(time.perf_counter() - started, ok=True)
+            return
+
+    async def astream(self, messages, turn=None, **kwargs):
+        queue = self.ranked()
+        while True:
+            route = queue.pop(0)
+            started = time.perf_counter()
+            chunks = route.client.astream(messages, model=route.model, max_retries=self._retries(queue), **kwargs)
+            try:
+                first = await anext(chunks, None)
+            except FAILOVER_ERRORS as e:
+                self._failed(route, e, started)
+                if not queue:
+                    raise
+                continue
+            if turn is not None:
+                turn.model = route.model
+            try:
+                if first is not None:
+                    yield first
+                    async for chunk in chunks:
+                        yield chunk
+            except FAILOVER_ERRORS as e:
+                self._failed(route, e, started)
+                raise
+            finally:
+                await chunks.aclose()
+            route.stats.record(time.perf_counter() - started, ok=True)
+            return
+
+    def stats(self):
+        return [route.snapshot() for route in self.ranked()]
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'LLM_ROUTER', {})}
+
+
+def build_routes(models, options):
+    """Routes for LLM_FALLBACK_MODELS-style entries: MODEL, and optionally BASE_URL, API_KEY and CLIENT overrides."""
+    client_options = {**CLIENT_DEFAULTS, **getattr(settings, 'LLM_CLIENT', {})}
+    routes = []
+    for entry in models:
+        client = LLMClient(
+            entry.get('BASE_URL') or settings.LLM_BASE_URL,
+            entry.get('API_KEY') or settings.LLM_API_KEY,
+            **{**client_options, **entry.get('CLIENT', {})},
+        )
+        routes.append(Route(entry['MODEL'], client, options['STATS_WINDOW'], options['MAX_SAMPLES']))
+    return routes
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                options = _options()
+                models = [{'MODEL': settings.LLM_MODEL}, *getattr(settings, 'LLM_FALLBACK_MODELS', [])]
+                _router = ModelRouter(build_routes(models, options), **{name.lower(): value for name, value in options.items()})
+    return _router
+
+
+@receiver(setting_changed)
+def _reset_router(setting, **kwargs):
+    global _router
+    if setting in ('LLM_MODEL', 'LLM_FALLBACK_MODELS', 'LLM_ROUTER', 'LLM_BASE_URL', 'LLM_API_KEY', 'LLM_CLIENT'):
+        _router = None
@@ -0,0 +1,84 @@
+import html
+import re
+import uuid
+from django.db import connection
+
+
+# Ranked full-text search over a user's messages, on the index kept by migration
+# 0007: a weighted tsvector column with a GIN index on PostgreSQL, an FTS5 table on
+# SQLite. Only the page of hits is highlighted, and only snippets leave the database.
+
+# Highlight markers the database wraps matches in, so the snippet can be HTML-escaped
+# before they become <mark> tags. Control characters do not occur in normal chat text
+START, STOP = "\x02", "\x03"
+
+POSTGRES_SEARCH = """
+    SELECT hit.id, hit.conversation_id, hit.rank,
+           ts_headline('english', m.user_message, hit.query, %s),
+           ts_headline('english', m.ai_response, hit.query, %s)
+    FROM (
+        SELECT m.id, c.conversation_id, ts_rank_cd(m.search_vector, q) AS rank, q AS query
+        FROM api_message m
+        JOIN api_conversation c ON c.id = m.conversation_id,
+             websearch_to_tsquery('english', %s) q
+        WHERE m.search_vector @@ q AND c.user_id = %s
+        ORDER BY rank DESC, m.id DESC
+        LIMIT %s OFFSET %s
+    ) hit
+    JOIN api_message m ON m.id = hit.id
+    ORDER BY hit.rank DESC, hit.id DESC
+"""
+POSTGRES_HEADLINE_OPTIONS = f"StartSel={START}, StopSel={STOP}, MaxWords=30, MinWords=10, MaxFragments=2, FragmentDelimiter=\" … \""
+
+SQLITE_SEARCH = f"""
+    SELECT m.id, c.conversation_id, api_message_fts.rank,
+           snippet(api_message_fts, 0, '{START}', '{STOP}', '…', 16),
+           snippet(api_message_fts, 1, '{START}', '{STOP}', '…', 16)
+    FROM api_message_fts
+    JOIN api_message m ON m.id = api_message_fts.rowid
+    JOIN api_conversation c ON c.id = m.conversation_id
+    WHERE api_message_fts MATCH %s AND c.user_id = %s
+    ORDER BY api_message_fts.rank
+    LIMIT %s OFFSET %s
+"""
+
+
+def _fts5_query(query):
+    # Every word as a quoted term: user input is never parsed as FTS5 syntax
+    terms = re.findall(r"\w+", query)
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _highlight(fragment):
+    return html.escape(fragment or "").replace(START, "<mark>").replace(STOP, "</mark>")
+
+
+def search_messages(user_id, query, limit, offset=0):
+    """Return up to `limit` hits as dicts with message_id, conversation_id and snippet, best first."""
+    if connection.vendor == "postgresql":
+        sql = POSTGRES_SEARCH
+        params = [POSTGRES_HEADLINE_OPTIONS, POSTGRES_HEADLINE_OPTIONS, query, user_id, limit, offset]
+    elif connection.vendor == "sqlite":
+        query = _fts5_query(query)
+        if not query:
+            return []
+        sql = SQLITE_SEARCH
+        params = [query, user_id, limit, offset]
+    else:
+        raise NotImplementedError(f"Search is not available on {connection.vendor}")
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    hits = []
+    for message_id, conversation_id, _, user_snippet, ai_snippet in rows:
+        # Show the side(s) that matched, the prompt when neither headline marks a term
+        snippets = [s for s in (user_snippet, ai_snippet) if s and START in s] or [user_snippet]
+        hits.append({
+            "message_id": message_id,
+            # SQLite hands the UUID back as bare hex
+            "conversation_id": str(uuid.UUID(str(conversation_id))),
+            "snippet": " … ".join(_highlight(s) for s in snippets),
+        })
+    return hits
@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+# Single-flight deduplication of upstream calls: concurrent requests with the same
+# key wait for one in-flight call and share its result. Inside a process followers
+# wait on the leader directly; across processes the leader holds a short lock in
+# settings.LLM_SINGLE_FLIGHT['CACHE_ALIAS'] (use a shared cache such as Redis,
+# Memcached or the database cache for this) and publishes its result there.
+
+DEFAULTS = {
+    'CACHE_ALIAS': 'default',
+    'LOCK_TIMEOUT': 120,
+    'WAIT_TIMEOUT': 90,
+    'POLL_INTERVAL': 0.05,
+    'RESULT_TTL': 30,
+}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _LeaderCancelled(Exception):
+    pass
+
+
+class SingleFlight:
+    def __init__(self, **options):
+        self.options = {**DEFAULTS, **options}
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    @property
+    def cache(self):
+        return caches[self.options['CACHE_ALIAS']]
+
+    def _keys(self, key):
+        return f"singleflight:lock:{key}", f"singleflight:result:{key}"
+
+    def do(self, key, fn):
+        """Run fn() once for all concurrent callers with the same key and return its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            if call.done.wait(self.options['WAIT_TIMEOUT']):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            # The leader is stuck, do not hold this request hostage
+            return fn()
+
+        try:
+            call.result = self._do_shared(key, fn)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _do_shared(self, key, fn):
+        lock_key, result_key = self._keys(key)
+        cache = self.cache
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.options['WAIT_TIMEOUT']
+        waited = False
+        while True:
+            if cache.add(lock_key, token, self.options['LOCK_TIMEOUT']):
+                try:
+                    # The previous holder may have published just before releasing the lock
+                    result = cache.get(result_key) if waited else None
+                    if result is not None:
+                        return result
+                    result = fn()
+                    cache.set(result_key, result, self.options['RESULT_TTL'])
+                    return result
+                finally:
+                    if cache.get(lock_key) == token:
+                        cache.delete(lock_key)
+            # Another process is already calling upstream, wait for what it publishes
+            result = cache.get(result_key)
+            if result is not None:
+                return result
+            if time.monotonic() >= deadline:
+                return fn()
+            waited = True
+            time.sleep(self.options['POLL_INTERVAL'])
+
+    async def ado(self, key, fn):
+        """Async flavour of do(), fn is a coroutine function."""
+        future = self._async_calls.get(key)
+        if future is not None:
+            self.followers += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.options['WAIT_TIMEOUT'])
+            except asyncio.TimeoutError:
+                return await fn()
+            except _LeaderCancelled:
+                # Its client went away; the first follower back takes over as leader
+                return await self.ado(key, fn)
+
+        self.leaders += 1
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._ado_shared(key, fn)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # Followers re-raise it, the leader should not also get "exception never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self._async_calls[key]
+            if not future.done():
+                # Cancelled (client disconnect, timeout): release the followers now, not
+                # after WAIT_TIMEOUT
+                future.set_exception(_LeaderCancelled())
+                future.exception()
+
+    async def _ado_shared(self, key, fn):
+        lock_key, result_key = self._keys(key)
+        cache = self.cache
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.options['WAIT_TIMEOUT']
+        waited = False
+        while True:
+            if await cache.aadd(lock_key, token, self.options['LOCK_TIMEOUT']):
+                try:
+                    result = await cache.aget(result_key) if waited else None
+                    if result is not None:
+                        return result
+                    result = await fn()
+                    await cache.aset(result_key, result, self.options['RESULT_TTL'])
+                    return result
+                finally:
+                    if await cache.aget(lock_key) == token:
+                        await cache.adelete(lock_key)
+            result = await cache.aget(result_key)
+            if result is not None:
+                return result
+            if time.monotonic() >= deadline:
+                return await fn()
+            waited = True
+            await asyncio.sleep(self.options['POLL_INTERVAL'])
+
+    def stats(self):
+        return {"leaders": self.leaders, "followers": self.followers}
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight(**getattr(settings, 'LLM_SINGLE_FLIGHT', {}))
+    return _single_flight
+
+
+@receiver(setting_changed)
+def _reset_single_flight(setting, **kwargs):
+    global _single_flight
+    if setting == 'LLM_SINGLE_FLIGHT':
+        _single_flight = None
@@ -0,0 +1,66 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.dispatch import receiver
+
+
+# In-process background worker pool for work that must not hold up a response
+# (attachment text extraction). Tasks are handed over once the surrounding
+# transaction commits, so workers always see the rows they were queued for.
+# Tuned through settings.BACKGROUND_TASKS; EAGER runs tasks inline, for tests.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'WORKERS': 2,
+    'EAGER': False,
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _option(name):
+    return getattr(settings, 'BACKGROUND_TASKS', {}).get(name, DEFAULTS[name])
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=_option('WORKERS'), thread_name_prefix='api-task')
+    return _executor
+
+
+def _run(fn, args, kwargs):
+    # Worker threads keep their own connections, drop the ones past CONN_MAX_AGE or broken
+    close_old_connections()
+    try:
+        fn(*args, **kwargs)
+    except Exception:
+        logger.exception("Background task %s failed", getattr(fn, '__name__', fn))
+    finally:
+        close_old_connections()
+
+
+def submit(fn, *args, **kwargs):
+    if _option('EAGER'):
+        fn(*args, **kwargs)
+        return
+    _get_executor().submit(_run, fn, args, kwargs)
+
+
+def submit_on_commit(fn, *args, **kwargs):
+    transaction.on_commit(lambda: submit(fn, *args, **kwargs))
+
+
+@receiver(setting_changed)
+def _reset_executor(setting, **kwargs):
+    global _executor
+    if setting == 'BACKGROUND_TASKS' and _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
@@ -1,3 +1,1611 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import zipfile
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import AsyncClient, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from .admission import AdmissionController, OverloadedError, get_admission
+from .llm_client import CircuitOpenError, LLMClient
+from .management.commands.bench import percentile, seed_database
+from .mock_llm import MockLLMServer
+from .pagination import encode_cursor
+from .account_deletion import request_deletion
+from .authentication import VerifiedTokenCache, get_token_cache, revoke_user, unrevoke_user
+from .blobs import collect_blobs
+from .context import build_context
+from .export import export_lines, import_lines
+from .extraction import chunk_text
+from .metrics import REGISTRY, Counter
+from .models import Blob, BlobText, Conversation, DailyUsage, FileAttachment, Message, UsageEvent, conversation_title
+from .ratelimit import DjangoCacheRateLimiter, LocMemRateLimiter, RateLimited, acheck_chat_rate, check_chat_rate, get_rate_limiter
+from .response_cache import LocMemResponseCache, get_response_cache, make_key
+from .retrieval import RetrievalIndex, invalidate_user
+from .router import ModelRouter, Route, get_router
+from .singleflight import SingleFlight
+from .uploads import HashingUploadHandler
+from .usage import Turn, get_usage_recorder
 
-# Create your tests here.
+
+def seed(user, conversations=30, messages=5):
+    convos = Conversation.objects.bulk_create([Conversation(user=user, title=f"Conversation {i}") for i in range(conversations)])
+    Message.objects.bulk_create([
+        Message(conversation=convo, user_message=f"question {j}", ai_response=f"answer {j}")
+        for convo in convos for j in range(messages)
+    ])
+    return convos
+
+
+#every query the hot views run against our tables must be answered from an index,
+#so their cost stays flat as api_conversation / api_message grow
+class QueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("planner", "planner@example.com", "password")
+        other = User.objects.create_user("other", "other@example.com", "password")
+        cls.conversations = seed(cls.user)
+        seed(other)
+
+    def setUp(self):
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # Tiny test tables are cheaper to scan, so only ask whether an index can serve the query
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("EXPLAIN " + sql)
+            else:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return "\n".join(str(row[-1]) for row in cursor.fetchall())
+
+    def assert_index_scans(self, queries):
+        checked = 0
+        for query in queries:
+            sql = query["sql"]
+            if not re.match(r"\s*(SELECT|UPDATE|DELETE)", sql, re.I) or "api_" not in sql:
+                continue
+            plan = self.explain(sql)
+            checked += 1
+            if connection.vendor == "postgresql":
+                self.assertNotRegex(plan, r"Seq Scan on api_", f"Sequential scan for:\n{sql}\n{plan}")
+            else:
+                # FTS5 lookups show up as "SCAN api_message_fts VIRTUAL TABLE INDEX ..."
+                self.assertNotRegex(plan, r"(^|\n)SCAN api_\w+(?! VIRTUAL TABLE INDEX)( |\n|$)", f"Full table scan for:\n{sql}\n{plan}")
+                self.assertNotIn("TEMP B-TREE", plan, f"Sort not served by an index for:\n{sql}\n{plan}")
+        self.assertGreater(checked, 0)
+
+    def test_chat_uses_indexes(self):
+        conversation = self.conversations[0]
+        with MockLLMServer(latency=0, tokens_per_second=10000) as upstream, override_settings(LLM_BASE_URL=upstream.base_url, LLM_API_KEY="test"):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post("/api/chat/", {
+                    "prompt_message": "query plan check",
+                    "conversation_id": str(conversation.conversation_id),
+                }, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assert_index_scans(queries)
+
+    def test_history_uses_indexes(self):
+        conversation = self.conversations[1]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/api/chat_history/{conversation.conversation_id}/", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assert_index_scans(queries)
+
+    def test_history_page_uses_indexes(self):
+        conversation = self.conversations[1]
+        url = f"/api/chat_history/{conversation.conversation_id}/"
+        older = self.client.get(url, {"limit": 2}, headers=self.headers).json()["older_cursor"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"limit": 2, "before": older}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assert_index_scans(queries)
+
+    def test_conversation_list_uses_indexes(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/conversations/?limit=5", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assert_index_scans(queries)
+
+    def test_search_uses_indexes(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/search/?q=answer", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assert_index_scans(queries)
+
+    def test_usage_uses_indexes(self):
+        today = timezone.localdate()
+        DailyUsage.objects.bulk_create([
+            DailyUsage(user_id=user_id, day=today - timedelta(days=n), turns=1, prompt_tokens=10)
+            for user_id in (self.user.id, self.user.id + 1) for n in range(40)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/usage/?days=7", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["days"]), 7)
+        self.assert_index_scans(queries)
+
+    def test_delete_uses_indexes(self):
+        conversation = self.conversations[2]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(f"/api/conversation_delete/{conversation.conversation_id}/", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assert_index_scans(queries)
+
+
+#every view must run the same number of queries whatever the amount of data behind it
+#(no query per conversation, message or attachment), and at most its QUERY_BUDGETS
+#entry. Raise a budget deliberately, in the commit that needs the extra query
+class QueryBudgetTests(TestCase):
+    QUERY_BUDGETS = {
+        "login": 1,
+        "refresh": 1,
+        "profile": 1,
+        "chat": 8,
+        "chat_stream": 9,
+        "chat_history": 3,
+        "history2": 2,
+        "conversations": 1,
+        "search": 1,
+        "usage": 2,
+        "export": 3,
+        "bulk_export": 4,
+        "bulk_archive": 2,
+        "conversation_delete": 9,
+        "delete_profile": 6,
+        "account_deletion": 1,
+    }
+    # (conversations, messages per conversation); every message has an attachment
+    SIZES = ((2, 2), (12, 8))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seeded = []
+        for n, (conversations, messages) in enumerate(cls.SIZES):
+            user = User.objects.create_user(f"budget{n}", f"budget{n}@example.com", "password")
+            convos = seed(user, conversations=conversations, messages=messages)
+            rows = list(Message.objects.filter(conversation__user=user))
+            blobs = Blob.objects.bulk_create([
+                Blob(sha256=hashlib.sha256(f"{n}-{row.pk}".encode()).hexdigest(), file=f"blobs/{n}-{row.pk}.txt", size=1)
+                for row in rows
+            ])
+            FileAttachment.objects.bulk_create([
+                FileAttachment(message=row, blob=blob, file=blob.file.name, file_name="notes.txt", file_type="text/plain")
+                for row, blob in zip(rows, blobs)
+            ])
+            cls.seeded.append((user, convos))
+
+    def setUp(self):
+        upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(upstream.stop)
+        # Every run starts cold: no cached context or retrieval index left by earlier tests,
+        # and no usage flush landing in the middle of a counted request
+        cache.clear()
+        settings = override_settings(
+            LLM_BASE_URL=upstream.base_url, LLM_API_KEY="test",
+            LLM_RESPONSE_CACHE={"BACKEND": "api.response_cache.DummyResponseCache"},
+            LLM_RETRIEVAL={"ENABLED": True},
+            # Cold retrieval indexes are built inline, and counted
+            BACKGROUND_TASKS={"EAGER": True},
+            CHAT_RATE_LIMIT={"USER_RATE": 0, "GLOBAL_RATE": 0},
+            USAGE_LEDGER={"FLUSH_INTERVAL": float("inf")},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def requests(self, user, conversations):
+        refresh = RefreshToken.for_user(user)
+        headers = {"Authorization": f"Bearer {refresh.access_token}"}
+        first, last = (str(convo.conversation_id) for convo in (conversations[0], conversations[-1]))
+        every = [str(convo.conversation_id) for convo in conversations]
+        job = {}
+
+        def delete_profile():
+            response = self.client.delete("/api/delete_profile/", headers=headers)
+            job["id"] = response.json()["job_id"]
+            return response
+
+        # Destructive ones last
+        return {
+            "login": lambda: self.client.post("/api/login/", json.dumps({"username": user.username, "password": "password"}), content_type="application/json"),
+            "refresh": lambda: self.client.post("/api/refresh/", json.dumps({"refresh_token": str(refresh)}), content_type="application/json", headers=headers),
+            "profile": lambda: self.client.get("/api/profile/", headers=headers),
+            "chat": lambda: self.client.post("/api/chat/", {"prompt_message": "budget check", "conversation_id": first}, headers=headers),
+            "chat_stream": lambda: self.client.post("/api/chat/", {"prompt_message": "budget stream", "conversation_id": first, "stream": "1"}, headers=headers),
+            "chat_history": lambda: self.client.get(f"/api/chat_history/{first}/", headers=headers),
+            "history2": lambda: self.client.post("/api/history2/", headers=headers),
+            "conversations": lambda: self.client.get("/api/conversations/", headers=headers),
+            "search": lambda: self.client.get("/api/search/?q=answer", headers=headers),
+            "usage": lambda: self.client.get("/api/usage/", headers=headers),
+            "export": lambda: self.client.get("/api/export/", headers=headers),
+            "bulk_export": lambda: self.client.post("/api/conversations/bulk/", json.dumps({"action": "export", "conversation_ids": every}), content_type="application/json", headers=headers),
+            "bulk_archive": lambda: self.client.post("/api/conversations/bulk/", json.dumps({"action": "archive", "conversation_ids": every}), content_type="application/json", headers=headers),
+            "conversation_delete": lambda: self.client.delete(f"/api/conversation_delete/{last}/", headers=headers),
+            "delete_profile": delete_profile,
+            "account_deletion": lambda: self.client.get(f"/api/account_deletion/{job['id']}/", headers=headers),
+        }
+
+    def count_queries(self, request):
+        with CaptureQueriesContext(connection) as queries:
+            response = request()
+            body = b"".join(response.streaming_content) if response.streaming else response.content
+        self.assertLess(response.status_code, 300, body[:200])
+        return len(queries)
+
+    def test_query_counts_are_flat_and_within_budget(self):
+        counts = {}
+        for user, conversations in self.seeded:
+            requests = self.requests(user, conversations)
+            self.assertEqual(list(requests), list(self.QUERY_BUDGETS))
+            for name, request in requests.items():
+                counts.setdefault(name, []).append(self.count_queries(request))
+        for name, budget in self.QUERY_BUDGETS.items():
+            with self.subTest(view=name):
+                self.assertEqual(len(set(counts[name])), 1, f"{name} runs more queries with more data: {counts[name]}")
+                self.assertLessEqual(max(counts[name]), budget, f"{name} is over its query budget")
+
+
+class LLMClientTests(SimpleTestCase):
+    def setUp(self):
+        self.upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(self.upstream.stop)
+
+    def make_client(self, **options):
+        options = {"BACKOFF_BASE": 0.01, "BACKOFF_MAX": 0.05, **options}
+        return LLMClient(self.upstream.base_url, "test", **options)
+
+    def test_retries_transient_errors(self):
+        self.upstream.fail(2, status=503)
+        response = self.make_client(MAX_RETRIES=2).complete([{"role": "user", "content": "hi"}])
+        self.assertEqual(response.choices[0].message.content, self.upstream.reply)
+        self.assertEqual(self.upstream.requests, 3)
+
+    def test_gives_up_after_retry_budget(self):
+        self.upstream.fail(5, status=500)
+        with self.assertRaises(Exception):
+            self.make_client(MAX_RETRIES=1).complete([{"role": "user", "content": "hi"}])
+        self.assertEqual(self.upstream.requests, 2)
+
+    def test_breaker_fails_fast_then_recovers(self):
+        client = self.make_client(MAX_RETRIES=0, BREAKER_FAILURE_THRESHOLD=2, BREAKER_RESET_TIMEOUT=0.2)
+        self.upstream.fail(2, status=502)
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                client.complete([{"role": "user", "content": "hi"}])
+        with self.assertRaises(CircuitOpenError):
+            client.complete([{"role": "user", "content": "hi"}])
+        self.assertEqual(self.upstream.requests, 2)
+
+        time.sleep(0.25)
+        client.complete([{"role": "user", "content": "hi"}])
+        self.assertEqual(client.breaker.state, "closed")
+
+    def test_read_timeout(self):
+        self.upstream.latency = 1
+        with self.assertRaises(Exception):
+            self.make_client(READ_TIMEOUT=0.1, MAX_RETRIES=0).complete([{"role": "user", "content": "hi"}])
+
+
+class RouterTests(SimpleTestCase):
+    def setUp(self):
+        self.primary = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.fallback = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(self.primary.stop)
+        self.addCleanup(self.fallback.stop)
+
+    def make_router(self, client=None, **options):
+        client = {"MAX_RETRIES": 0, "BACKOFF_BASE": 0.01, "BACKOFF_MAX": 0.05, **(client or {})}
+        routes = [
+            Route("primary", LLMClient(self.primary.base_url, "test", **client)),
+            Route("fallback", LLMClient(self.fallback.base_url, "test", **client)),
+        ]
+        return ModelRouter(routes, **options)
+
+    def test_fails_over_on_rate_limit_and_benches_the_model(self):
+        router = self.make_router(cooldown=0.2)
+        self.primary.fail(1, status=429, retry_after=0.2)
+        turn = Turn()
+        response = router.complete([{"role": "user", "content": "hi"}], turn=turn)
+        self.assertEqual(response.model, "fallback")
+        self.assertEqual(turn.model, "fallback")
+        self.assertEqual((self.primary.requests, self.fallback.requests), (1, 1))
+
+        # Benched for Retry-After: the next turn goes straight to the fallback
+        router.complete([{"role": "user", "content": "hi"}])
+        self.assertEqual((self.primary.requests, self.fallback.requests), (1, 2))
+        self.assertEqual([route["model"] for route in router.stats()], ["fallback", "primary"])
+
+        time.sleep(0.25)
+        self.assertTrue(router.routes[0].available)
+
+    def test_fails_over_on_timeout(self):
+        self.primary.latency = 1
+        router = self.make_router(client={"READ_TIMEOUT": 0.1})
+        turn = Turn()
+        router.complete([{"role": "user", "content": "hi"}], turn=turn)
+        self.assertEqual(turn.model, "fallback")
+        self.assertEqual(router.routes[0].stats.error_rate(), 1.0)
+
+    def test_only_the_last_model_tried_retries(self):
+        router = self.make_router(client={"MAX_RETRIES": 2}, retries_before_failover=0)
+        primary, fallback = router.routes
+        # Ranked ahead of the configured first choice, it still fails over without retrying
+        for _ in range(3):
+            primary.stats.record(0.5, ok=True)
+            fallback.stats.record(0.1, ok=True)
+        self.fallback.fail(1, status=503)
+        self.primary.fail(2, status=503)
+        turn = Turn()
+        router.complete([{"role": "user", "content": "hi"}], turn=turn)
+        self.assertEqual(turn.model, "primary")
+        self.assertEqual((self.fallback.requests, self.primary.requests), (1, 3))
+
+    def test_client_errors_do_not_fail_over(self):
+        self.primary.fail(1, status=400)
+        with self.assertRaises(Exception):
+            self.make_router().complete([{"role": "user", "content": "hi"}])
+        self.assertEqual(self.fallback.requests, 0)
+
+    def test_every_model_failing_raises(self):
+        self.primary.fail(1, status=503)
+        self.fallback.fail(1, status=503)
+        with self.assertRaises(Exception):
+            self.make_router().complete([{"role": "user", "content": "hi"}])
+        self.assertEqual((self.primary.requests, self.fallback.requests), (1, 1))
+
+    def test_ranks_by_latency_weighted_by_errors(self):
+        router = self.make_router(error_weight=4)
+        primary, fallback = router.routes
+        self.assertEqual(router.ranked(), [primary, fallback])
+        for _ in range(5):
+            primary.stats.record(0.5, ok=True)
+            fallback.stats.record(0.3, ok=True)
+        self.assertEqual(router.ranked(), [fallback, primary])
+        # 2 failures in 7 make its 0.3s weigh as 0.64s
+        fallback.stats.record(1.0, ok=False)
+        fallback.stats.record(1.0, ok=False)
+        self.assertEqual(router.ranked(), [primary, fallback])
+
+    def test_hedges_a_slow_completion(self):
+        router = self.make_router(hedge=True, min_samples=1, hedge_min_delay=0.05)
+        router.routes[0].stats.record(0.01, ok=True)
+        self.primary.latency = 2
+        turn = Turn()
+        started = time.perf_counter()
+        router.complete([{"role": "user", "content": "hi"}], turn=turn)
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(turn.model, "fallback")
+        self.assertEqual((self.primary.requests, self.fallback.requests), (1, 1))
+
+    def test_no_hedge_without_enough_samples(self):
+        router = self.make_router(hedge=True, min_samples=5, hedge_min_delay=0.01)
+        self.primary.latency = 0.1
+        turn = Turn()
+        router.complete([{"role": "user", "content": "hi"}], turn=turn)
+        self.assertEqual(turn.model, "primary")
+        self.assertEqual(self.fallback.requests, 0)
+
+    def test_async_hedge(self):
+        router = self.make_router(hedge=True, min_samples=1, hedge_min_delay=0.05)
+        router.routes[0].stats.record(0.01, ok=True)
+        self.primary.latency = 2
+        turn = Turn()
+
+        async def complete():
+            return await router.acomplete([{"role": "user", "content": "hi"}], turn=turn)
+
+        started = time.perf_counter()
+        response = asyncio.run(complete())
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual((response.model, turn.model), ("fallback", "fallback"))
+
+    def test_stream_fails_over_before_the_first_chunk(self):
+        self.primary.fail(1, status=503)
+        router = self.make_router()
+        turn = Turn()
+        chunks = list(router.stream([{"role": "user", "content": "hi"}], turn=turn))
+        self.assertEqual("".join(chunk.choices[0].delta.content or "" for chunk in chunks if chunk.choices), self.fallback.reply)
+        self.assertEqual(turn.model, "fallback")
+
+        async def consume():
+            self.primary.fail(1, status=429)
+            return [chunk async for chunk in router.astream([{"role": "user", "content": "hi"}], turn=turn)]
+
+        turn.model = None
+        self.assertTrue(asyncio.run(consume()))
+        self.assertEqual(turn.model, "fallback")
+
+
+class ResponseCacheTests(TestCase):
+    def test_entries_expire_after_ttl(self):
+        responses = LocMemResponseCache(ttl=0.05)
+        responses.set("key", "answer")
+        self.assertEqual(responses.get("key"), "answer")
+        time.sleep(0.06)
+        self.assertIsNone(responses.get("key"))
+        self.assertEqual(responses.stats()["entries"], 0)
+
+    def test_evicts_least_recently_used_by_count_and_size(self):
+        responses = LocMemResponseCache(max_entries=2, max_bytes=10)
+        responses.set("a", "1111")
+        responses.set("b", "2222")
+        responses.get("a")
+        responses.set("c", "3333")
+        self.assertIsNone(responses.get("b"))
+        self.assertEqual((responses.get("a"), responses.get("c")), ("1111", "3333"))
+
+        # Over max_bytes drops the oldest until it fits
+        responses.set("d", "44444444")
+        self.assertEqual(responses.stats()["entries"], 1)
+        self.assertLessEqual(responses.stats()["bytes"], 10)
+        self.assertEqual(responses.get("d"), "44444444")
+
+    def test_counts_hits_and_misses(self):
+        responses = LocMemResponseCache()
+        responses.get("missing")
+        responses.set("present", "answer")
+        responses.get("present")
+        responses.get("present")
+        # Empty answers are never stored
+        responses.set("empty", "")
+        responses.get("empty")
+        stats = responses.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (2, 2, 0.5))
+
+    def test_key_ignores_case_and_whitespace_but_not_model_or_role(self):
+        key = make_key("model", [{"role": "user", "content": "What is  Django?"}])
+        self.assertEqual(key, make_key("model", [{"role": "user", "content": " what is\ndjango? "}]))
+        self.assertNotEqual(key, make_key("other", [{"role": "user", "content": "What is Django?"}]))
+        self.assertNotEqual(key, make_key("model", [{"role": "system", "content": "What is Django?"}]))
+
+    def test_hit_skips_the_upstream_but_stores_the_message(self):
+        user = User.objects.create_user("asker", "asker@example.com", "password")
+        headers = {"Authorization": f"Bearer {RefreshToken.for_user(user).access_token}"}
+        upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(upstream.stop)
+        with override_settings(LLM_BASE_URL=upstream.base_url, LLM_API_KEY="test",
+                               LLM_RESPONSE_CACHE={"BACKEND": "api.response_cache.LocMemResponseCache"},
+                               LLM_RETRIEVAL={"ENABLED": False},
+                               CHAT_RATE_LIMIT={"USER_RATE": 0, "GLOBAL_RATE": 0}):
+            prompt = f"cached question {uuid.uuid4()}"
+            for text in (prompt, prompt.upper()):
+                response = self.client.post("/api/chat/", {"prompt_message": text}, headers=headers)
+                self.assertEqual(response.json()["ai_response"], upstream.reply)
+            self.assertEqual(get_response_cache().stats()["hits"], 1)
+        self.assertEqual(upstream.requests, 1)
+        self.assertEqual(Message.objects.filter(conversation__user=user, ai_response=upstream.reply).count(), 2)
+
+
+@override_settings(LLM_CONTEXT={"MAX_MESSAGES": 3, "TOKEN_BUDGET": 1000})
+class ContextTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user("historian", "historian@example.com", "password")
+        self.conversation = Conversation.objects.create(user=user)
+
+    def add(self, *texts):
+        return [Message.objects.create(conversation=self.conversation, user_message=f"q {text}", ai_response=f"a {text}")
+                for text in texts]
+
+    def questions(self, context):
+        return [m["content"] for m in context if m["role"] == "user"]
+
+    def test_keeps_the_newest_turns_within_max_messages(self):
+        self.add("1", "2", "3", "4", "5")
+        context = build_context(self.conversation)
+        self.assertEqual(self.questions(context), ["q 3", "q 4", "q 5"])
+        self.assertEqual(context[:2], [{"role": "user", "content": "q 3"}, {"role": "assistant", "content": "a 3"}])
+
+    def test_trims_the_oldest_turns_to_the_token_budget(self):
+        # 2 * (40 // 4 + 1) = 22 estimated tokens per turn
+        self.add(*(f"{n}" * 38 for n in "123"))
+        with override_settings(LLM_CONTEXT={"MAX_MESSAGES": 3, "TOKEN_BUDGET": 50}):
+            context = build_context(self.conversation)
+        self.assertEqual(self.questions(context), [f"q {n * 38}" for n in "23"])
+
+    def test_warm_build_only_reads_new_rows(self):
+        old = self.add("1", "2")
+        build_context(self.conversation)
+        # Not re-read, so this edit stays invisible to the cached prefix
+        Message.objects.filter(pk=old[0].pk).update(user_message="q edited")
+        self.add("3")
+        with CaptureQueriesContext(connection) as queries:
+            context = build_context(self.conversation)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"api_message"."created_at" >', queries[0]["sql"])
+        self.assertEqual(self.questions(context), ["q 1", "q 2", "q 3"])
+
+    def test_rebuilds_cold_once_max_messages_new_rows_arrived(self):
+        self.add("1")
+        build_context(self.conversation)
+        self.add("2", "3", "4")
+        with CaptureQueriesContext(connection) as queries:
+            context = build_context(self.conversation)
+        # The warm read came back full, the cold read starts over from the newest rows
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(self.questions(context), ["q 2", "q 3", "q 4"])
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flights, key="same-prompt"):
+        calls = []
+
+        def upstream():
+            calls.append(1)
+            time.sleep(0.2)
+            return "shared answer"
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda i: flights[i % len(flights)].do(key, upstream), range(8)))
+        return results, calls
+
+    def test_coalesces_within_a_process(self):
+        results, calls = self.run_concurrently([SingleFlight()])
+        self.assertEqual(results, ["shared answer"] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_coalesces_across_instances_through_the_cache(self):
+        # Two SingleFlight instances stand in for two worker processes sharing a cache
+        results, calls = self.run_concurrently([SingleFlight(), SingleFlight()], key="cross-process")
+        self.assertEqual(results, ["shared answer"] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_leader_error_reaches_followers(self):
+        flight = SingleFlight()
+
+        def failing():
+            time.sleep(0.1)
+            raise RuntimeError("upstream down")
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            futures = [pool.submit(flight.do, "failing", failing) for _ in range(3)]
+        for future in futures:
+            self.assertRaises(RuntimeError, future.result)
+
+    def test_followers_take_over_from_a_cancelled_leader(self):
+        flight = SingleFlight(WAIT_TIMEOUT=30)
+        calls = []
+
+        async def upstream():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return "shared answer"
+
+        async def main():
+            leader = asyncio.create_task(flight.ado("cancelled", upstream))
+            await asyncio.sleep(0.05)
+            followers = [asyncio.create_task(flight.ado("cancelled", upstream)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            # Its client disconnects
+            leader.cancel()
+            started = time.monotonic()
+            results = await asyncio.gather(*followers)
+            return results, time.monotonic() - started, leader.cancelled()
+
+        results, elapsed, cancelled = asyncio.run(main())
+        self.assertTrue(cancelled)
+        self.assertEqual(results, ["shared answer"] * 3)
+        self.assertLess(elapsed, 5)
+        # One of the followers called upstream again for the others
+        self.assertEqual(len(calls), 2)
+
+
+class RateLimitTests(SimpleTestCase):
+    def hammer(self, limiter, key, rate, burst, attempts=200):
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            return list(pool.map(lambda i: limiter.take(key, rate, burst), range(attempts)))
+
+    def test_buckets_hand_out_exactly_their_burst_under_concurrency(self):
+        results = self.hammer(LocMemRateLimiter(), "local", rate=0.001, burst=25)
+        self.assertEqual(results.count(0), 25)
+        # About a thousand seconds until the next token at this rate
+        self.assertGreater(max(results), 900)
+
+    def test_shared_buckets_span_processes(self):
+        # Two DjangoCacheRateLimiter instances stand in for two worker processes
+        first, second = DjangoCacheRateLimiter(lock_wait=5), DjangoCacheRateLimiter(lock_wait=5)
+        self.assertEqual(self.hammer(first, "shared", rate=0.001, burst=25).count(0), 25)
+        self.assertEqual(self.hammer(second, "shared", rate=0.001, burst=25).count(0), 0)
+
+    def test_bucket_refills_at_its_rate(self):
+        limiter = LocMemRateLimiter()
+        self.assertEqual([limiter.take("refill", 20, 2) for _ in range(3)][:2], [0, 0])
+        time.sleep(0.06)
+        self.assertEqual(limiter.take("refill", 20, 2), 0)
+
+    @override_settings(CHAT_RATE_LIMIT={"USER_RATE": 0.001, "USER_BURST": 3, "GLOBAL_RATE": 0.001, "GLOBAL_BURST": 4})
+    def test_refusal_by_one_bucket_costs_nothing_in_the_others(self):
+        for user_id in (1, 1, 1):
+            check_chat_rate(user_id)
+        self.assertRaises(RateLimited, check_chat_rate, 1)
+        check_chat_rate(2)
+        # The global bucket is now empty; user 3 keeps its tokens for later
+        self.assertRaises(RateLimited, check_chat_rate, 3)
+        limiter = get_rate_limiter()
+        self.assertEqual(limiter.take("user:3", 0.001, 3), 0)
+        self.assertEqual(limiter.take("user:3", 0.001, 3), 0)
+
+
+    def test_async_check_leaves_the_event_loop_for_shared_buckets(self):
+        threads = []
+
+        async def check():
+            with mock.patch("api.ratelimit.check_chat_rate", side_effect=lambda user_id: threads.append(threading.get_ident())):
+                await acheck_chat_rate(1)
+            return threading.get_ident()
+
+        with override_settings(CHAT_RATE_LIMIT={"BACKEND": "api.ratelimit.DjangoCacheRateLimiter"}):
+            loop_thread = asyncio.run(check())
+        self.assertNotEqual(threads, [loop_thread])
+        with override_settings(CHAT_RATE_LIMIT={"BACKEND": "api.ratelimit.LocMemRateLimiter"}):
+            loop_thread = asyncio.run(check())
+        self.assertEqual(threads[1:], [loop_thread])
+
+
+class AdmissionTests(SimpleTestCase):
+    def run_calls(self, admission, calls, duration):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def call(i):
+            try:
+                with admission.admit():
+                    with lock:
+                        running.append(i)
+                        peak.append(len(running))
+                    time.sleep(duration)
+                    with lock:
+                        running.remove(i)
+                return "ok"
+            except OverloadedError as e:
+                return e.retry_after
+
+        with ThreadPoolExecutor(max_workers=calls) as pool:
+            return list(pool.map(call, range(calls))), max(peak)
+
+    def test_bounds_in_flight_calls_and_refuses_beyond_the_queue(self):
+        admission = AdmissionController(max_in_flight=3, max_queue=5, queue_timeout=10, retry_after=7)
+        results, peak = self.run_calls(admission, calls=20, duration=0.1)
+        self.assertEqual(peak, 3)
+        self.assertEqual(results.count("ok"), 8)
+        self.assertEqual(results.count(7), 12)
+        self.assertEqual(admission.stats(), {"in_flight": 0, "queued": 0, "admitted": 8, "rejected": 12})
+
+    def test_queued_calls_give_up_after_the_timeout(self):
+        admission = AdmissionController(max_in_flight=1, max_queue=10, queue_timeout=0.05)
+        started = time.monotonic()
+        results, _ = self.run_calls(admission, calls=4, duration=0.5)
+        self.assertEqual(results.count("ok"), 1)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_threads_and_coroutines_share_slots(self):
+        admission = AdmissionController(max_in_flight=2, max_queue=2, queue_timeout=5)
+
+        async def coroutines():
+            async def call():
+                async with admission.aadmit():
+                    await asyncio.sleep(0.05)
+
+            return await asyncio.gather(*[call() for _ in range(6)], return_exceptions=True)
+
+        # A thread holds a slot while the coroutines compete for the other one
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            held = pool.submit(self.run_calls, admission, 1, 0.2)
+            time.sleep(0.02)
+            results = asyncio.run(coroutines())
+            held.result()
+        self.assertEqual(sum(isinstance(result, OverloadedError) for result in results), 3)
+        self.assertEqual(admission.stats()["in_flight"], 0)
+
+
+class ChatAdmissionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("flooder", "flooder@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(upstream.stop)
+        settings = override_settings(
+            LLM_BASE_URL=upstream.base_url, LLM_API_KEY="test",
+            LLM_RESPONSE_CACHE={"BACKEND": "api.response_cache.DummyResponseCache"},
+            CHAT_RATE_LIMIT={"USER_RATE": 0.01, "USER_BURST": 2},
+            LLM_ADMISSION={"MAX_IN_FLIGHT": 1, "MAX_QUEUE": 0, "RETRY_AFTER": 3},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def chat(self, prompt, **extra):
+        return self.client.post("/api/chat/", {"prompt_message": prompt, **extra}, headers=self.headers)
+
+    def test_users_over_their_rate_get_429(self):
+        self.assertEqual(self.chat("one").status_code, 200)
+        self.assertEqual(self.chat("two").status_code, 200)
+        response = self.chat("three")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "100")
+
+    def test_saturated_upstream_gets_503(self):
+        # Another request holds the only slot and nobody may queue
+        admission = get_admission()
+        admission.acquire()
+        self.addCleanup(admission.release)
+        for extra in ({}, {"stream": "1"}):
+            response = self.chat("busy?", **extra)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response["Retry-After"], "3")
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("watched", "watched@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        upstream = MockLLMServer(latency=0.05, tokens_per_second=10000).start()
+        self.addCleanup(upstream.stop)
+        settings = override_settings(
+            LLM_BASE_URL=upstream.base_url, LLM_API_KEY="test", LLM_MODEL="metrics-model",
+            LLM_RESPONSE_CACHE={"BACKEND": "api.response_cache.DummyResponseCache"},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_server_timing_breaks_down_the_request(self):
+        response = self.client.post("/api/chat/", {"prompt_message": "where does the time go?"}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        timings = dict(entry.split(";dur=") for entry in response["Server-Timing"].split(", "))
+        self.assertEqual({"auth", "db", "queue", "llm", "total"} - set(timings), set())
+        self.assertGreaterEqual(float(timings["llm"]), 50)
+        self.assertLess(float(timings["llm"]), float(timings["total"]))
+
+    def sample(self, series):
+        # Process-wide values, other tests add to them too
+        match = re.search(r"^" + re.escape(series) + r" (\S+)$", self.client.get("/metrics").content.decode(), re.M)
+        return float(match.group(1)) if match else 0.0
+
+    def test_metrics_endpoint(self):
+        series = [
+            'api_llm_tokens_total{model="metrics-model",type="completion"}',
+            'api_llm_request_seconds_count{model="metrics-model",stream="true",outcome="ok"}',
+            'api_request_seconds_bucket{route="api/chat/",method="POST",status="200",le="+Inf"}',
+        ]
+        before = [self.sample(name) for name in series]
+        self.client.post("/api/chat/", {"prompt_message": "count my tokens", "stream": "1"}, headers=self.headers).getvalue()
+        self.client.post("/api/chat/", {"prompt_message": "and these"}, headers=self.headers)
+        tokens, streams, requests = [self.sample(name) - start for name, start in zip(series, before)]
+        self.assertGreater(tokens, 0)
+        self.assertEqual((streams, requests), (1, 2))
+        self.assertEqual(self.sample("api_llm_in_flight"), 0)
+        with override_settings(METRICS={"TOKEN": "scraper-secret"}):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer scraper-secret"}).status_code, 200)
+
+    def test_large_values_keep_every_digit(self):
+        counter = Counter("api_test_large_total", "Large counter")
+        self.addCleanup(REGISTRY.remove, counter)
+        counter.inc(1234567)
+        counter.inc(0.5)
+        self.assertIn("api_test_large_total 1234567.5\n", self.client.get("/metrics").content.decode())
+
+    def test_metrics_without_a_token_are_local_only(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="::1").status_code, 200)
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.5").status_code, 403)
+
+
+class UsageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("spender", "spender@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.upstream = upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(upstream.stop)
+        settings = override_settings(
+            LLM_BASE_URL=upstream.base_url, LLM_API_KEY="test",
+            # Snippets of earlier turns would change the prompt, and miss the response cache
+            LLM_RETRIEVAL={"ENABLED": False},
+            CHAT_RATE_LIMIT={"USER_RATE": 0, "GLOBAL_RATE": 0},
+            USAGE_LEDGER={"BATCH_SIZE": 3, "FLUSH_INTERVAL": 3600, "DAILY_TOKEN_QUOTA": None},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def chat(self, prompt, **extra):
+        response = self.client.post("/api/chat/", {"prompt_message": prompt, **extra}, headers=self.headers)
+        if response.streaming:
+            response.getvalue()
+        return response
+
+    def test_turns_are_written_in_batches(self):
+        prompt = f"ledger {uuid.uuid4()}"
+        self.assertEqual(self.chat(prompt).status_code, 200)
+        self.assertEqual(self.chat("and a stream", stream="1").status_code, 200)
+        self.assertFalse(UsageEvent.objects.filter(user_id=self.user.id).exists())
+
+        # Third turn fills the batch; the same prompt again comes from the response cache
+        self.assertEqual(self.chat(prompt).status_code, 200)
+        events = list(UsageEvent.objects.filter(user_id=self.user.id).order_by('created_at', 'id'))
+        self.assertEqual([event.cached for event in events], [False, False, True])
+        self.assertTrue(all(event.prompt_tokens and event.completion_tokens for event in events[:2]))
+        self.assertEqual((events[2].prompt_tokens, events[2].latency_ms), (0, None))
+        self.assertEqual(events[0].message_id, Message.objects.filter(user_message=prompt).first().id)
+
+        daily = DailyUsage.objects.get(user_id=self.user.id, day=timezone.localdate())
+        self.assertEqual((daily.turns, daily.upstream_calls), (3, 2))
+        self.assertEqual(daily.prompt_tokens, sum(event.prompt_tokens for event in events))
+        self.assertEqual(daily.completion_tokens, sum(event.completion_tokens for event in events))
+
+        # Counters are incremented, not overwritten, by later batches
+        for n in range(3):
+            self.assertEqual(self.chat(f"more {n}").status_code, 200)
+        daily.refresh_from_db()
+        self.assertEqual((daily.turns, daily.upstream_calls), (6, 5))
+
+    def test_records_the_model_that_answered(self):
+        fallback = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(fallback.stop)
+        with override_settings(LLM_MODEL="primary", LLM_FALLBACK_MODELS=[{"MODEL": "fallback", "BASE_URL": fallback.base_url}]):
+            self.upstream.fail(1, status=429)
+            self.assertEqual(self.chat(f"who answers {uuid.uuid4()}").status_code, 200)
+            # Benched after its 429, streams go to the fallback too
+            self.assertFalse(get_router().routes[0].available)
+            self.assertEqual(self.chat(f"and now {uuid.uuid4()}", stream="1").status_code, 200)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('model', flat=True)), ["fallback", "fallback"])
+        get_usage_recorder().flush()
+        self.assertEqual(list(UsageEvent.objects.order_by('id').values_list('model', flat=True)), ["fallback", "fallback"])
+
+    def test_daily_quota(self):
+        with override_settings(USAGE_LEDGER={"DAILY_TOKEN_QUOTA": 1}):
+            self.assertEqual(self.chat("spend it all").status_code, 200)
+            # Not written yet, the quota still counts what this process has buffered
+            self.assertEqual(get_usage_recorder().stats()["written"], 0)
+            response = self.chat("one more?")
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response["Retry-After"]), 0)
+
+            get_usage_recorder().flush()
+            usage = self.client.get("/api/usage/", headers=self.headers).json()
+            self.assertEqual(usage["today"]["turns"], 1)
+            self.assertEqual(usage["today"]["quota"], 1)
+            self.assertEqual(usage["days"][0]["day"], timezone.localdate().isoformat())
+            self.assertGreater(usage["days"][0]["total_tokens"], 0)
+
+
+def sse_events(body):
+    # (event, data) pairs of a Server-Sent Events body
+    events = []
+    for block in body.decode().strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+class StreamingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("streamer", "streamer@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(self.upstream.stop)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(
+            MEDIA_ROOT=media.name,
+            LLM_BASE_URL=self.upstream.base_url,
+            LLM_API_KEY="test",
+            LLM_CLIENT={"MAX_RETRIES": 0},
+            LLM_RESPONSE_CACHE={"BACKEND": "api.response_cache.DummyResponseCache"},
+            LLM_RETRIEVAL={"ENABLED": False},
+            CHAT_RATE_LIMIT={"USER_RATE": 0, "GLOBAL_RATE": 0},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def data(self):
+        return {"prompt_message": "stream it", "stream": "1", "files": [SimpleUploadedFile("notes.txt", b"some notes")]}
+
+    def assertStreamed(self, events):
+        names = [name for name, _ in events]
+        self.assertEqual((names[0], names[-1]), ("start", "done"))
+        self.assertEqual(set(names[1:-1]), {"token"})
+        self.assertEqual("".join(data["token"] for name, data in events if name == "token"), self.upstream.reply)
+
+        start, done = events[0][1], events[-1][1]
+        self.assertEqual(done["conversation_id"], start["conversation_id"])
+        self.assertEqual(done["ai_response"], self.upstream.reply)
+        self.assertEqual([f["file_name"] for f in done["files"]], ["notes.txt"])
+        message = Message.objects.get(conversation__conversation_id=start["conversation_id"])
+        self.assertEqual((message.user_message, message.ai_response), ("stream it", self.upstream.reply))
+        self.assertEqual(list(message.attachments.values_list("file_name", flat=True)), ["notes.txt"])
+
+    def test_streams_tokens_and_stores_the_turn(self):
+        response = self.client.post("/api/chat/", self.data(), headers=self.headers)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertStreamed(sse_events(b"".join(response.streaming_content)))
+
+    def test_upstream_failure_ends_with_an_error_event(self):
+        self.upstream.fail(1, status=503)
+        response = self.client.post("/api/chat/", self.data(), headers=self.headers)
+        events = sse_events(b"".join(response.streaming_content))
+        self.assertEqual([name for name, _ in events], ["start", "error"])
+        self.assertFalse(Message.objects.exists())
+
+    async def test_async_view_streams_tokens_and_stores_the_turn(self):
+        response = await self.async_client.post("/api/chat_async/", self.data(), headers=self.headers)
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        events = sse_events(body)
+        await sync_to_async(self.assertStreamed)(events)
+
+    async def test_async_upstream_failure_ends_with_an_error_event(self):
+        self.upstream.fail(1, status=503)
+        response = await self.async_client.post("/api/chat_async/", self.data(), headers=self.headers)
+        events = sse_events(b"".join([chunk async for chunk in response.streaming_content]))
+        self.assertEqual([name for name, _ in events], ["start", "error"])
+        self.assertFalse(await Message.objects.aexists())
+
+
+class UploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("uploader", "uploader@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(self.upstream.stop)
+
+    def post(self, *files):
+        with override_settings(LLM_BASE_URL=self.upstream.base_url, LLM_API_KEY="test", FILE_UPLOAD_MAX_SIZE=1024, FILE_UPLOAD_MAX_FILES=2):
+            return self.client.post("/api/chat/", {"prompt_message": "see attached", "files": list(files)}, headers=self.headers)
+
+    def test_rejected_before_calling_the_llm(self):
+        for files in (
+            [SimpleUploadedFile("tool.exe", b"MZ")],
+            [SimpleUploadedFile("big.txt", b"x" * 2048)],
+            [SimpleUploadedFile(f"{i}.txt", b"x") for i in range(3)],
+        ):
+            response = self.post(*files)
+            self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(self.upstream.requests, 0)
+        self.assertFalse(Conversation.objects.exists())
+
+    def test_streamed_files_are_hashed(self):
+        handler = HashingUploadHandler()
+        handler.new_file("files", "notes.txt", "text/plain", None)
+        for start, chunk in enumerate([b"hello ", b"world"]):
+            handler.receive_data_chunk(chunk, start)
+        file = handler.file_complete(11)
+        self.assertEqual(file.sha256, hashlib.sha256(b"hello world").hexdigest())
+        file.close()
+
+
+@override_settings(BACKGROUND_TASKS={"EAGER": True})
+class BlobStorageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("sharer", "sharer@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(upstream.stop)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(LLM_BASE_URL=upstream.base_url, LLM_API_KEY="test", MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def send(self, name, content):
+        response = self.client.post("/api/chat/", {
+            "prompt_message": "see attached", "files": [SimpleUploadedFile(name, content)],
+        }, headers=self.headers)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()["conversation_id"]
+
+    def test_duplicate_uploads_share_one_blob(self):
+        first = self.send("report.pdf", b"%PDF same bytes")
+        second = self.send("copy of report.pdf", b"%PDF same bytes")
+        self.assertEqual(FileAttachment.objects.count(), 2)
+        blob = Blob.objects.get()
+        self.assertEqual(set(FileAttachment.objects.values_list("file", flat=True)), {blob.file.name})
+        self.assertTrue(default_storage.exists(blob.file.name))
+
+        # The blob outlives the first conversation and goes with the last reference
+        self.client.delete(f"/api/conversation_delete/{first}/", headers=self.headers)
+        self.assertTrue(Blob.objects.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/conversation_delete/{second}/", headers=self.headers)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(default_storage.exists(blob.file.name))
+
+    def test_upload_racing_the_collection_of_its_blob_keeps_its_file(self):
+        self.send("notes.txt", b"back again")
+        old = Blob.objects.get()
+        # The last reference goes, the file is deleted once the collecting transaction commits
+        FileAttachment.objects.all().delete()
+        with self.captureOnCommitCallbacks() as pending:
+            collect_blobs([old.pk])
+        self.assertFalse(Blob.objects.exists())
+
+        self.send("notes.txt", b"back again")
+        for callback in pending:
+            callback()
+        blob = Blob.objects.get()
+        self.assertTrue(default_storage.exists(blob.file.name))
+        with default_storage.open(blob.file.name) as f:
+            self.assertEqual(f.read(), b"back again")
+        self.assertEqual(default_storage.exists(old.file.name), blob.file.name == old.file.name)
+
+    def test_deleting_the_profile_collects_its_blobs(self):
+        self.send("notes.txt", b"only mine")
+        blob = Blob.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete("/api/delete_profile/", headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(default_storage.exists(blob.file.name))
+
+
+@override_settings(BACKGROUND_TASKS={"EAGER": True}, ACCOUNT_DELETION={"BATCH_SIZE": 4})
+class AccountDeletionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("leaver", "leaver@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_deletes_in_batches_and_reports_progress(self):
+        convos = seed(self.user, conversations=10, messages=2)
+        # An attachment saved before blob storage, in the user's own upload directory
+        message = convos[0].messages.first()
+        legacy = FileAttachment(message=message, file_name="old.txt", file_type="text/plain")
+        legacy.file.save("old.txt", SimpleUploadedFile("old.txt", b"legacy"))
+        directory = os.path.dirname(default_storage.path(legacy.file.name))
+        bystander = seed(User.objects.create_user("stayer", "stayer@example.com", "password"), conversations=1)[0]
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete("/api/delete_profile/", headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        # Ten conversations in batches of four
+        self.assertEqual(sum(query["sql"].startswith('DELETE FROM "api_conversation"') for query in queries.captured_queries), 3)
+
+        status = self.client.get(f"/api/account_deletion/{response.json()['job_id']}/", headers=self.headers).json()
+        self.assertEqual(status["status"], "done")
+        self.assertEqual((status["conversations_total"], status["conversations_deleted"]), (10, 10))
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(Message.objects.filter(conversation=bystander).count(), 5)
+
+    def test_account_is_locked_until_the_job_runs(self):
+        response = self.client.delete("/api/delete_profile/", headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(User.objects.get(pk=self.user.pk).is_active)
+        job_id = response.json()["job_id"]
+        self.assertEqual(request_deletion(self.user.pk).job_id, uuid.UUID(job_id))
+        # Tokens issued before the lock only get to follow the job
+        self.assertEqual(self.client.delete("/api/delete_profile/", headers=self.headers).status_code, 401)
+        self.assertEqual(self.client.post("/api/chat/", {"prompt_message": "still here?"}, headers=self.headers).status_code, 401)
+        self.assertEqual(self.client.get(f"/api/account_deletion/{job_id}/", headers=self.headers).status_code, 200)
+        other = User.objects.create_user("snoop", "snoop@example.com", "password")
+        headers = {"Authorization": f"Bearer {RefreshToken.for_user(other).access_token}"}
+        self.assertEqual(self.client.get(f"/api/account_deletion/{job_id}/", headers=headers).status_code, 404)
+
+
+def docx(*paragraphs):
+    body = "".join(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>" for text in paragraphs)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("word/document.xml", (
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{body}</w:body></w:document>"
+        ))
+    return buffer.getvalue()
+
+
+@override_settings(BACKGROUND_TASKS={"EAGER": True})
+class ExtractionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("reader", "reader@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.upstream = MockLLMServer(latency=0, tokens_per_second=10000).start()
+        self.addCleanup(self.upstream.stop)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(
+            LLM_BASE_URL=self.upstream.base_url, LLM_API_KEY="test", MEDIA_ROOT=media.name,
+            LLM_RESPONSE_CACHE={"BACKEND": "api.response_cache.DummyResponseCache"},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def send(self, prompt, conversation_id=None, files=()):
+        data = {"prompt_message": prompt, "files": list(files)}
+        if conversation_id:
+            data["conversation_id"] = conversation_id
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/chat/", data, headers=self.headers)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()["conversation_id"]
+
+    def test_documents_are_parsed_once_and_sent_on_later_turns(self):
+        contract = docx("Termination requires ninety days notice.", "Renewal is automatic.")
+        conversation_id = self.send("summarize", files=[SimpleUploadedFile("contract.docx", contract)])
+        text = BlobText.objects.get()
+        self.assertEqual(text.status, BlobText.DONE)
+        self.assertIn("ninety days notice", text.chunks[0])
+
+        self.send("and the renewal?", conversation_id)
+        prompt = self.upstream.last_body["messages"][0]
+        self.assertEqual(prompt["role"], "system")
+        self.assertIn("[File: contract.docx]", prompt["content"])
+        self.assertIn("Renewal is automatic.", prompt["content"])
+
+        # The same content uploaded again is not parsed a second time
+        self.send("again", files=[SimpleUploadedFile("contract copy.docx", contract)])
+        self.assertEqual(BlobText.objects.count(), 1)
+        self.assertIn("[File: contract copy.docx]", self.upstream.last_body["messages"][0]["content"])
+
+    def test_unsupported_documents_are_marked(self):
+        self.send("legacy format", files=[SimpleUploadedFile("old.doc", b"\xd0\xcf\x11\xe0")])
+        self.assertEqual(BlobText.objects.get().status, BlobText.UNSUPPORTED)
+
+    def test_chunks_overlap_on_word_boundaries(self):
+        words = " ".join(f"word{i}" for i in range(2000))
+        with override_settings(LLM_ATTACHMENTS={"CHUNK_SIZE": 500, "CHUNK_OVERLAP": 50}):
+            chunks = chunk_text(words)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 500)
+            self.assertRegex(chunk, r"^word\d+ .* word\d+$")
+        self.assertIn(chunks[0].split()[-1], chunks[1].split())
+
+
+@override_settings(BACKGROUND_TASKS={"EAGER": True})
+class RetrievalTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("recaller", "recaller@example.com", "password")
+        self.other = User.objects.create_user("stranger", "stranger@example.com", "password")
+        self.index = RetrievalIndex()
+        self.trip, self.recipes = Conversation.objects.bulk_create([
+            Conversation(user=self.user, title="Trip"), Conversation(user=self.user, title="Recipes"),
+        ])
+        Message.objects.bulk_create([
+            Message(conversation=self.trip, user_message="Which train goes from Lyon to Turin?", ai_response="Take the TGV to Chambery, then the regional train to Turin."),
+            Message(conversation=self.trip, user_message="Hotels near Turin station?", ai_response="Several hotels are within walking distance of Porta Nuova."),
+            Message(conversation=self.recipes, user_message="How long do I bake sourdough?", ai_response="Bake sourdough about 45 minutes at 230C."),
+        ])
+        stranger = Conversation.objects.create(user=self.other)
+        Message.objects.create(conversation=stranger, user_message="sourdough starter", ai_response="feed it daily")
+
+    def test_ranks_the_users_own_messages(self):
+        hits = self.index.search(self.user.id, "sourdough bake time")
+        self.assertEqual([hit["message_id"] for hit in hits], [Message.objects.get(user_message__startswith="How long").id])
+        hits = self.index.search(self.user.id, "train to Turin")
+        self.assertEqual(hits[0]["conversation_id"], str(self.trip.conversation_id))
+        self.assertIn("Chambery", hits[0]["text"])
+
+    def test_excludes_the_current_conversation(self):
+        self.assertEqual(self.index.search(self.user.id, "Turin", exclude_conversation=self.trip.pk), [])
+
+    def test_picks_up_new_messages_and_forgets_deleted_ones(self):
+        self.assertEqual(self.index.search(self.user.id, "focaccia"), [])
+        message = Message.objects.create(conversation=self.recipes, user_message="And focaccia?", ai_response="Focaccia needs 20 minutes.")
+        self.recipes.record_message(message)
+        self.assertEqual(len(self.index.search(self.user.id, "focaccia")), 1)
+
+        self.trip.delete()
+        self.assertEqual(self.index.search(self.user.id, "Turin hotels"), [])
+
+    def test_picks_up_rows_committed_after_a_later_one(self):
+        self.assertEqual(self.index.search(self.user.id, "focaccia"), [])
+        late = Message.objects.create(conversation=self.recipes, user_message="And focaccia?", ai_response="Focaccia needs 20 minutes.")
+        later = Message.objects.create(conversation=self.recipes, user_message="And brioche?", ai_response="Brioche needs 25 minutes.")
+        self.recipes.record_message(later)
+        # The later turn is indexed while the transaction holding the first one is still open
+        with mock.patch.object(Message.objects, "filter") as rows:
+            rows.side_effect = lambda *args, **kwargs: Message.objects.all().exclude(pk=late.pk).filter(*args, **kwargs)
+            self.assertEqual(len(self.index.search(self.user.id, "brioche")), 1)
+        self.assertEqual([hit["message_id"] for hit in self.index.search(self.user.id, "focaccia")], [late.pk])
+        # Read again inside the margin, but indexed once
+        self.assertEqual(len(self.index.search(self.user.id, "brioche")), 1)
+        self.assertEqual(len(self.index.for_user(self.user.id)), 5)
+
+    def test_invalidated_index_is_rebuilt(self):
+        self.assertEqual(self.index.search(self.user.id, "Lisbon"), [])
+        old = timezone.now() - timedelta(days=400)
+        imported = Conversation.objects.create(user=self.user, title="Imported", last_message_at=old)
+        message = Message.objects.create(conversation=imported, user_message="Trams in Lisbon?", ai_response="Take tram 28.")
+        Message.objects.filter(pk=message.pk).update(created_at=old)
+        self.assertEqual(self.index.search(self.user.id, "Lisbon"), [])
+        invalidate_user(self.user.id)
+        self.assertEqual([hit["message_id"] for hit in self.index.search(self.user.id, "Lisbon")], [message.pk])
+
+    def test_cold_index_is_built_in_the_background(self):
+        with mock.patch("api.retrieval.submit") as submit:
+            self.assertEqual(self.index.search(self.user.id, "sourdough"), [])
+            self.assertEqual(self.index.search(self.user.id, "sourdough"), [])
+        index = self.index.for_user(self.user.id)
+        submit.assert_called_once_with(index.build)
+        index.build()
+        self.assertFalse(index.building)
+        self.assertEqual(len(self.index.search(self.user.id, "sourdough")), 1)
+
+    def test_indexes_extracted_attachment_text(self):
+        message = Message.objects.create(conversation=self.trip, user_message="my itinerary", ai_response="noted")
+        self.trip.record_message(message)
+        blob = Blob.objects.create(sha256="a" * 64, file="blobs/aa/aa/itinerary.txt", size=10)
+        FileAttachment.objects.create(message=message, blob=blob, file=blob.file.name, file_name="itinerary.txt", file_type="text/plain")
+        text = BlobText.objects.create(blob=blob)
+        self.assertEqual(self.index.search(self.user.id, "ferry Sardinia"), [])
+
+        # Extraction finished after the attachment was first seen
+        text.status, text.chunks = BlobText.DONE, ["Day 3: overnight ferry from Genoa to Sardinia."]
+        text.save()
+        hits = self.index.search(self.user.id, "ferry Sardinia")
+        self.assertEqual(hits[0]["file_name"], "itinerary.txt")
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("searcher", "searcher@example.com", "password")
+        other = User.objects.create_user("neighbour", "neighbour@example.com", "password")
+        cls.conversation = Conversation.objects.create(user=cls.user)
+        Message.objects.bulk_create([
+            Message(conversation=cls.conversation, user_message="How do I renew my passport?", ai_response="Fill in the renewal form <b>online</b>."),
+            Message(conversation=cls.conversation, user_message="Passport photo size?", ai_response="35 by 45 millimetres."),
+            Message(conversation=cls.conversation, user_message="Best pizza in Naples", ai_response="Try a margherita."),
+        ] + [
+            Message(conversation=cls.conversation, user_message=f"passport question {i}", ai_response="answer") for i in range(5)
+        ])
+        Message.objects.create(conversation=Conversation.objects.create(user=other), user_message="my passport", ai_response="theirs")
+
+    def setUp(self):
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def search(self, query, **params):
+        return self.client.get("/api/search/", {"q": query, **params}, headers=self.headers)
+
+    def test_ranked_highlighted_hits(self):
+        response = self.search("renew passport")
+        self.assertEqual(response.status_code, 200)
+        hit = response.json()["results"][0]
+        self.assertEqual(set(hit), {"message_id", "conversation_id", "snippet"})
+        self.assertEqual(hit["conversation_id"], str(self.conversation.conversation_id))
+        self.assertIn("<mark>passport</mark>", hit["snippet"])
+        # Message text is escaped, only the highlight markup is HTML
+        self.assertIn("&lt;b&gt;online&lt;/b&gt;", hit["snippet"])
+
+    def test_paginates_only_the_users_messages(self):
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+            page = self.search("passport", **params).json()
+            seen += [hit["message_id"] for hit in page["results"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+
+    def test_search_syntax_is_not_interpreted(self):
+        response = self.search('passport" OR pizza* NEAR(')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.search("").status_code, 400)
+
+    def test_index_follows_updates_and_deletes(self):
+        Message.objects.filter(user_message__startswith="Best pizza").update(user_message="Best calzone in Naples")
+        self.assertEqual(self.search("pizza").json()["results"], [])
+        self.assertEqual(len(self.search("calzone").json()["results"]), 1)
+        Message.objects.filter(user_message__startswith="Best calzone").delete()
+        self.assertEqual(self.search("calzone").json()["results"], [])
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("scroller", "scroller@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.conversation = seed(self.user, conversations=1, messages=7)[0]
+        self.url = f"/api/chat_history/{self.conversation.conversation_id}/"
+
+    def history(self, **params):
+        return self.client.get(self.url, params, headers=self.headers)
+
+    def test_scrolls_back_from_the_newest_messages(self):
+        page = self.history(limit=3).json()
+        self.assertEqual([m["user_message"] for m in page["messages"]], ["question 4", "question 5", "question 6"])
+        seen = page["messages"]
+        while page["older_cursor"]:
+            page = self.history(limit=3, before=page["older_cursor"]).json()
+            seen = page["messages"] + seen
+        self.assertEqual([m["user_message"] for m in seen], [f"question {i}" for i in range(7)])
+
+        # Polling forward from the newest message picks up only what was added
+        newest = self.history(limit=3).json()["newer_cursor"]
+        self.assertEqual(self.history(after=newest).json()["messages"], [])
+        new = Message.objects.create(conversation=self.conversation, user_message="question 7", ai_response="answer 7")
+        self.conversation.record_message(new)
+        self.assertEqual([m["id"] for m in self.history(after=newest).json()["messages"]], [new.id])
+
+    def test_unchanged_conversations_revalidate_with_304(self):
+        first = self.history()
+        self.assertEqual(first.status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(self.url, headers={**self.headers, "If-None-Match": first["ETag"]})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self.client.get(self.url, headers={**self.headers, "If-Modified-Since": first["Last-Modified"]}).status_code, 304)
+        # Another page of the same conversation is a different representation
+        self.assertNotEqual(self.history(limit=2)["ETag"], first["ETag"])
+
+        time.sleep(0.01)
+        self.conversation.record_message(Message.objects.create(conversation=self.conversation, user_message="more", ai_response="ok"))
+        fresh = self.client.get(self.url, headers={**self.headers, "If-None-Match": first["ETag"]})
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual(fresh.json()["messages"][-1]["user_message"], "more")
+
+    def test_rejects_bad_cursors(self):
+        self.assertEqual(self.history(before="garbage").status_code, 400)
+        for cursor in (encode_cursor(["2024-01-01T00:00:00+00:00"], 1), encode_cursor({"at": 1}, None),
+                       encode_cursor(20240101, 1), encode_cursor("2024-01-01T00:00:00+00:00", [1])):
+            self.assertEqual(self.history(before=cursor).status_code, 400, cursor)
+            self.assertEqual(self.history(after=cursor).status_code, 400, cursor)
+        self.assertEqual(self.client.get("/api/chat_history/not-a-uuid/", headers=self.headers).status_code, 400)
+
+
+class BulkTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("tidier", "tidier@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.conversations = seed(self.user, conversations=4, messages=3)
+        self.ids = [str(convo.conversation_id) for convo in self.conversations]
+
+    def bulk(self, action, ids):
+        return self.client.post("/api/conversations/bulk/", {"action": action, "conversation_ids": ids},
+                                content_type="application/json", headers=self.headers)
+
+    def listed(self, **params):
+        response = self.client.get("/api/conversations/", params, headers=self.headers)
+        return {row["conversation_id"] for row in response.json()["conversations"]}
+
+    def test_delete_runs_a_fixed_number_of_queries(self):
+        other = seed(User.objects.create_user("bystander", "bystander@example.com", "password"), conversations=1, messages=3)[0]
+        with CaptureQueriesContext(connection) as few:
+            self.bulk("delete", self.ids[:1])
+        with CaptureQueriesContext(connection) as many:
+            response = self.bulk("delete", self.ids[1:] + [str(other.conversation_id)])
+        self.assertEqual(response.json(), {"action": "delete", "count": 3, "not_found": [str(other.conversation_id)]})
+        self.assertEqual(len(few.captured_queries), len(many.captured_queries))
+        self.assertFalse(Conversation.objects.filter(user=self.user).exists())
+        self.assertFalse(Message.objects.filter(conversation__user=self.user).exists())
+        self.assertEqual(Message.objects.filter(conversation=other).count(), 3)
+
+    def test_archived_conversations_leave_the_listing(self):
+        self.assertEqual(self.bulk("archive", self.ids[:2]).json()["count"], 2)
+        self.assertEqual(self.listed(), set(self.ids[2:]))
+        self.assertEqual(self.listed(archived=1), set(self.ids[:2]))
+        self.bulk("unarchive", self.ids[:1])
+        self.assertEqual(self.listed(), set(self.ids[:1] + self.ids[2:]))
+
+    def test_listing_rejects_bad_cursors(self):
+        for cursor in ("garbage", encode_cursor("not a date", 1), encode_cursor("2024-02-30T00:00:00", 1),
+                       encode_cursor("2024-01-01T00:00:00+00:00", "1"), encode_cursor(["2024"], 1)):
+            response = self.client.get("/api/conversations/", {"cursor": cursor}, headers=self.headers)
+            self.assertEqual(response.status_code, 400, cursor)
+
+    def test_export_streams_ndjson(self):
+        response = self.bulk("export", self.ids[:2])
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([line["type"] for line in lines], ["conversation", "message", "message", "message"] * 2)
+        self.assertEqual({line["conversation_id"] for line in lines}, set(self.ids[:2]))
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self.bulk("shred", self.ids).status_code, 400)
+        self.assertEqual(self.bulk("delete", ["not-a-uuid"]).status_code, 400)
+        self.assertEqual(self.bulk("delete", []).status_code, 400)
+        for body in ([], "delete", 3, None):
+            response = self.client.post("/api/conversations/bulk/", json.dumps(body), content_type="application/json", headers=self.headers)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(Conversation.objects.count(), 4)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("mover", "mover@example.com", "password")
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.conversations = seed(self.user, conversations=3, messages=4)
+        for convo in self.conversations:
+            last = convo.messages.last()
+            Conversation.objects.filter(pk=convo.pk).update(message_count=4, last_message_at=last.created_at)
+        blob = Blob.objects.create(sha256="ab" * 32, file="blobs/ab/ab/shared.txt", size=6)
+        FileAttachment.objects.create(message=self.conversations[0].messages.first(), blob=blob, file=blob.file.name,
+                                      file_name="shared.txt", file_type="text/plain")
+
+    def test_gzipped_export_round_trips_through_the_importer(self):
+        response = self.client.get("/api/export/", {"gzip": 1}, headers=self.headers)
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        export = tempfile.NamedTemporaryFile(suffix=".ndjson.gz")
+        self.addCleanup(export.close)
+        export.write(b"".join(response.streaming_content))
+        export.flush()
+
+        heir = User.objects.create_user("heir", "heir@example.com", "password")
+        out = io.StringIO()
+        call_command("import_conversations", export.name, user="heir", new_ids=True, batch_size=5, stdout=out)
+        self.assertIn("imported 3 conversations, 12 messages, 1 attachments", out.getvalue())
+
+        fields = ("title", "message_count", "created_at", "last_message_at")
+        self.assertEqual(
+            list(Conversation.objects.filter(user=heir).order_by("created_at").values_list(*fields)),
+            list(Conversation.objects.filter(user=self.user).order_by("created_at").values_list(*fields)),
+        )
+        self.assertEqual(
+            list(Message.objects.filter(conversation__user=heir).order_by("created_at", "id").values_list("user_message", "created_at")),
+            list(Message.objects.filter(conversation__user=self.user).order_by("created_at", "id").values_list("user_message", "created_at")),
+        )
+        attachment = FileAttachment.objects.filter(message__conversation__user=heir).get()
+        self.assertEqual(attachment.blob.sha256, "ab" * 32)
+        self.assertEqual(attachment.uploaded_at, FileAttachment.objects.filter(message__conversation__user=self.user).get().uploaded_at)
+
+    def test_import_leaves_other_saves_their_timestamps(self):
+        lines = list(export_lines(Conversation.objects.filter(user=self.user)))
+        heir = User.objects.create_user("heir", "heir@example.com", "password")
+        bystander = Conversation.objects.create(user=self.user)
+        saved = []
+        bulk_create = Message.objects.bulk_create
+
+        def meanwhile(*args, **kwargs):
+            # What any other thread saving a message during the import would do
+            saved.append(Message.objects.create(conversation=bystander, user_message="live", ai_response="turn"))
+            return bulk_create(*args, **kwargs)
+
+        started = timezone.now()
+        with mock.patch.object(Message.objects, "bulk_create", side_effect=meanwhile):
+            import_lines(lines, heir, new_ids=True)
+        self.assertGreaterEqual(Message.objects.get(pk=saved[0].pk).created_at, started)
+        self.assertEqual(
+            sorted(Message.objects.filter(conversation__user=heir).values_list("created_at", flat=True)),
+            sorted(Message.objects.filter(conversation__user=self.user).exclude(conversation=bystander).values_list("created_at", flat=True)),
+        )
+
+
+class BenchTests(TestCase):
+    def test_seed_is_reproducible(self):
+        seeded = seed_database(random.Random(7), users=2, conversations=3, messages=4)
+        self.assertEqual([len(ids) for _, _, ids in seeded], [3, 3])
+        self.assertEqual(Message.objects.count(), 24)
+        convo = Conversation.objects.get(conversation_id=seeded[0][2][0])
+        self.assertEqual(convo.message_count, 4)
+        self.assertEqual(convo.title, conversation_title(convo.messages.first().user_message))
+        # Same seed, same text
+        texts = list(Message.objects.order_by('id').values_list('user_message', flat=True)[:4])
+        Message.objects.all().delete()
+        User.objects.filter(username__startswith="bench").delete()
+        seed_database(random.Random(7), users=1, conversations=1, messages=4)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('user_message', flat=True)), texts)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual((percentile(values, 50), percentile(values, 95), percentile(values, 99)), (50, 95, 99))
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+class AuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("holder", "holder@example.com", "password")
+        self.token = RefreshToken.for_user(self.user).access_token
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+        get_token_cache()._entries.clear()
+
+    def test_token_is_verified_once_per_request_without_a_user_query(self):
+        with mock.patch("rest_framework_simplejwt.authentication.JWTAuthentication.get_validated_token",
+                        autospec=True, side_effect=lambda self, raw: AccessToken(raw)) as verify:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/api/conversations/", headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(verify.call_count, 1)
+            self.assertFalse([q for q in queries if "auth_user" in q["sql"]])
+
+            # Later requests with the same token skip the signature check
+            self.client.get("/api/conversations/", headers=self.headers)
+            self.assertEqual(verify.call_count, 1)
+
+    def test_rejects_invalid_and_expired_tokens(self):
+        self.assertEqual(self.client.get("/api/conversations/", headers={"Authorization": "Bearer nonsense"}).status_code, 401)
+        expired = AccessToken.for_user(self.user)
+        expired.set_exp(lifetime=-timedelta(seconds=1))
+        self.assertEqual(self.client.get("/api/conversations/", headers={"Authorization": f"Bearer {expired}"}).status_code, 401)
+        self.assertEqual(self.client.get("/api/conversations/").status_code, 401)
+
+    def test_cache_drops_expired_entries(self):
+        cache = VerifiedTokenCache(max_entries=2)
+        cache.set("a", {"exp": time.time() - 1})
+        self.assertIsNone(cache.get("a"))
+        for key in "bcd":
+            cache.set(key, {"exp": time.time() + 60})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 2)
+
+    def test_deactivating_a_user_revokes_their_tokens(self):
+        self.assertEqual(self.client.get("/api/conversations/", headers=self.headers).status_code, 200)
+        self.assertEqual(len(get_token_cache()), 1)
+        refresh = str(RefreshToken.for_user(self.user))
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(len(get_token_cache()), 0)
+        self.assertEqual(self.client.get("/api/conversations/", headers=self.headers).status_code, 401)
+        self.assertEqual(self.client.post("/api/refresh/", {"refresh_token": refresh}, content_type="application/json",
+                                          headers=self.headers).status_code, 401)
+
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.client.get("/api/conversations/", headers=self.headers).status_code, 200)
+
+    def test_async_views_reject_revoked_tokens(self):
+        revoke_user(self.user.pk)
+        self.addCleanup(unrevoke_user, self.user.pk)
+
+        async def chat():
+            return await AsyncClient().post("/api/chat_async/", {"prompt_message": "hi"}, headers=self.headers)
+
+        self.assertEqual(asyncio.run(chat()).status_code, 401)
+
+    def test_deactivated_user_is_rejected_without_the_cached_status(self):
+        # A restarted worker, or one not sharing the cache, reads the row instead
+        self.assertEqual(self.client.get("/api/conversations/", headers=self.headers).status_code, 200)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        cache.clear()
+        self.assertEqual(self.client.get("/api/conversations/", headers=self.headers).status_code, 401)
+
+        User.objects.filter(pk=self.user.pk).delete()
+        cache.clear()
+        self.assertEqual(self.client.get("/api/conversations/", headers=self.headers).status_code, 401)
+
+    async def test_async_views_reject_a_deactivated_user_without_the_cached_status(self):
+        await User.objects.filter(pk=self.user.pk).aupdate(is_active=False)
+        await cache.aclear()
+        response = await self.async_client.post("/api/chat_async/", {"prompt_message": "hi"}, headers=self.headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_unreachable_cache_falls_back_to_the_user_row(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        with mock.patch("django.core.cache.backends.locmem.LocMemCache.get", side_effect=ConnectionError("cache down")), \
+                self.assertLogs("api.authentication", "WARNING"):
+            self.assertEqual(self.client.get("/api/conversations/", headers=self.headers).status_code, 401)
+
+    def test_profile_loads_the_user_lazily(self):
+        response = self.client.get("/api/profile/", headers=self.headers)
+        self.assertEqual(response.json()["username"], "holder")
@@ -0,0 +1,72 @@
+import hashlib
+import os
+from django.conf import settings
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+
+
+# Chat attachments are streamed straight to a temporary file in chunks (64 KB by
+# default) and hashed on the way, so a request never holds a whole upload in memory
+# however many files it carries. Extension, size and count limits are enforced while
+# the body is still being read; rejected files are skipped and reported through
+# upload_errors() so the view can answer 400 before calling the LLM.
+
+VALID_EXTENSIONS = [
+    # Images
+    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.svg',
+    # Documents
+    '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.txt', '.rtf',
+    # Archives
+    '.zip', '.rar', '.7z', '.tar', '.gz',
+    # Audio
+    '.mp3', '.wav', '.ogg', '.flac',
+    # Video
+    '.mp4', '.mov', '.avi', '.mkv', '.wmv'
+]
+
+
+def unsupported_type_error(file_ext):
+    return f"File type {file_ext} is not supported. Supported types: {', '.join(VALID_EXTENSIONS)}"
+
+
+def upload_errors(request):
+    return getattr(request, '_upload_errors', [])
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.max_size = getattr(settings, 'FILE_UPLOAD_MAX_SIZE', 10 * 1024 * 1024)
+        self.max_files = getattr(settings, 'FILE_UPLOAD_MAX_FILES', 10)
+        self.file_count = 0
+
+    def _reject(self, error):
+        if self.request is not None:
+            if not hasattr(self.request, '_upload_errors'):
+                self.request._upload_errors = []
+            self.request._upload_errors.append(error)
+        raise SkipFile(error)
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        file_ext = os.path.splitext(file_name)[1].lower()
+        if file_ext not in VALID_EXTENSIONS:
+            self._reject(unsupported_type_error(file_ext))
+        self.file_count += 1
+        if self.file_count > self.max_files:
+            self._reject(f"Too many files, at most {self.max_files} can be attached to a message.")
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size > self.max_size:
+            # Stop writing right away, the parser discards the rest of this part
+            self.file.close()
+            self._reject(f"File {self.file_name} is larger than the {self.max_size / (1024 * 1024):g} MB limit.")
+        self.hasher.update(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.hasher.hexdigest()
+        return file
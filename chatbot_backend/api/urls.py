@@ -1,19 +1,28 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 from django.conf import settings
 from django.conf.urls.static import static
 
 urlpatterns = [
     path('chat/', views.chat, name='chat'),
+    path('chat_async/', async_views.chat, name='chat_async'),
     path('chat_history/<str:conversation_id>/', views.get_chat_history, name='get_chat_history'),
     path('login/', views.login_view, name='login_view'),
     path('register/', views.register, name='register'),
     path('logout/', views.logout_view, name='logout_view'),
     path('refresh/', views.refresh_token, name='refresh_token'),
     path('history2/', views.get_chat_history2, name='get_chat_history2'),
+    path('export/', views.export_history, name='export_history'),
+    path('conversations/', views.list_conversations, name='list_conversations'),
+    path('conversations/bulk/', views.bulk_conversations, name='bulk_conversations'),
+    path('search/', views.search, name='search'),
     path('profile/', views.get_profile, name='get_profile'),
     path('conversation_delete/<str:conversation_id>/', views.delete_conversation, name='delete_conversation'),
     path('delete_profile/', views.delete_profile, name='delete_profile'),
+    path('account_deletion/<str:job_id>/', views.account_deletion_status, name='account_deletion_status'),
+    path('usage/', views.usage, name='usage'),
+    path('response_cache_stats/', views.response_cache_stats, name='response_cache_stats'),
+    path('router_stats/', views.router_stats, name='router_stats'),
     # path('validate-token/', views.validate_token2, name='validate_token2'),
 ]
 
@@ -0,0 +1,251 @@
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.signals import request_finished, setting_changed
+from django.db import connection, transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import DailyUsage, UsageEvent
+
+
+# Token usage ledger. Every chat turn leaves a UsageEvent (model, prompt and completion
+# tokens, upstream latency) and adds to its user's DailyUsage row. Events are buffered
+# in memory and written in batches: once BATCH_SIZE of them are waiting or the oldest
+# has waited FLUSH_INTERVAL seconds, the request that notices writes them after its
+# response has gone out, with one insert for the events and one increment per user and
+# day touched. DAILY_TOKEN_QUOTA, when set, caps the tokens a user spends per day.
+# Configured through settings.USAGE_LEDGER.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 5.0,
+    # Beyond this many unwritten events (database down) the oldest are dropped
+    'MAX_PENDING': 10_000,
+    'DAILY_TOKEN_QUOTA': None,
+}
+
+_COUNTERS = ('turns', 'upstream_calls', 'prompt_tokens', 'completion_tokens', 'latency_ms')
+
+
+def _option(name):
+    return getattr(settings, 'USAGE_LEDGER', {}).get(name, DEFAULTS[name])
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Daily usage limit reached, please come back tomorrow.")
+        self.retry_after = retry_after
+
+
+class Turn:
+    """Upstream usage of one chat turn, filled in while the view talks to the LLM."""
+
+    def __init__(self, model=None):
+        # Set by the router to the model that answered
+        self.model = model
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = None
+
+    @contextmanager
+    def upstream(self):
+        # Wraps the call, for streams until the last token. A turn that never enters it
+        # was answered from the cache or by an identical call already in flight
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.latency = (self.latency or 0.0) + time.perf_counter() - started
+
+    def add(self, usage):
+        # response.usage, or chunk.usage of the last chunk of a stream
+        if usage is not None:
+            self.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+            self.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+
+def _counters(event):
+    upstream = event.latency_ms is not None
+    return (1, int(upstream), event.prompt_tokens, event.completion_tokens, event.latency_ms or 0)
+
+
+class UsageRecorder:
+    def __init__(self, batch_size=100, flush_interval=5.0, max_pending=10_000, **options):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        self._pending = []
+        self._oldest = None
+        # Database the pending events were recorded against, see _flush_at_exit
+        self.database = None
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.monotonic()
+                self.database = connection.settings_dict['NAME']
+            self._pending.append(event)
+            if len(self._pending) > self.max_pending:
+                self.dropped += 1
+                self._pending.pop(0)
+
+    def due(self):
+        with self._lock:
+            return bool(self._pending) and (
+                len(self._pending) >= self.batch_size
+                or time.monotonic() - self._oldest >= self.flush_interval
+            )
+
+    def flush(self):
+        """Write the buffered events and add them to the daily counters. Returns the number written."""
+        with self._lock:
+            events, self._pending = self._pending, []
+        if not events:
+            return 0
+        totals = {}
+        for event in events:
+            key = (event.user_id, timezone.localdate(event.created_at))
+            totals[key] = [a + b for a, b in zip(totals.get(key, [0] * len(_COUNTERS)), _counters(event))]
+        try:
+            with transaction.atomic():
+                UsageEvent.objects.bulk_create(events, batch_size=self.batch_size)
+                # Make sure every row exists, then increment in SQL so concurrent flushes add up
+                DailyUsage.objects.bulk_create(
+                    [DailyUsage(user_id=user_id, day=day) for user_id, day in totals], ignore_conflicts=True,
+                )
+                for (user_id, day), values in totals.items():
+                    DailyUsage.objects.filter(user_id=user_id, day=day).update(
+                        **{name: F(name) + value for name, value in zip(_COUNTERS, values)}
+                    )
+        except Exception:
+            logger.exception("Could not write %d usage events, keeping them for the next flush", len(events))
+            for event in events:
+                # Rolled back, whatever ids bulk_create handed out are void
+                event.pk = None
+            with self._lock:
+                self._pending[:0] = events
+                self._oldest = time.monotonic()
+                overflow = len(self._pending) - self.max_pending
+                if overflow > 0:
+                    self.dropped += overflow
+                    del self._pending[:overflow]
+            return 0
+        with self._lock:
+            self.written += len(events)
+            if self._pending:
+                self._oldest = time.monotonic()
+        return len(events)
+
+    def pending_for(self, user_id, day):
+        # This process's events for user_id on day that are not in DailyUsage yet
+        with self._lock:
+            events = [event for event in self._pending if event.user_id == user_id]
+        totals = [0] * len(_COUNTERS)
+        for event in events:
+            if timezone.localdate(event.created_at) == day:
+                totals = [a + b for a, b in zip(totals, _counters(event))]
+        return dict(zip(_COUNTERS, totals))
+
+    def stats(self):
+        return {"pending": len(self._pending), "written": self.written, "dropped": self.dropped}
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_usage_recorder():
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                options = {**DEFAULTS, **getattr(settings, 'USAGE_LEDGER', {})}
+                _recorder = UsageRecorder(**{name.lower(): value for name, value in options.items()})
+    return _recorder
+
+
+def record_turn(conversation, message, turn):
+    get_usage_recorder().record(UsageEvent(
+        user_id=conversation.user_id,
+        conversation_id=conversation.conversation_id,
+        message_id=message.pk,
+        model=turn.model or '',
+        prompt_tokens=turn.prompt_tokens,
+        completion_tokens=turn.completion_tokens,
+        latency_ms=None if turn.latency is None else round(turn.latency * 1000),
+        cached=turn.latency is None,
+    ))
+
+
+def _today(user_id, row):
+    usage = dict(zip(_COUNTERS, row or (0,) * len(_COUNTERS)))
+    for name, value in get_usage_recorder().pending_for(user_id, timezone.localdate()).items():
+        usage[name] += value
+    return usage
+
+
+def usage_today(user_id):
+    """Today's counters for user_id, including events this process has not written yet."""
+    row = DailyUsage.objects.filter(user_id=user_id, day=timezone.localdate()).values_list(*_COUNTERS).first()
+    return _today(user_id, row)
+
+
+async def ausage_today(user_id):
+    row = await DailyUsage.objects.filter(user_id=user_id, day=timezone.localdate()).values_list(*_COUNTERS).afirst()
+    return _today(user_id, row)
+
+
+def _check(usage, quota):
+    if usage['prompt_tokens'] + usage['completion_tokens'] >= quota:
+        now = timezone.localtime()
+        midnight = timezone.make_aware(datetime.combine(now.date() + timedelta(days=1), datetime.min.time()))
+        raise QuotaExceeded((midnight - now).total_seconds())
+
+
+def daily_quota():
+    return _option('DAILY_TOKEN_QUOTA')
+
+
+def check_quota(user_id):
+    """Raise QuotaExceeded if the user has used up DAILY_TOKEN_QUOTA today. One row read, or none when off."""
+    quota = daily_quota()
+    if quota:
+        _check(usage_today(user_id), quota)
+
+
+async def acheck_quota(user_id):
+    quota = daily_quota()
+    if quota:
+        _check(await ausage_today(user_id), quota)
+
+
+@receiver(request_finished)
+def _flush_if_due(sender, **kwargs):
+    # After the response went out, so no client waits on the write
+    if _recorder is not None and _recorder.due():
+        _recorder.flush()
+
+
+@atexit.register
+def _flush_at_exit():
+    # Not when a test run (or bench) recorded them: its test database is gone by now and
+    # the connection points at the real one again
+    if _recorder is not None and _recorder.database == connection.settings_dict['NAME']:
+        _recorder.flush()
+
+
+@receiver(setting_changed)
+def _reset_recorder(setting, **kwargs):
+    global _recorder
+    if setting == 'USAGE_LEDGER':
+        _recorder = None
@@ -1,31 +1,179 @@
 import os
 import json
+import logging
+import math
 import uuid
-from django.http import JsonResponse
-from .models import Conversation, Message, FileAttachment
+import hashlib
+from datetime import timedelta
+from django.http import JsonResponse, StreamingHttpResponse
+from .models import AccountDeletion, Conversation, DailyUsage, Message, FileAttachment
 from dotenv import load_dotenv
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import RefreshToken
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.utils.cache import get_conditional_response
+from django.utils import timezone
+from django.utils.http import http_date
 import mimetypes
+from .authentication import RevokedJWTAuthentication, is_revoked
 from .decorators import validate_token
-from openai import OpenAI
+from .metrics import span
+from .response_cache import get_response_cache, make_key
+from .singleflight import get_single_flight
+from .context import build_context
+from .pagination import encode_cursor, decode_cursor, decode_keyset_cursor, page_size, HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE
+from .llm_client import CircuitOpenError
+from .router import get_router
+from .admission import OverloadedError, get_admission
+from .ratelimit import RateLimited, check_chat_rate
+from .usage import QuotaExceeded, Turn, check_quota, daily_quota, record_turn, usage_today
+from .account_deletion import request_deletion
+from .blobs import store_blob
+from .bulk import MAX_CONVERSATIONS as MAX_BULK_CONVERSATIONS, archive_conversations, delete_conversations, unarchive_conversations
+from .export import export_lines, gzip_lines
+from .extraction import document_context, queue_extraction
+from .retrieval import retrieval_context
+from .search import search_messages
+from .uploads import VALID_EXTENSIONS, unsupported_type_error, upload_errors
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
+# print(Message.objects.all())
+
+BULK_ACTIONS = {
+    "delete": delete_conversations,
+    "archive": archive_conversations,
+    "unarchive": unarchive_conversations,
+    "export": None,
+}
+
+
+def _validate_files(request, files):
+    # Returns an error response for the first rejected file, None if all are fine.
+    # HashingUploadHandler already checked type, size and count while the body was
+    # streamed to disk; the extension check stays for any other configured handler
+    errors = upload_errors(request)
+    if errors:
+        return JsonResponse({"error": errors[0]}, status=400)
+    for file in files:
+        file_ext = os.path.splitext(file.name)[1].lower()
+        if file_ext not in VALID_EXTENSIONS:
+            return JsonResponse({"error": unsupported_type_error(file_ext)}, status=400)
+    return None
+
+
+def _save_attachments(request, message, files):
+    saved_files = []
+    with span("files"):
+        for file in files:
+            # Get file type from MIME or extension
+            file_type = file.content_type or mimetypes.guess_type(file.name)[0] or "application/octet-stream"
+
+            # Save the file attachment, its content is stored once per distinct file
+            with transaction.atomic():
+                blob = store_blob(file)
+                attachment = FileAttachment.objects.create(
+                    message=message,
+                    blob=blob,
+                    file=blob.file.name,
+                    file_name=file.name,
+                    file_type=file_type
+                )
+                # Documents are parsed in the background, once per distinct content
+                queue_extraction(attachment)
 
-client2 = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=os.getenv("KEY"),
-)
+            saved_files.append({
+                "id": str(attachment.id),
+                "file_name": attachment.file_name,
+                "file_type": attachment.file_type,
+                "file_url": request.build_absolute_uri(settings.MEDIA_URL + str(attachment.file)),
+                "file_category": attachment.file_category
+            })
+    return saved_files
+
+
+def _upstream_unavailable(error, status=503):
+    # The circuit breaker is open, the upstream is saturated (503) or the caller is over
+    # its rate limit or daily quota (429): tell the client when to come back instead of hanging
+    response = JsonResponse({"error": str(error)}, status=status)
+    response["Retry-After"] = str(max(1, math.ceil(error.retry_after)))
+    return response
+
+
+def _wants_stream(request):
+    # Streaming is opt-in through a "stream" form field or query parameter
+    stream = request.POST.get("stream") or request.GET.get("stream") or ""
+    return stream.lower() in ("1", "true", "yes")
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _stream_chat(request, conversation, conversation_id, prompt_message, llm_messages, files):
+    def event_stream():
+        # Let the client know which conversation the tokens belong to right away
+        yield _sse("start", {"conversation_id": str(conversation_id)})
+
+        chunks = []
+        turn = Turn()
+        try:
+            response_cache = get_response_cache()
+            cache_key = make_key(settings.LLM_MODEL, llm_messages)
+            ai_response = response_cache.get(cache_key)
+            if ai_response is not None:
+                yield _sse("token", {"token": ai_response})
+            else:
+                with turn.upstream():
+                    for chunk in get_router().stream(llm_messages, turn=turn):
+                        turn.add(chunk.usage)
+                        if not chunk.choices:
+                            continue
+                        token = chunk.choices[0].delta.content
+                        if token:
+                            chunks.append(token)
+                            yield _sse("token", {"token": token})
+
+                # The full answer is only persisted once the upstream stream is complete
+                ai_response = "".join(chunks)
+                response_cache.set(cache_key, ai_response)
+
+            message = Message.objects.create(
+                conversation=conversation,
+                user_message=prompt_message,
+                ai_response=ai_response,
+                model=turn.model
+            )
+            saved_files = _save_attachments(request, message, files)
+            # Bumps last_edited_at, the history ETag, so only once the attachments are in
+            conversation.record_message(message)
+            record_turn(conversation, message, turn)
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+            return
+
+        yield _sse("done", {
+            "conversation_id": str(conversation_id),
+            "ai_response": ai_response,
+            "files": saved_files
+        })
+
+    response = StreamingHttpResponse(event_stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx-style proxies from buffering the whole stream
+    response["X-Accel-Buffering"] = "no"
+    return response
 
-# print(Message.objects.all())
 
 #for file support
 @csrf_exempt
@@ -39,6 +187,12 @@ def chat(request):
         if not request.user.is_authenticated:
             return JsonResponse({"error": "You must be logged in to interact with the chat."}, status=401)
 
+        try:
+            check_chat_rate(request.user.id)
+            check_quota(request.user.id)
+        except (RateLimited, QuotaExceeded) as e:
+            return _upstream_unavailable(e, status=429)
+
         try:
             # Handle form data and files
             prompt_message = request.POST.get("prompt_message", "")
@@ -48,15 +202,30 @@ def chat(request):
             if not prompt_message and not files:
                 return JsonResponse({"error": "No prompt message or files provided"}, status=400)
 
+            # Reject unsupported files before creating anything or paying for the AI round trip
+            file_error = _validate_files(request, files)
+            if file_error:
+                return file_error
+
             # If a conversation_id is provided, attempt to retrieve the existing conversation
             if conversation_id:
-                conversation = Conversation.objects.filter(conversation_id=conversation_id, user=request.user).first()
+                conversation = Conversation.objects.filter(conversation_id=conversation_id, user_id=request.user.id).first()
                 if not conversation:
                     return JsonResponse({"error": "Conversation not found or you are not authorized to continue this conversation."}, status=404)
+                # Previous turns, trimmed to the token budget, so the model can follow the conversation
+                history = build_context(conversation)
+                new_conversation = False
             else:
                 # If no conversation_id is provided, create a new conversation
                 conversation_id = str(uuid.uuid4())  # New conversation ID
-                conversation = Conversation.objects.create(user=request.user, conversation_id=conversation_id)
+                conversation = Conversation.objects.create(user_id=request.user.id, conversation_id=conversation_id)
+                history = []
+                new_conversation = True
+
+            # Text already extracted from this turn's or earlier attached documents
+            documents = document_context(conversation, files, new_conversation)
+            # and the most relevant snippets of the user's other conversations and files
+            retrieved = retrieval_context(request.user.id, prompt_message, conversation, skip=documents["content"] if documents else "")
 
             # Preparing payload for AI - include file information if files are uploaded
             ai_input = prompt_message
@@ -69,64 +238,45 @@ def chat(request):
                 if file_info:
                     ai_input += "\n\nAttached files:\n" + "\n".join(file_info)
 
-            # Sending message to AI and receiving a response
-            response = client2.chat.completions.create(
-                extra_headers={"HTTP-Referer": "", "X-Title": ""},
-                extra_body={},
-                model="deepseek/deepseek-chat:free",
-                messages=[{"role": "user", "content": ai_input}],
-            )
-
-            ai_response = response.choices[0].message.content
+            llm_messages = [m for m in (documents, retrieved) if m] + history + [{"role": "user", "content": ai_input}]
+
+            # Stream tokens back as Server-Sent Events when the client asks for it
+            if _wants_stream(request):
+                # Refuse now rather than with an error event once the stream has started
+                get_admission().check()
+                return _stream_chat(request, conversation, conversation_id, prompt_message, llm_messages, files)
+
+            # Repeated prompts are answered from the cache without an upstream round trip
+            response_cache = get_response_cache()
+            cache_key = make_key(settings.LLM_MODEL, llm_messages)
+            ai_response = response_cache.get(cache_key)
+            turn = Turn()
+
+            if ai_response is None:
+                # Sending message to AI and receiving a response. Identical prompts that are
+                # already in flight wait for that call instead of issuing their own
+                def complete():
+                    with turn.upstream():
+                        response = get_router().complete(llm_messages, turn=turn)
+                    turn.add(response.usage)
+                    answer = response.choices[0].message.content
+                    response_cache.set(cache_key, answer)
+                    return answer
+
+                ai_response = get_single_flight().do(cache_key, complete)
 
             # Save the user message and AI response in the Message model
             message = Message.objects.create(
                 conversation=conversation,
                 user_message=prompt_message,
-                ai_response=ai_response
+                ai_response=ai_response,
+                model=turn.model
             )
-            
             # Process and save files
-            saved_files = []
-            for file in files:
-                # Validate file type
-                file_ext = os.path.splitext(file.name)[1].lower()
-                valid_extensions = [
-                    # Images
-                    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.svg',
-                    # Documents
-                    '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.txt', '.rtf',
-                    # Archives
-                    '.zip', '.rar', '.7z', '.tar', '.gz',
-                    # Audio
-                    '.mp3', '.wav', '.ogg', '.flac',
-                    # Video
-                    '.mp4', '.mov', '.avi', '.mkv', '.wmv'
-                ]
-                
-                if file_ext not in valid_extensions:
-                    return JsonResponse({
-                        "error": f"File type {file_ext} is not supported. Supported types: {', '.join(valid_extensions)}"
-                    }, status=400)
-                
-                # Get file type from MIME or extension
-                file_type = file.content_type or mimetypes.guess_type(file.name)[0] or "application/octet-stream"
-                
-                # Save the file attachment
-                attachment = FileAttachment.objects.create(
-                    message=message,
-                    file=file,
-                    file_name=file.name,
-                    file_type=file_type
-                )
-                
-                saved_files.append({
-                    "id": str(attachment.id),
-                    "file_name": attachment.file_name,
-                    "file_type": attachment.file_type,
-                    "file_url": request.build_absolute_uri(settings.MEDIA_URL + str(attachment.file)),
-                    "file_category": attachment.file_category
-                })
+            saved_files = _save_attachments(request, message, files)
+            # Bumps last_edited_at, the history ETag, so only once the attachments are in
+            conversation.record_message(message)
+            record_turn(conversation, message, turn)
 
             return JsonResponse({
                 "conversation_id": conversation_id, 
@@ -134,6 +284,8 @@ def chat(request):
                 "files": saved_files
             }, status=200)
 
+        except (CircuitOpenError, OverloadedError) as e:
+            return _upstream_unavailable(e)
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=500)
 
@@ -144,6 +296,7 @@ def chat(request):
 #this is the view to get the chat history titles and id for 
 #the navbar but also the messages that i was aiming to use but eneded 
 # making another function specifically for that
+#the sidebar now uses list_conversations, this one is kept for older clients
 @csrf_exempt
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -151,7 +304,14 @@ def chat(request):
 def get_chat_history2(request):
     if request.method == "POST":
         try:
-            conversations = Conversation.objects.filter(user=request.user).order_by('-created_at')
+            # All messages in one query rather than one per conversation; ordered like the
+            # (conversation, created_at, id) index, so chronological within each conversation
+            messages = Message.objects.order_by('conversation_id', 'created_at', 'id').only(
+                'conversation_id', 'user_message', 'ai_response', 'created_at'
+            )
+            conversations = Conversation.objects.filter(user_id=request.user.id).order_by('-created_at').prefetch_related(
+                Prefetch('messages', queryset=messages)
+            )
 
             chat_history = []
             for convo in conversations:
@@ -164,13 +324,9 @@ def get_chat_history2(request):
                         "created_at": message.created_at,
                     })
 
-                # Extract the first three words from the first message of the conversation
-                first_prompt = convo.messages.first().user_message if convo.messages.exists() else ""
-                first_prompt_title = ' '.join(first_prompt.split()[:4])
-
                 chat_history.append({
                     "conversation_id": convo.conversation_id,
-                    "title": first_prompt_title,
+                    "title": convo.title,
                     "messages": messages,
                     "created_at": convo.created_at,
                 })
@@ -182,58 +338,199 @@ def get_chat_history2(request):
 
     return JsonResponse({"error": "Invalid request method. Please use POST."}, status=400)
 
-#this is the view to get the chat history for a specific conversation with file attachements support
+#full export of the user's conversations (archived ones included) as NDJSON, see api.export.
+#?gzip=1 sends it gzipped. Streamed from server-side cursors, so any history size works
 @csrf_exempt
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 @validate_token
-def get_chat_history(request, conversation_id):
-    if request.method == "GET":
-        try:
-            # Retrieve the conversation with related messages for the authenticated user
-            conversation = Conversation.objects.prefetch_related('messages', 'messages__attachments').filter(
-                conversation_id=conversation_id, user=request.user
-            ).first()
+def export_history(request):
+    lines = export_lines(Conversation.objects.filter(user_id=request.user.id))
+    if request.GET.get("gzip", "").lower() in ("1", "true", "yes"):
+        response = StreamingHttpResponse(gzip_lines(lines), content_type="application/gzip")
+        response["Content-Disposition"] = 'attachment; filename="conversations.ndjson.gz"'
+    else:
+        response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+        response["Content-Disposition"] = 'attachment; filename="conversations.ndjson"'
+    return response
+
+#paginated sidebar listing: only ids, titles and timestamps, message bodies are
+#fetched on demand through get_chat_history. Keyset pagination on (created_at, id)
+#over the denormalized Conversation fields keeps every page at a single query
+@csrf_exempt
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@validate_token
+def list_conversations(request):
+    try:
+        limit = page_size(request)
+        conversations = Conversation.objects.filter(user_id=request.user.id)
+        # Archived conversations are listed separately with ?archived=1
+        archived = request.GET.get("archived", "").lower() in ("1", "true", "yes")
+        conversations = conversations.filter(archived_at__isnull=not archived)
+
+        cursor = request.GET.get("cursor")
+        if cursor:
+            created_at, pk = decode_keyset_cursor(cursor)
+            conversations = conversations.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+            )
 
-            if not conversation:
-                return JsonResponse({"error": "Conversation not found or unauthorized."}, status=404)
+        rows = list(
+            conversations.order_by('-created_at', '-id')
+            .values('id', 'conversation_id', 'title', 'message_count', 'created_at', 'last_edited_at', 'last_message_at', 'archived_at')[:limit + 1]
+        )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
 
-            # Retrieve all messages ordered chronologically
-            messages = []
-            for msg in conversation.messages.all().order_by('created_at'):
-                # Get file attachments for this message
-                attachments = []
-                for attachment in msg.attachments.all():
-                    attachments.append({
-                        "id": str(attachment.id),
-                        "file_name": attachment.file_name,
-                        "file_type": attachment.file_type,
-                        "file_url": request.build_absolute_uri(settings.MEDIA_URL + str(attachment.file)),
-                        "file_category": attachment.file_category,
-                        "uploaded_at": attachment.uploaded_at.isoformat()
-                    })
-                
-                messages.append({
-                    "id": msg.id,
-                    "user_message": msg.user_message,
-                    "ai_response": msg.ai_response,
-                    "created_at": msg.created_at.isoformat(),
-                    "attachments": attachments
-                })
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'].isoformat(), rows[-1]['id'])
+
+    return JsonResponse({
+        "conversations": [{
+            "conversation_id": row['conversation_id'],
+            "title": row['title'],
+            "message_count": row['message_count'],
+            "created_at": row['created_at'].isoformat(),
+            "last_edited_at": row['last_edited_at'].isoformat(),
+            "last_message_at": row['last_message_at'].isoformat() if row['last_message_at'] else None,
+            "archived_at": row['archived_at'].isoformat() if row['archived_at'] else None,
+        } for row in rows],
+        "next_cursor": next_cursor,
+    }, status=200)
+
+
+#ranked full-text search across the user's messages. Only snippets and ids are returned,
+#the client opens the conversation through get_chat_history. Pages are offset based
+#since results are ordered by rank
+@csrf_exempt
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@validate_token
+def search(request):
+    query = request.GET.get("q", "").strip()
+    if not query:
+        return JsonResponse({"error": "No search query provided"}, status=400)
 
-            # Get the first message to use as a title (if available)
-            first_message = conversation.messages.first()
-            title = ' '.join(first_message.user_message.split()[:4]) if first_message else "Untitled Conversation"
+    try:
+        limit = page_size(request)
+        offset = 0
+        cursor = request.GET.get("cursor")
+        if cursor:
+            offset, = decode_cursor(cursor)
+            if not isinstance(offset, int) or offset < 0:
+                raise ValueError("Invalid cursor")
+        hits = search_messages(request.user.id, query, limit + 1, offset)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except NotImplementedError as e:
+        return JsonResponse({"error": str(e)}, status=501)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
 
-            return JsonResponse({
-                "conversation_id": conversation.conversation_id,
-                "title": title,
-                "messages": messages,
-                "created_at": conversation.created_at.isoformat()
-            }, status=200)
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        next_cursor = encode_cursor(offset + limit)
+
+    return JsonResponse({"results": hits, "next_cursor": next_cursor}, status=200)
 
-        except Exception as e:
-            return JsonResponse({"error": str(e)}, status=500)
+
+#this is the view to get the chat history for a specific conversation with file attachements support.
+#returns the newest `limit` messages (default 50) in chronological order; pass older_cursor back as
+#?before= to scroll back and newer_cursor as ?after= to fetch what came since. Keyset on (created_at, id).
+#responses carry an ETag and Last-Modified from Conversation.last_edited_at, so an unchanged
+#conversation revalidates with a 304 after a single indexed lookup
+@csrf_exempt
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@validate_token
+def get_chat_history(request, conversation_id):
+    try:
+        limit = page_size(request, default=HISTORY_PAGE_SIZE, maximum=MAX_HISTORY_PAGE_SIZE)
+        before, after = request.GET.get("before"), request.GET.get("after")
+        if before and after:
+            return JsonResponse({"error": "Pass either before or after, not both"}, status=400)
+        if before or after:
+            cursor_time, cursor_id = decode_keyset_cursor(before or after)
+        conversation = (
+            Conversation.objects.filter(conversation_id=uuid.UUID(conversation_id), user_id=request.user.id)
+            .only('id', 'conversation_id', 'title', 'created_at', 'last_edited_at').first()
+        )
+    except (ValueError, TypeError) as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    try:
+        if not conversation:
+            return JsonResponse({"error": "Conversation not found or unauthorized."}, status=404)
+
+        # last_edited_at moves with every message, the rest of the key is which page was asked for
+        version = f"{conversation.pk}:{conversation.last_edited_at.isoformat()}:{limit}:{before}:{after}"
+        etag = '"%s"' % hashlib.md5(version.encode()).hexdigest()
+        # HTTP dates have whole seconds; the ETag, which clients prefer, tells apart edits within one
+        last_modified = int(conversation.last_edited_at.timestamp())
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        messages = Message.objects.filter(conversation_id=conversation.pk)
+        if after:
+            # Forward from the cursor, oldest first
+            rows = list(
+                messages.filter(Q(created_at__gt=cursor_time) | Q(created_at=cursor_time, id__gt=cursor_id))
+                .order_by('created_at', 'id')[:limit + 1]
+            )
+            has_newer, has_older = len(rows) > limit, True
+            rows = rows[:limit]
+        else:
+            # Back from the cursor (or the end), newest first, then put back in reading order
+            if before:
+                messages = messages.filter(Q(created_at__lt=cursor_time) | Q(created_at=cursor_time, id__lt=cursor_id))
+            rows = list(messages.order_by('-created_at', '-id')[:limit + 1])
+            has_older, has_newer = len(rows) > limit, bool(before)
+            rows = rows[:limit][::-1]
+
+        attachments = {}
+        if rows:
+            for attachment in FileAttachment.objects.filter(message_id__in=[row.id for row in rows]):
+                attachments.setdefault(attachment.message_id, []).append(attachment)
+        media_url = request.build_absolute_uri(settings.MEDIA_URL)
+
+        response = JsonResponse({
+            "conversation_id": conversation.conversation_id,
+            "title": conversation.title or "Untitled Conversation",
+            "created_at": conversation.created_at.isoformat(),
+            "messages": [{
+                "id": msg.id,
+                "user_message": msg.user_message,
+                "ai_response": msg.ai_response,
+                "created_at": msg.created_at.isoformat(),
+                "attachments": [{
+                    "id": str(attachment.id),
+                    "file_name": attachment.file_name,
+                    "file_type": attachment.file_type,
+                    "file_url": media_url + str(attachment.file),
+                    "file_category": attachment.file_category,
+                    "uploaded_at": attachment.uploaded_at.isoformat()
+                } for attachment in attachments.get(msg.id, ())],
+            } for msg in rows],
+            "older_cursor": encode_cursor(rows[0].created_at.isoformat(), rows[0].id) if rows and has_older else None,
+            # Handed out at the newest message too, to poll for what is added later
+            "newer_cursor": encode_cursor(rows[-1].created_at.isoformat(), rows[-1].id) if rows else after,
+            "has_newer": has_newer,
+        }, status=200)
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        # Cached by the browser but always revalidated
+        response["Cache-Control"] = "private, no-cache"
+        return response
+
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
 
 
 #delete conversation view
@@ -244,16 +541,75 @@ def get_chat_history(request, conversation_id):
 def delete_conversation(request, conversation_id):
     """Delete a specific conversation belonging to the authenticated user."""
     try:
-        conversation = Conversation.objects.filter(conversation_id=conversation_id, user=request.user).first()
+        conversation = Conversation.objects.filter(conversation_id=conversation_id, user_id=request.user.id).first()
         if not conversation:
             return JsonResponse({"error": "Conversation not found or unauthorized."}, status=404)
 
-        conversation.delete()
+        # Set-based delete, unreferenced files are collected in the background
+        delete_conversations(Conversation.objects.filter(pk=conversation.pk))
         return JsonResponse({"message": "Conversation deleted successfully."}, status=200)
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
 
+#delete, archive, unarchive or export many conversations in one call.
+#body: {"action": "...", "conversation_ids": [...]}; ids that are not the user's are reported as not_found
+@csrf_exempt
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@validate_token
+def bulk_conversations(request):
+    try:
+        data = json.loads(request.body)
+        if not isinstance(data, dict):
+            return JsonResponse({"error": "Request body must be a JSON object"}, status=400)
+        action = data.get("action")
+        conversation_ids = data.get("conversation_ids")
+        if action not in BULK_ACTIONS:
+            return JsonResponse({"error": f"action must be one of {', '.join(BULK_ACTIONS)}"}, status=400)
+        if not isinstance(conversation_ids, list) or not conversation_ids:
+            return JsonResponse({"error": "conversation_ids must be a non-empty list"}, status=400)
+        if len(conversation_ids) > MAX_BULK_CONVERSATIONS:
+            return JsonResponse({"error": f"At most {MAX_BULK_CONVERSATIONS} conversations per call"}, status=400)
+        requested = {str(uuid.UUID(str(conversation_id))) for conversation_id in conversation_ids}
+    except ValueError as e:
+        # Covers malformed JSON and malformed ids
+        return JsonResponse({"error": f"Invalid request: {e}"}, status=400)
+
+    try:
+        conversations = Conversation.objects.filter(user_id=request.user.id, conversation_id__in=requested)
+        found = {str(conversation_id) for conversation_id in conversations.values_list('conversation_id', flat=True)}
+        not_found = sorted(requested - found)
+
+        if action == "export":
+            response = StreamingHttpResponse(export_lines(conversations), content_type="application/x-ndjson")
+            response["Content-Disposition"] = 'attachment; filename="conversations.ndjson"'
+            return response
+
+        count = BULK_ACTIONS[action](conversations)
+        return JsonResponse({"action": action, "count": count, "not_found": not_found}, status=200)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+#hit/miss counters of the prompt response cache (per process for the local-memory backend)
+@csrf_exempt
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+@validate_token
+def response_cache_stats(request):
+    return JsonResponse(get_response_cache().stats(), status=200)
+
+
+#latency, error rate and availability of each routed model, in the order they are tried
+@csrf_exempt
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+@validate_token
+def router_stats(request):
+    return JsonResponse({"models": get_router().stats()}, status=200)
+
+
 # User registration view
 @csrf_exempt
 def register(request):
@@ -329,15 +685,17 @@ def refresh_token(request):
     data = json.loads(request.body)
     refresh_token = data.get("refresh_token")
     if not refresh_token:
-        print("No refresh token provided")
+        logger.info("Token refresh without a refresh token")
         return JsonResponse({"error": "No refresh token provided"}, status=401)
     try:
-        print(f"Received refresh token: {refresh_token}")
         refresh = RefreshToken(refresh_token)
+        if is_revoked(refresh[api_settings.USER_ID_CLAIM]):
+            return JsonResponse({"error": "User is inactive"}, status=401)
         new_access_token = str(refresh.access_token)
         return JsonResponse({"access_token": new_access_token}, status=200)
     except Exception as e:
-        print(f"Error refreshing token: {e}")
+        # Never log the token itself
+        logger.warning("Token refresh failed: %s", e)
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -360,16 +718,72 @@ def get_profile(request):
 
 
 
-#delete the authenticated user's profile
+#delete the authenticated user's profile.
+#the account is locked right away and deleted by a background job, poll account_deletion/<job_id>/
 @csrf_exempt
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
 @validate_token
 def delete_profile(request):
     try:
-        user = request.user
-        user.delete()
-        return JsonResponse({"message": "User profile deleted successfully."}, status=200)
+        job = request_deletion(request.user.id)
+        return JsonResponse({
+            "message": "User profile deletion started.",
+            "job_id": str(job.job_id),
+            "status": job.status,
+        }, status=202)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+#progress of an account deletion job. the account is locked by then, so its tokens are
+#only accepted here (without validate_token, which rejects them like every other view)
+@csrf_exempt
+@api_view(['GET'])
+@authentication_classes([RevokedJWTAuthentication])
+@permission_classes([IsAuthenticated])
+def account_deletion_status(request, job_id):
+    try:
+        job = AccountDeletion.objects.filter(job_id=uuid.UUID(job_id), user_id=request.user.id).first()
+    except ValueError:
+        job = None
+    if not job:
+        return JsonResponse({"error": "Deletion job not found or unauthorized."}, status=404)
+    return JsonResponse({
+        "job_id": str(job.job_id),
+        "status": job.status,
+        "conversations_total": job.conversations_total,
+        "conversations_deleted": job.conversations_deleted,
+        "error": job.error or None,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }, status=200)
+
+
+#token usage of the last ?days= days (30 by default) from the daily counters, newest first
+@csrf_exempt
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@validate_token
+def usage(request):
+    try:
+        days = min(max(int(request.GET.get("days", 30)), 1), 366)
+    except ValueError:
+        return JsonResponse({"error": "days must be a number."}, status=400)
+    try:
+        since = timezone.localdate() - timedelta(days=days - 1)
+        rows = DailyUsage.objects.filter(user_id=request.user.id, day__gte=since).order_by('-day')
+        today = usage_today(request.user.id)
+        return JsonResponse({
+            "today": {**today, "quota": daily_quota()},
+            "days": [{
+                "day": row.day.isoformat(),
+                "turns": row.turns,
+                "prompt_tokens": row.prompt_tokens,
+                "completion_tokens": row.completion_tokens,
+                "total_tokens": row.total_tokens,
+            } for row in rows],
+        }, status=200)
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
@@ -400,13 +814,13 @@ def chat2(request):
 
             # If a conversation_id is provided, attempt to retrieve the existing conversation
             if conversation_id:
-                conversation = Conversation.objects.filter(conversation_id=conversation_id, user=request.user).first()
+                conversation = Conversation.objects.filter(conversation_id=conversation_id, user_id=request.user.id).first()
                 if not conversation:
                     return JsonResponse({"error": "Conversation not found or you are not authorized to continue this conversation."}, status=404)
             else:
                 # If no conversation_id is provided, create a new conversation
                 conversation_id = str(uuid.uuid4())  # New conversation ID
-                conversation = Conversation.objects.create(user=request.user, conversation_id=conversation_id)
+                conversation = Conversation.objects.create(user_id=request.user.id, conversation_id=conversation_id)
 
             # Preparing payload for AI
             payload = {
@@ -415,22 +829,23 @@ def chat2(request):
             }
 
             # Sending message to AI and receiving a response
-            response = client2.chat.completions.create(
-                extra_headers={"HTTP-Referer": "", "X-Title": ""},
-                extra_body={},
-                model="deepseek/deepseek-chat:free",
-                messages=[{"role": "user", "content": payload["inputs"]}],
-            )
+            turn = Turn()
+            with turn.upstream():
+                response = get_router().complete([{"role": "user", "content": payload["inputs"]}], turn=turn)
+            turn.add(response.usage)
 
             ai_response = response.choices[0].message.content
 
             # Save the user message and AI response in the Message model
-            Message.objects.create(
+            message = Message.objects.create(
                 conversation=conversation,
                 user_message=prompt_message,
-                ai_response=ai_response
+                ai_response=ai_response,
+                model=turn.model
             )
-            print(f"Saving message: {prompt_message}, AI response: {ai_response}")
+            conversation.record_message(message)
+            record_turn(conversation, message, turn)
+            logger.debug("Saved message %s in conversation %s", message.id, conversation_id)
 
 
             return JsonResponse({"conversation_id": conversation_id, "ai_response": ai_response}, status=200)
@@ -442,17 +857,19 @@ def chat2(request):
 
 
 #this is the view to get the chat history bedore file attachements support
-#also unused now but keeping it for reference
+#also unused now but keeping it for reference (renamed, it used to shadow the view above)
 @csrf_exempt
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 @validate_token
-def get_chat_history(request, conversation_id):
+def get_chat_history_without_files(request, conversation_id):
     if request.method == "GET":
         try:
             # Retrieve the conversation with related messages for the authenticated user
-            conversation = Conversation.objects.prefetch_related('messages').filter(
-                conversation_id=conversation_id, user=request.user
+            conversation = Conversation.objects.prefetch_related(
+                Prefetch('messages', queryset=Message.objects.order_by('created_at', 'id'))
+            ).filter(
+                conversation_id=conversation_id, user_id=request.user.id
             ).first()
 
             if not conversation:
@@ -465,12 +882,11 @@ def get_chat_history(request, conversation_id):
                     "ai_response": msg.ai_response,
                     "created_at": msg.created_at.isoformat(),
                 }
-                for msg in conversation.messages.all().order_by('created_at')
+                # Already ordered by the prefetch, a new order_by here would query again
+                for msg in conversation.messages.all()
             ]
 
-            # Get the first message to use as a title (if available)
-            first_message = conversation.messages.first()
-            title = ' '.join(first_message.user_message.split()[:4]) if first_message else "Untitled Conversation"
+            title = conversation.title or "Untitled Conversation"
 
             return JsonResponse({
                 "conversation_id": conversation.conversation_id,
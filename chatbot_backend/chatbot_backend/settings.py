@@ -30,9 +30,167 @@ ALLOWED_HOSTS = []
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-# Maximum file upload size (10MB)
+# Maximum size of the non-file part of a request (10MB)
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024
-FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024
+
+# Attachments are streamed to temporary files and hashed chunk by chunk, never held in memory
+FILE_UPLOAD_HANDLERS = ['api.uploads.HashingUploadHandler']
+FILE_UPLOAD_MAX_MEMORY_SIZE = 256 * 1024
+FILE_UPLOAD_MAX_SIZE = 10 * 1024 * 1024
+FILE_UPLOAD_MAX_FILES = 10
+
+
+# LLM upstream (OpenRouter by default, overridable to point at a local mock)
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1")
+LLM_API_KEY = os.getenv("KEY")
+LLM_MODEL = os.getenv("LLM_MODEL", "deepseek/deepseek-chat:free")
+
+# Connection pool, timeouts (seconds), retry budget and circuit breaker of the LLM client
+LLM_CLIENT = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30,
+    'CONNECT_TIMEOUT': 5,
+    'READ_TIMEOUT': 60,
+    'MAX_RETRIES': 2,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 8,
+    'BREAKER_FAILURE_THRESHOLD': 5,
+    'BREAKER_RESET_TIMEOUT': 30,
+}
+
+# Models to fail over to after LLM_MODEL, in order of preference (comma-separated in the
+# environment). Entries may set their own BASE_URL, API_KEY and CLIENT (overrides of
+# LLM_CLIENT) to fail over to another provider
+LLM_FALLBACK_MODELS = [
+    {'MODEL': model.strip()} for model in os.getenv("LLM_FALLBACK_MODELS", "").split(",") if model.strip()
+]
+
+# Failover and hedging between LLM_MODELS (seconds), see api.router
+LLM_ROUTER = {
+    'HEDGE': os.getenv("LLM_HEDGE", "") == "1",
+    'HEDGE_QUANTILE': 0.95,
+    'HEDGE_MIN_DELAY': 1,
+    'MIN_SAMPLES': 20,
+    'STATS_WINDOW': 300,
+    'MAX_SAMPLES': 200,
+    'ERROR_WEIGHT': 4,
+    'COOLDOWN': 10,
+    'RETRIES_BEFORE_FAILOVER': 0,
+}
+
+# Cache for repeated prompts. Use api.response_cache.DjangoResponseCache (with CACHE_ALIAS)
+# to share it between processes, or api.response_cache.DummyResponseCache to disable it.
+LLM_RESPONSE_CACHE = {
+    'BACKEND': 'api.response_cache.LocMemResponseCache',
+    'TTL': 60 * 60,
+    'MAX_ENTRIES': 1024,
+    'MAX_BYTES': 16 * 1024 * 1024,
+}
+
+
+# Identical in-flight prompts share one upstream call. Coalescing across processes
+# needs CACHE_ALIAS to point at a shared cache (Redis, Memcached or the database cache)
+LLM_SINGLE_FLIGHT = {
+    'CACHE_ALIAS': 'default',
+    'LOCK_TIMEOUT': 120,
+    'WAIT_TIMEOUT': 90,
+    'POLL_INTERVAL': 0.05,
+    'RESULT_TTL': 30,
+}
+
+# Token buckets on the chat endpoints (RATE tokens per second, up to BURST), per user
+# and for the whole deployment. Use api.ratelimit.DjangoCacheRateLimiter with
+# CACHE_ALIAS pointing at a shared cache to enforce them across processes
+CHAT_RATE_LIMIT = {
+    'BACKEND': 'api.ratelimit.LocMemRateLimiter',
+    'USER_RATE': 0.5,
+    'USER_BURST': 10,
+    'GLOBAL_RATE': 5.0,
+    'GLOBAL_BURST': 20,
+}
+
+# Upstream calls running at once per process, and how many may queue for a slot (for
+# at most QUEUE_TIMEOUT seconds) before requests are refused with a 503
+LLM_ADMISSION = {
+    'MAX_IN_FLIGHT': 16,
+    'MAX_QUEUE': 32,
+    'QUEUE_TIMEOUT': 5.0,
+    'RETRY_AFTER': 5,
+}
+
+# Conversation history sent with each turn: at most MAX_MESSAGES previous turns,
+# trimmed to an estimated TOKEN_BUDGET, assembled prefix cached in CACHE_ALIAS
+LLM_CONTEXT = {
+    'MAX_MESSAGES': 20,
+    'TOKEN_BUDGET': 3000,
+    'CACHE_ALIAS': 'default',
+    'CACHE_TIMEOUT': 60 * 60,
+}
+
+# Text extracted from document attachments (txt, rtf, docx, pptx, xlsx, and pdf when
+# pypdf is installed), chunked and sent with each turn within CONTEXT_TOKENS
+LLM_ATTACHMENTS = {
+    'CHUNK_SIZE': 1500,
+    'CHUNK_OVERLAP': 150,
+    'MAX_CHARS': 500_000,
+    'CONTEXT_TOKENS': 2000,
+}
+
+# Top-k snippets of the user's other conversations and files, found with a per-user
+# in-memory BM25 index (the MAX_USERS most recently active users per process)
+LLM_RETRIEVAL = {
+    'ENABLED': True,
+    'TOP_K': 4,
+    'MAX_USERS': 256,
+    'SNIPPET_CHARS': 600,
+    # Shared between processes in production, so an import reaches every worker's indexes
+    'CACHE_ALIAS': 'default',
+}
+
+# In-process worker pool for background work such as text extraction
+BACKGROUND_TASKS = {
+    'WORKERS': 2,
+    'EAGER': False,
+}
+
+# Account deletion jobs delete this many conversations per transaction
+ACCOUNT_DELETION = {
+    'BATCH_SIZE': 100,
+}
+
+# Token usage ledger: events are written in batches of BATCH_SIZE, or once the oldest
+# has waited FLUSH_INTERVAL seconds. DAILY_TOKEN_QUOTA caps prompt + completion tokens
+# per user and day (None: no cap)
+USAGE_LEDGER = {
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 5.0,
+    'DAILY_TOKEN_QUOTA': None,
+}
+
+
+# Request timings (Server-Timing header, /metrics). Set TOKEN to require it as a Bearer
+# token on /metrics, which otherwise only answers local requests; requests slower than
+# SLOW_REQUEST seconds are logged with their spans
+METRICS = {
+    'TOKEN': os.getenv("METRICS_TOKEN"),
+    'SLOW_REQUEST': 10.0,
+    'SERVER_TIMING': True,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{asctime} {levelname} {name}: {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'api': {'handlers': ['console'], 'level': os.getenv("API_LOG_LEVEL", "INFO")},
+    },
+}
 
 
 # Application definition
@@ -53,7 +211,8 @@ INSTALLED_APPS = [
 # REST framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Reads the token verified by api.authentication.JWTAuthenticationMiddleware
+        'api.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -75,13 +234,26 @@ SIMPLE_JWT = {
     'USER_ID_CLAIM': 'user_id',
 }
 
+# Recently verified access tokens, reused until they expire instead of re-checking the signature
+AUTH_TOKEN_CACHE = {
+    'MAX_ENTRIES': 10_000,
+    # Where whether a user is still active is cached, for STATUS_TIMEOUT seconds. Share it
+    # between processes in production, or a deactivated user's tokens keep working on the
+    # other workers until their cached status expires
+    'CACHE_ALIAS': 'default',
+    'STATUS_TIMEOUT': 60,
+}
+
 
 MIDDLEWARE = [
+    # First, so its timings cover the whole request
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.authentication.JWTAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -29,11 +29,15 @@ export default function ConversationPage() {
   const [conversationId, setConversationId] = useState<string | null>(null);
   const [isLoading, setIsLoading] = useState<boolean>(false);
   const [isLoadingHistory, setIsLoadingHistory] = useState<boolean>(false);
+  const [olderCursor, setOlderCursor] = useState<string | null>(null);
+  const [isLoadingOlder, setIsLoadingOlder] = useState<boolean>(false);
   const [isSidebarCollapsed, setIsSidebarCollapsed] = useState<boolean>(false);
   const [selectedFiles, setSelectedFiles] = useState<File[]>([]);
   const [isDragging, setIsDragging] = useState<boolean>(false);
   const [isDarkMode, setIsDarkMode] = useState<boolean>();
   const messagesEndRef = useRef<HTMLDivElement | null>(null);
+  // Set while earlier messages are prepended, so the view does not jump to the bottom
+  const keepScrollRef = useRef<boolean>(false);
   const fileInputRef = useRef<HTMLInputElement | null>(null);
   
   
@@ -70,6 +74,10 @@ export default function ConversationPage() {
     
   // Scroll to bottom whenever messages change
   useEffect(() => {
+    if (keepScrollRef.current) {
+      keepScrollRef.current = false;
+      return;
+    }
     scrollToBottom();
   }, [messages]);
 
@@ -156,10 +164,16 @@ export default function ConversationPage() {
     fileInputRef.current?.click();
   };
 
-  async function loadConversationHistory(id: string) {
-    setIsLoadingHistory(true);
+  // Loads the newest page of messages, or with a cursor the page before it, prepended
+  async function loadConversationHistory(id: string, before: string | null = null) {
+    if (before) {
+      setIsLoadingOlder(true);
+    } else {
+      setIsLoadingHistory(true);
+    }
     try {
-      const response = await fetch(`${API_URL}/chat_history/${id}/`, {
+      const query = before ? `?before=${encodeURIComponent(before)}` : "";
+      const response = await fetch(`${API_URL}/chat_history/${id}/${query}`, {
         method: "GET",
         headers: {
           Authorization: `Bearer ${localStorage.getItem("access_token")}`,
@@ -170,9 +184,6 @@ export default function ConversationPage() {
       const data = await response.json();
   
       if (response.ok) {
-        // Clear existing messages first
-        setMessages([]);
-        
         // Transform the message format to match our component's structure
         const formattedMessages = (data.messages ?? []).map((msg: { 
           user_message: string; 
@@ -186,7 +197,13 @@ export default function ConversationPage() {
         }));
         
         // Set the messages
-        setMessages(formattedMessages);
+        if (before) {
+          keepScrollRef.current = true;
+          setMessages(prev => [...formattedMessages, ...prev]);
+        } else {
+          setMessages(formattedMessages);
+        }
+        setOlderCursor(data.older_cursor ?? null);
       } else {
         console.error("Error loading conversation:", data.error || "Unknown error occurred");
       }
@@ -194,6 +211,7 @@ export default function ConversationPage() {
       console.error("Failed to load conversation history:", error);
     } finally {
       setIsLoadingHistory(false);
+      setIsLoadingOlder(false);
     }
   }
 
@@ -444,6 +462,17 @@ export default function ConversationPage() {
         {messages.length > 0 && !isLoadingHistory && (
           <div className="flex-1 overflow-y-auto px-4 py-6 md:px-6">
             <div className="max-w-4xl mx-auto space-y-6">
+              {olderCursor && conversationId && (
+                <div className="flex justify-center">
+                  <button
+                    onClick={() => loadConversationHistory(conversationId, olderCursor)}
+                    disabled={isLoadingOlder}
+                    className={`px-3 py-1 text-xs rounded-md ${isDarkMode ? 'text-gray-400 hover:bg-gray-700' : 'text-gray-500 hover:bg-gray-100'} transition-colors`}
+                  >
+                    {isLoadingOlder ? "Loading..." : "Load earlier messages"}
+                  </button>
+                </div>
+              )}
               {messages.map((msg, index) => (
                 <div key={index} className="space-y-4">
                   {/* User message */}
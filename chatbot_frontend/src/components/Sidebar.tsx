@@ -23,6 +23,8 @@ interface UserProfile {
 export default function Sidebar() {
   const [chatHistory, setChatHistory] = useState<ChatHistoryItem[]>([]);
   const [isLoading, setIsLoading] = useState(true);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [error, setError] = useState<string | null>(null);
   const [isCollapsed, setIsCollapsed] = useState(false); // Default expanded on desktop
   const [isMobileMenuOpen, setIsMobileMenuOpen] = useState(false); // Mobile menu state
@@ -115,43 +117,49 @@ export default function Sidebar() {
     fetchUserProfile();
   }, []);
 
-  useEffect(() => {
-    // Fetch chat history from your backend API
-    async function fetchChatHistory() {
+  // Fetch one page of conversations from the backend; pages after the first are appended
+  async function fetchChatHistory(cursor: string | null = null) {
+    if (cursor) {
+      setIsLoadingMore(true);
+    } else {
       setIsLoading(true);
-      setError(null);
+    }
+    setError(null);
+    
+    try {
+      const token = localStorage.getItem('access_token');
+      if (!token) {
+        setError("Authentication required");
+        return;
+      }
       
-      try {
-        const token = localStorage.getItem('access_token');
-        if (!token) {
-          setError("Authentication required");
-          setIsLoading(false);
-          return;
-        }
-        
-        const response = await fetch(`${API_URL}/history2/`, {
-          method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${token}`,
-            'Content-Type': 'application/json',
-          },
-        });
-        
-        const data = await response.json();
-        
-        if (response.ok && data.chat_history) {
-          setChatHistory(data.chat_history);
-        } else {
-          setError(data.error || "Failed to load chat history");
-        }
-      } catch (err) {
-        setError("Network error. Please try again later.");
-        console.error("Failed to load chat history:", err);
-      } finally {
-        setIsLoading(false);
+      const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : "";
+      const response = await fetch(`${API_URL}/conversations/${query}`, {
+        method: 'GET',
+        headers: {
+          'Authorization': `Bearer ${token}`,
+          'Content-Type': 'application/json',
+        },
+      });
+      
+      const data = await response.json();
+      
+      if (response.ok && data.conversations) {
+        setChatHistory(prevHistory => cursor ? [...prevHistory, ...data.conversations] : data.conversations);
+        setNextCursor(data.next_cursor);
+      } else {
+        setError(data.error || "Failed to load chat history");
       }
+    } catch (err) {
+      setError("Network error. Please try again later.");
+      console.error("Failed to load chat history:", err);
+    } finally {
+      setIsLoading(false);
+      setIsLoadingMore(false);
     }
-    
+  }
+
+  useEffect(() => {
     fetchChatHistory();
   }, []);
 
@@ -407,6 +415,17 @@ export default function Sidebar() {
                     </li>
                   );
                 })}
+                {nextCursor && (
+                  <li>
+                    <button
+                      onClick={() => fetchChatHistory(nextCursor)}
+                      disabled={isLoadingMore}
+                      className={`w-full p-2 text-xs rounded-md ${isDarkMode ? 'text-gray-400 hover:bg-gray-700' : 'text-gray-500 hover:bg-gray-100'} transition-colors`}
+                    >
+                      {isLoadingMore ? "Loading..." : "Load more"}
+                    </button>
+                  </li>
+                )}
               </ul>
             )}
           </div>